@@ -1,6 +1,6 @@
 # vim:set ff=unix expandtab ts=4 sw=4:
 from .Model import Model
-import yaml
+from .helpers import load_yaml_str
 
 class IncompleteModel(Model):
     # the purpose of this class is to avoid complete initialization by Models __init__   
@@ -14,7 +14,7 @@ class IncompleteModel(Model):
         # if a model is created directly from a string (e.g. in tests) it does not have
         # a filename that could serve as an id in a folder 
         # To distinguish the different such models from each other an id has to be given manually
-        self.complete_dict = yaml.load(yaml_str)
+        self.complete_dict = load_yaml_str(yaml_str)
         self.id=id
 
 
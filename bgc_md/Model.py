@@ -6,6 +6,7 @@ from sympy.core import Atom
 
 import re
 import string
+from string import Template
 import yaml
 import builtins
 import sys
@@ -13,13 +14,16 @@ import pandas as pd
 import numpy as np
 
 from .ReportInfraStructure import Text, Math, ReportElementList, TableRow, Table, Header, Newline
+from . import bibtexc
 from .bibtexc import BibtexEntry, DoiNotFoundException, online_entry
-from .helpers import remove_indentation, create_symbols_func, eval_expressions, retrieve_or_default, retrieve_this_or_that, py2tex_silent
+from .helpers import remove_indentation, create_symbols_func, eval_expressions, retrieve_or_default, retrieve_this_or_that, py2tex_silent, load_yaml_str
 from .helpers_reservoir import factor_out_from_matrix
 from .DataFrame import DataFrame
+from .VariableTable import VariableTable
 from .Exceptions import ModelInitializationException
 from CompartmentalSystems.smooth_reservoir_model import SmoothReservoirModel
 from CompartmentalSystems.smooth_model_run import SmoothModelRun
+from .SmoothModelRunEnsemble import SmoothModelRunEnsemble
 
 
 ######### helper functions #############
@@ -115,7 +119,12 @@ def load_further_references(complete_dict):
                     ref['bibtex_entry'] = BibtexEntry.from_doi(ref_dict['doi'])
                 except DoiNotFoundException as e:
                     ex_string = "Invalid doi in further_references."
-                    raise(ModelInitializationException(ex_string + "\n" + e.__str__()))
+                    if not bibtexc.offline:
+                        raise(ModelInitializationException(ex_string + "\n" + e.__str__()))
+                    # offline the doi may just not be in the local store yet
+                    print("Warning:" + ex_string + " " + ref_dict['doi'] + " (offline mode)")
+                    ref['bibtex_entry'] = None
+                    ref['doi'] = ref_dict['doi']
             else:
                 ex_string = "Missing 'doi' and 'bibtex' in further_references."
                 raise(ModelInitializationException(ex_string))
@@ -262,12 +271,10 @@ def load_df(complete_dict, sections):
                     raise(ModelInitializationException('Variable description wrong in ' + sec + '.'))
                 row_list.append(row)
 
-    df = DataFrame(row_list)
+    df = VariableTable(row_list)
 
-    var_list = df.get_column('name')
-    for v in var_list:
-        if var_list.count(v) > 1:
-            raise(ModelInitializationException("Variable '" + v + "' defined more than once."))
+    if df.duplicate_names:
+        raise(ModelInitializationException("Variable '" + df.duplicate_names[0] + "' defined more than once."))
 
     return df
 
@@ -316,6 +323,55 @@ def load_expressions_and_symbols(complete_df):
     return (syms_dict, exprs_dict, symbols_by_type)
 
 
+def load_dependency_graph(complete_df, symbols_by_type):
+    # direct_dependencies: name -> names of the variables in its expression
+    # all_dependencies: name -> names in the whole dependency tree
+    # every expression is parsed only once, the transitive closure is
+    # built in topological order
+    direct_dependencies = {}
+    for name in complete_df.get_column('name'):
+        direct_dependencies[name] = set()
+        if 'exprs' in complete_df.head:
+            expr_strs = complete_df.get_by_cond('exprs', 'name', name)
+            if not expr_strs: continue
+            if not isinstance(expr_strs, list):
+                expr_strs = [expr_strs]
+            for expr_str in expr_strs:
+                rhs = expr_str.split("=", 1)[1].strip()
+                expr = sympify(rhs, locals=symbols_by_type)
+                direct_dependencies[name] |= set([str(atom) for atom in expr.free_symbols])
+
+    all_dependencies = {}
+    for root in direct_dependencies.keys():
+        # depth first search without recursion, a name is finished
+        # when all its dependencies are
+        stack = [root]
+        on_stack = set([root])
+        while stack:
+            name = stack[-1]
+            if name in all_dependencies.keys():
+                stack.pop()
+                on_stack.discard(name)
+                continue
+
+            unfinished = [dep for dep in direct_dependencies.get(name, set()) if dep not in all_dependencies.keys()]
+            if not unfinished:
+                deps = set()
+                for dep in direct_dependencies.get(name, set()):
+                    deps.add(dep)
+                    deps |= all_dependencies[dep]
+                all_dependencies[name] = deps
+                continue
+
+            for dep in unfinished:
+                if dep in on_stack:
+                    raise(ModelInitializationException("Circular dependency between the variables '" + name + "' and '" + dep + "'."))
+                stack.append(dep)
+                on_stack.add(dep)
+
+    return (direct_dependencies, all_dependencies)
+
+
 def load_model_run_data(complete_dict):
     try:
         tag = 'model_run_data'
@@ -368,7 +424,12 @@ def load_from_model_run_data(model_run_data, attr_name):
                 except DoiNotFoundException as e:
                     #ex_string = "Invalid doi in parameter set '" + lel['table_head'] + "'."
                     ex_string = "could not fetch doi " + lel['table_head'] + "'."
-                    raise(ModelInitializationException(ex_string + "\n" + e.__str__()))
+                    if not bibtexc.offline:
+                        raise(ModelInitializationException(ex_string + "\n" + e.__str__()))
+                    # offline the doi may just not be in the local store yet,
+                    # the raw doi is kept
+                    print("Warning:" + ex_string + " (offline mode)")
+                    lel['bibtex_entry'] = None
             else:
                 lel['bibtex_entry'] = None
 
@@ -613,7 +674,7 @@ class Model:
     @classmethod
     def from_str(cls,yaml_str, id):
         try:
-             complete_dict = yaml.load(yaml_str)
+             complete_dict = load_yaml_str(yaml_str)
         except yaml.YAMLError as ye:
             raise(ye)
             
@@ -621,14 +682,26 @@ class Model:
         return(model)
 
     @classmethod
-    def from_file(cls, yaml_file_name): 
+    def from_file(cls, yaml_file_name, cache_dir=None): 
         yaml_file_path=Path(yaml_file_name)
-        model = cls.from_path(yaml_file_path)
+        model = cls.from_path(yaml_file_path, cache_dir)
          
         return model
     
     @classmethod
-    def from_path(cls, yaml_file_path): 
+    def from_path(cls, yaml_file_path, cache_dir=None): 
+        # If cache_dir is given, the initialized model is pickled there
+        # and reused as long as the yaml file and the sources of the
+        # model classes do not change.
+        if cache_dir is not None:
+            from .model_cache import ModelCache
+            cache = ModelCache(cache_dir)
+            model = cache.load(yaml_file_path)
+            if model is None:
+                model = cls.from_path(yaml_file_path)
+                cache.store(yaml_file_path, model)
+            return model
+
         # We could create the new model by a call to its
         #   model = cls.from_str(yaml_str,id=name)
         # This would call init and thus implicitly __new__(cls) 
@@ -648,7 +721,7 @@ class Model:
         name=yaml_file_path.stem
         # now load the yaml str into a dictionary
         try:
-             complete_dict = yaml.load(yaml_str)
+             complete_dict = load_yaml_str(yaml_str)
         except yaml.YAMLError as ye:
             msg=Template("The Yaml in file ${ps} caused the following exception ${submsg}").substitute(ps=str(model.yaml_file_path),submsg=str(ye))
             raise(ModelInitializationException(msg))
@@ -672,8 +745,9 @@ class Model:
                 self.bibtex_entry = load_bibtex_entry(self.complete_dict)
             except DoiNotFoundException:
                 print("could not find BibtexEntry by doi")
-                if hasattr(self,'bibtex_entry'): 
-                    abstract =load_abstract(self.complete_dict, self.bibtex_entry)
+                self.bibtex_entry = None
+                # the abstract from the yaml file is still used
+                abstract = load_abstract(self.complete_dict, None)
                 if abstract is not None:
                     self.abstract = abstract
 
@@ -684,6 +758,7 @@ class Model:
             # if we want to switch to pandas the load_df should become obsolete
             self.df = load_df(self.complete_dict, self.sections)
             self.syms_dict, self.exprs_dict, self.symbols_by_type = load_expressions_and_symbols(self.df) 
+            self.direct_dependencies, self.all_dependencies = load_dependency_graph(self.df, self.symbols_by_type)
             self.set_component_keys()
 
             self.model_run_data = load_model_run_data(self.complete_dict)
@@ -737,14 +812,9 @@ class Model:
 
    
     def get_component_name_by_key(self, comp_key):
-        df = self.df
-        for i, name in enumerate(df.get_column("name")): 
-            entry = df[i,"key"]
-            if entry:
-                if not(isinstance(entry,list)):
-                    entry=[entry]
-                if comp_key in entry:
-                    return(name)
+        rows = self.df.rows_of_key(comp_key)
+        if rows:
+            return(self.df[rows[0], "name"])
         return None
 
     # fixme: 
@@ -1304,6 +1374,12 @@ class Model:
                 model_runs.append(mr)
         return(model_runs)
 
+    def model_run_ensemble(self, **kwargs):
+        # all model runs integrated together as one stacked system,
+        # they need to have the same run times,
+        # kwargs are passed on to SmoothModelRunEnsemble
+        return SmoothModelRunEnsemble.from_model_runs(self.model_runs, **kwargs)
+
 
     @property
     def reservoir_model(self):
@@ -1468,9 +1544,17 @@ class Model:
 #        df.remove_empty_columns()
 #        return df
     def has_key(self,target_key):
-        df=self.df
-        keylist=flatten([key for key in  df.get_column("key") if key])
-        return(target_key in keylist)
+        return(target_key in self.df.key_index.keys())
+
+    def _name_of_unique_key(self,target_key):
+        if not(self.has_key(target_key)):
+            raise(Exception("The model:"+str(self.name)+" has no key: "+str(target_key)))
+        #fixme :
+        # the following check should be made on model initialization for all keys found
+        rows=self.df.rows_of_key(target_key)
+        if len(rows)>1:
+            raise(Exception("the key: "+str(target_key)+" has been used at least twice"))
+        return(self.df[rows[0],"name"])
         
     def find_keys_used_in_key(self,target_key):
         # fixme:
@@ -1478,19 +1562,8 @@ class Model:
         
         # the component keys can not be used in general since 
         # they are used only for the components...
-        if not(self.has_key(target_key)):
-            raise(Exception("The model:"+str(self.name)+" has no key: "+str(target_key)))
         #find the symbol or expression related to target_key
-        df=self.df
-        keys=df.get_column("key")
-        i=keys.index(target_key)
-        names=df.get_column("name")
-        name=names[keys.index(target_key)]
-        #fixme :
-        # the following check should be made on model initialization for all keys found
-        keys.remove(target_key)
-        if target_key in keys: #still after one removal 
-            raise(Exception("the key: "+str(target_key)+" has been used at least twice"))
+        name=self._name_of_unique_key(target_key)
         # now get all the varnames that are part of the expr
         var_names=self.find_all_variables_in_dependency_tree_of_expr(name)
         res=set([])
@@ -1506,20 +1579,8 @@ class Model:
         
         # the component keys can not be used in general since 
         # they are used only for the components...
-        if not(self.has_key(target_key)):
-            raise(Exception("The model:"+str(self.name)+" has no key: "+str(target_key)))
         #find the symbol or expression related to target_key
-        df=self.df
-        keys=df.get_column("key")
-        i=keys.index(target_key)
-        names=df.get_column("name")
-        name=names[keys.index(target_key)]
-        #fixme :
-        # the following check should be made on model initialization for all keys found
-        keys.remove(target_key)
-        #
-        if target_key in keys: #still after one removal 
-            raise(Exception("the key: "+str(target_key)+" has been used at least twice"))
+        name=self._name_of_unique_key(target_key)
         # now get all the varnames that are part of the expr
         var_names=self.find_all_variables_in_dependency_tree_of_expr(name)
         res=set([])
@@ -1532,21 +1593,14 @@ class Model:
         return(res)
     
     def get_key_of_var_name_or_None(self,var_name):    
-        df=self.df
-        names=df.get_column("name")
-        keys=df.get_column("key")
-        rn=names.index(var_name)
-        return(keys[rn])
+        return(self.df.get_by_name(var_name,"key"))
 
     def get_expr_str_rhs_or_None(self,var_name):
         # fixme:
         # this should live in a new class . I propose: ModelVars
         
         # the method finds the unevaluated expression in self.df
-        names=self.df.get_column("name")
-        exprs=self.df.get_column("exprs")
-        rn=names.index(var_name)
-        expr_str=exprs[rn] #result could be None
+        expr_str=self.df.get_by_name(var_name,"exprs") #result could be None
         if expr_str:
             rhs= expr_str.split("=", 1)[1].strip()
             return(rhs)
@@ -1559,16 +1613,10 @@ class Model:
     def find_all_variables_in_dependency_tree_of_expr(self,var_name):
         # fixme:
         # this should live in a new class . I propose: ModelVars
-        expr_str=self.get_expr_str_rhs_or_None(var_name)
-        names=set()
-        if expr_str:
-            expr=sympify(expr_str, locals=self.symbols_by_type)
-            atoms=expr.free_symbols
-            if len(atoms)>0:
-                for atom in atoms:
-                    names.update([str(atom)]) #note the list bracket that prevent the string from beeing treated as a list of characters
-                    names.update(self.find_all_variables_in_dependency_tree_of_expr(str(atom)))
-        return(names)
+        if not hasattr(self,'all_dependencies'):
+            # the model has been assembled without __init__
+            self.direct_dependencies, self.all_dependencies = load_dependency_graph(self.df, self.symbols_by_type)
+        return(set(self.all_dependencies.get(var_name,set())))
 
 
 
@@ -14,6 +14,7 @@ from .plot_helpers import add_xhist_data_to_scatter,xhist_fs,yhist_fs
 from .ReportInfraStructure import ReportElementList, Header, Math, Meta, Text, Citation, Table, TableRow, Newline, MatplotlibFigure, exprs_to_element
 from .Model import Model, check_parameter_set_complete
 from .helpers import py2tex_silent, key_from_dict_by_value
+from .bibtexc import prefetch_record_dois
 
 from .DataFrame import DataFrame
 
@@ -68,12 +69,15 @@ class ModelList(list):
     # and get some methods to produce plots or report parts
     # this will eventually make it possible to get rid of plot_data in autogeneratedMd...
     @classmethod
-    def from_dir_path(cls,input_path):
+    def from_dir_path(cls,input_path,cache_dir=None):
     
         if not input_path.exists():
             raise(Exception("The input path " + input_path.as_posix() + " does not exist."))
         
-        model_list=cls(Model.from_path(p) for p in input_path.iterdir() if p.suffix == ".yaml")
+        yaml_paths=[p for p in input_path.iterdir() if p.suffix == ".yaml"]
+        # resolve all dois concurrently before the models are created one by one
+        prefetch_record_dois(yaml_paths)
+        model_list=cls(Model.from_path(p,cache_dir) for p in yaml_paths)
         return(model_list)
 
 
@@ -86,21 +90,12 @@ class ModelList(list):
 
     def plot_dependencies(self,target_key,ax):
        #print(target_key)
-        #first find all keys
-        all_keys=set()
-        for model in self:
-           #print(model.name)
-            deps=model.find_keys_or_symbols_used_in_key(target_key)
-           #print(deps)
-            all_keys.update(deps)
-        #now for every dependency find the number of models in which
-        #target_key depends on it
+        #find all keys and count for every dependency the number of
+        #models in which target_key depends on it
         hist=dict()
-        for dep in all_keys:
-            hist[dep]=0
-            for model in self:
-                if dep in model.find_keys_or_symbols_used_in_key(target_key):
-                    hist[dep]+=1
+        for model in self:
+            for dep in model.find_keys_or_symbols_used_in_key(target_key):
+                hist[dep]=hist.get(dep,0)+1
         dict_plot(hist,ax)   
         ax.set_ylabel("models")
         
@@ -108,14 +103,15 @@ class ModelList(list):
        #print(target_key)
         #first find all keys
         all_keys=set()
+        deps_by_model=[]
         for model in self:
-            #print(model.name)
             deps=model.find_keys_or_symbols_used_in_key(target_key)
-            #print(deps)
+            deps_by_model.append(deps)
             all_keys.update(deps)
 
 
         all_keys=list(all_keys)
+        key_positions={key:p for p,key in enumerate(all_keys)}
         #now for every dependency find the number of models in which
         #target_key depends on it
         #x=np.arange(len(hist_dict))
@@ -124,10 +120,10 @@ class ModelList(list):
         y_vals=range(len(self))
         model_names=[el.name for el in self]
         for y,mod in enumerate(self):
-            keys=mod.find_keys_or_symbols_used_in_key(target_key)
+            keys=deps_by_model[y]
             positions=[]
             for key in keys:
-                positions.append(all_keys.index(key))
+                positions.append(key_positions[key])
             ys=[y for p in positions]
             ax.scatter(positions,ys, s=100,alpha=0.9,  marker=indexed_filled_marker(y), c=indexed_color(y+20))
         ax.set_xticks(x_vals)
@@ -159,11 +155,10 @@ class ModelList(list):
         nr_hist = len(target_keys)
         fig.set_figheight(fig.get_figwidth()/8*nr_hist)
         # 2nd iterate over them 
-        for target_key in target_keys:
+        for count,target_key in enumerate(target_keys,1):
         # 3rd check wich models actually provide the target_key
             sublist=ModelList([m for m in self if m.has_key(target_key)])
         # Plot! 
-            count = target_keys.index(target_key)+1
             nr_columns=2
             nr_rows=ceiling(nr_hist/nr_columns)
             ax = fig.add_subplot(nr_rows,nr_columns, count) 
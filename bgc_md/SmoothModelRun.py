@@ -7,39 +7,121 @@ from mpl_toolkits.mplot3d import Axes3D
 #import plotly.plotly as py
 import plotly.graph_objs as go
 
-from sympy import lambdify, flatten, latex, Function, sympify, sstr
+from sympy import lambdify, flatten, latex, Function, sympify, sstr, binomial, Tuple
 from sympy.abc import _clash
+from sympy.core.function import AppliedUndef
 
 from scipy.integrate import odeint, quad 
 from scipy.interpolate import interp1d, UnivariateSpline
 from scipy.optimize import newton, brentq
+from scipy.linalg import expm
 
 from tqdm import tqdm
 import numpy as np
+import json
+import os
 import pickle
+import time
+from pathlib import Path
 
 from .SmoothReservoirModel import SmoothReservoirModel
-from .helpers_reservoir import has_pw, numsol_symbolic_system, arrange_subplots, melt, generalized_inverse_CDF, draw_rv, stochastic_collocation_transform, numerical_rhs, MH_sampling, save_csv, load_csv, stride
+from .lambdify_cache import cached_lambdify
+from .result_cache import ResultCache
+from .field_store import FieldStore
+from .helpers_reservoir import has_pw, numsol_symbolic_system, arrange_subplots, melt, generalized_inverse_CDF, draw_rv, stochastic_collocation_transform, numerical_rhs, MH_sampling, save_csv, load_csv, stride, exp_sinh_nodes, fork_map, tabulated_inverse_CDF, MH_sampling_chains, generalized_inverse_CDF_vectorized
+
+
+# version of the on-disk format of the state transition operator cache
+state_transition_operator_cache_format_version = 1
+
+# memory budget of the results cached by a SmoothModelRun
+default_cache_bytes = 512*2**20
 
 
 class SmoothModelRun:
-    def __init__(self, smooth_reservoir_model, parameter_set = None, start_values = None, times = None, func_set = {}):
+    # integrator is the name of one of the integrators in bgc_md.integrators,
+    # e.g. 'odeint' (LSODA), 'BDF' or 'Radau' for stiff systems,
+    # with use_jacobian the symbolic Jacobian of the system is passed to it,
+    # derived results are kept in a ResultCache of at most cache_bytes bytes
+    def __init__(self, smooth_reservoir_model, parameter_set = None, start_values = None, times = None, func_set = {}, integrator = 'odeint', use_jacobian = False, cache_bytes = default_cache_bytes):
         # we cannot use dict() as default because the test suite makes weird things with it!
         if parameter_set is None: parameter_set = dict()
         if func_set is None: func_set = dict()
         #fixme:
         # check for completeness and so on and so forth
+        self.result_cache = ResultCache(cache_bytes, owner = self)
         self.model = smooth_reservoir_model
         self.parameter_set = parameter_set
         self.times = times
-        self.start_values = start_values
         if not(isinstance(start_values,np.ndarray)):
             raise(Exception("start_values should be a numpy array"))
-        func_set = {str(key): val for key, val in func_set.items()}
+        self.start_values = start_values
         self.func_set = func_set
+        self.integrator = integrator
+        self.use_jacobian = use_jacobian
+        self._state_transition_operator_values = None
+        # 'integrate' or 'interpolate', see _state_transition_operator_cached
+        self.state_transition_operator_cache_mode = 'integrate'
+        self.state_transition_operator_cache_error = 0.0
+
+
+    # Everything derived from the parameters, functions, times and start
+    # values is computed once and kept in self.result_cache, only a few
+    # small properties of the compartmental matrix are attributes.
+    # Assigning new values to them clears the cache and drops the
+    # attributes, changing the dictionaries in place does not.
+    _attributes_depending_on_parameters = ('_constant_A', '_saved_is_linear_autonomous', '_constant_u', '_A_eig')
+
+    def _drop_derived_attributes(self, names):
+        for name in names:
+            self.__dict__.pop(name, None)
+        self.result_cache.clear()
+
+
+    @property
+    def parameter_set(self):
+        return self._parameter_set
+
+    @parameter_set.setter
+    def parameter_set(self, parameter_set):
+        self._parameter_set = parameter_set
+        self._drop_derived_attributes(self._attributes_depending_on_parameters)
         self._state_transition_operator_values = None
 
 
+    @property
+    def func_set(self):
+        return self._func_set
+
+    @func_set.setter
+    def func_set(self, func_set):
+        self._func_set = {str(key): val for key, val in func_set.items()}
+        self._drop_derived_attributes(self._attributes_depending_on_parameters)
+        self._state_transition_operator_values = None
+
+
+    @property
+    def times(self):
+        return self._times
+
+    @times.setter
+    def times(self, times):
+        self._times = times
+        self._drop_derived_attributes(())
+        # the cache is organized along the times
+        self._state_transition_operator_values = None
+
+
+    @property
+    def start_values(self):
+        return self._start_values
+
+    @start_values.setter
+    def start_values(self, start_values):
+        self._start_values = start_values
+        self._drop_derived_attributes(())
+
+
     # create self.A(t)
 
     # in a linear model, A(t) is independent of the state_variables,
@@ -49,28 +131,31 @@ class SmoothModelRun:
 
     # --> this should be respected by the class to which the model belongs
     def A(self, t):
-        if not hasattr(self, '_A'):
-            #fixme: what about a piecewise in the matrix?
-            # is this here the right place to do it??
-            cm_par = self.model.compartmental_matrix.subs(self.parameter_set)
-            tup = tuple(self.model.state_vector) + (self.model.time_symbol.name,)
-            cut_func_set = {key[:key.index('(')]: val for key, val in self.func_set.items()}
-            A_func = lambdify(tup, cm_par, [cut_func_set, 'numpy'])
-        
-            def _A(t):
-                #print('A', t)
-                #fixme: another times cut off!
-                t = min(t, self.times[-1])
-                #print(t)
-                #X = self.solve_single_value()(t) # nonlinear model needs that
-
-                X = np.ones((self.nr_pools,)) # for a linear model this is OK (and faster)
-                Xt = tuple(X) + (t,)
-                return  A_func(*Xt)
-
-            self._A = _A
-            
-        return self._A(t)     
+        if self._is_linear_autonomous:
+            return self._constant_A
+
+        return self.result_cache.cached('A', self._A_func)(t)
+
+
+    def _A_func(self):
+        #fixme: what about a piecewise in the matrix?
+        # is this here the right place to do it??
+        tup = tuple(self.model.state_vector) + (self.model.time_symbol.name,)
+        cut_func_set = {key[:key.index('(')]: val for key, val in self.func_set.items()}
+        A_func = cached_lambdify(tup, self.model.compartmental_matrix, self.parameter_set, cut_func_set)
+    
+        def _A(t):
+            #print('A', t)
+            #fixme: another times cut off!
+            t = min(t, self.times[-1])
+            #print(t)
+            #X = self.solve_single_value()(t) # nonlinear model needs that
+
+            X = np.ones((self.nr_pools,)) # for a linear model this is OK (and faster)
+            Xt = tuple(X) + (t,)
+            return  A_func(*Xt)
+
+        return _A
    
 
     def linearize(self):
@@ -157,25 +242,30 @@ class SmoothModelRun:
     ##### fluxes as functions #####
     
 
-    #fixme: test
+    # the pool contents as functions of scalar or array t,
+    # they evaluate the dense solution like solve_single_value
     def sol_funcs(self):
-        times = self.times
-
-        sol = self.solve(times)
-        sol_funcs = []
-        for i in range(self.nr_pools):
-            sol_inter = interp1d(times, sol[:,i])
-            sol_funcs.append(sol_inter)
-
-        return(sol_funcs)
+        def build():
+            sol = self.solve_single_value()
+            sol_funcs = []
+            for i in range(self.nr_pools):
+                # default argument, a closure would see only the last i
+                sol_funcs.append(lambda t, i = i: sol(t)[..., i] if np.ndim(t) > 0 else sol(t).reshape((-1,))[i])
+            return sol_funcs
+
+        return(list(self.result_cache.cached('sol_funcs', build)))
         
 
     #fixme: test and move
+    # the returned function also accepts arrays of times
     def f_of_t_maker(self,sol_funcs,ol):
         def ot(t):
             sv = [sol_funcs[i](t) for i in range(self.nr_pools)]
             tup = tuple(sv)+(t,)
             res = ol(*tup)
+            if np.ndim(t) > 0:
+                # constant fluxes do not depend on the arguments
+                res = np.broadcast_to(np.array(res, dtype = 'float64'), np.shape(t))
             return(res)
         return(ot)
 
@@ -186,65 +276,114 @@ class SmoothModelRun:
         flux_funcs = {}
         tup = tuple(m.state_variables) + (m.time_symbol,)
         for key, value in expr_dict.items():
-            o_par = sympify(value, locals=_clash).subs(self.parameter_set)
             cut_func_set = {key[:key.index('(')]: val for key, val in self.func_set.items()}
-            ol = lambdify(tup, o_par, modules = [cut_func_set, 'numpy'])
+            ol = cached_lambdify(tup, sympify(value, locals=_clash), self.parameter_set, cut_func_set)
             flux_funcs[key] = self.f_of_t_maker(sol_funcs, ol)
 
         return(flux_funcs)
 
 
+    # the flux functions of the model, built once,
+    # kind is one of 'input', 'output' and 'internal'
+    def _cached_flux_funcs(self, kind):
+        expr_dicts = {'input': self.model.input_fluxes,
+                      'output': self.model.output_fluxes,
+                      'internal': self.model.internal_fluxes}
+        return self.result_cache.cached(('flux_funcs', kind), lambda: self.flux_funcs(expr_dicts[kind]))
+
+
+    # all input or output fluxes as one function of t, returning an array
+    # of shape (n,) for scalar t and (len(t), n) for an array t,
+    # the fluxes are evaluated by a single lambdified function
+    def _flux_vector_func(self, kind):
+        def build():
+            m = self.model
+            n = self.nr_pools
+            expr_dict = {'input': m.input_fluxes, 'output': m.output_fluxes}[kind]
+            pools = list(expr_dict.keys())
+            sol_funcs = self.sol_funcs()
+            tup = tuple(m.state_variables) + (m.time_symbol,)
+            cut_func_set = {key[:key.index('(')]: val for key, val in self.func_set.items()}
+            ol = cached_lambdify(tup, Tuple(*[sympify(expr_dict[pool], locals = _clash) for pool in pools]), self.parameter_set, cut_func_set)
+
+            def single_value(t):
+                res = np.zeros((n,))
+                if pools:
+                    res[pools] = np.array(ol(*([sol_func(t) for sol_func in sol_funcs] + [t])), dtype = 'float64')
+                return res
+
+            def flux_vector(t):
+                if np.ndim(t) == 0:
+                    return single_value(t)
+
+                t = np.array(t, dtype = 'float64')
+                res = np.zeros(t.shape + (n,))
+                if not pools:
+                    return res
+                try:
+                    with np.errstate(all = 'ignore'):
+                        vals = ol(*([sol_func(t) for sol_func in sol_funcs] + [t]))
+                    res[..., pools] = np.stack([np.broadcast_to(np.array(val, dtype = 'float64'), t.shape) for val in vals], axis = -1)
+                except (TypeError, ValueError):
+                    # functions in func_set that cannot handle arrays
+                    res = np.array([single_value(ti) for ti in t.reshape((-1,))]).reshape(t.shape + (n,))
+                return res
+
+            return flux_vector
+
+        return self.result_cache.cached(('flux_vector_func', kind), build)
+
+
     def external_input_flux_funcs(self):
-        return(self.flux_funcs(self.model.input_fluxes))
+        return(dict(self._cached_flux_funcs('input')))
 
 
     def internal_flux_funcs(self):
-        return(self.flux_funcs(self.model.internal_fluxes))
+        return(dict(self._cached_flux_funcs('internal')))
 
 
     def output_flux_funcs(self):
-        return(self.flux_funcs(self.model.output_fluxes))
+        return(dict(self._cached_flux_funcs('output')))
     
 
     def output_vector_func(self, t):
-        res = np.zeros((self.nr_pools,))
-        for key, value in self.output_flux_funcs().items():
-            res[key] = value(t)
-
-        return res
+        return self._flux_vector_func('output')(t)
 
 
     ##### fluxes as vector-valued functions #####
     
 
     #fixme: returns a function
+    # u(t) also accepts an array of times and returns (len(t), n) then
     def external_input_vector_func(self):
         t0 = self.times[0]
-        # cut off inputs until t0
-        t_valid = lambda t: True if (t0<t) and (t<=self.times[-1]) else False
+        t_max = self.times[-1]
+        input_vector = self._flux_vector_func('input')
+
+        def u(t):
+            # cut off inputs until t0
+            if np.ndim(t) == 0:
+                if (t0 < t) and (t <= t_max):
+                    return input_vector(t)
+                return np.zeros((self.nr_pools,))
+
+            t = np.array(t, dtype = 'float64')
+            valid = (t0 < t) & (t <= t_max)
+            res = np.zeros(t.shape + (self.nr_pools,))
+            if valid.any():
+                res[valid] = input_vector(t[valid])
+            return res
 
-        input_fluxes = []
-        for i in range(self.nr_pools):
-            if i in self.external_input_flux_funcs().keys():
-                input_fluxes.append(self.external_input_flux_funcs()[i])
-            else:
-                input_fluxes.append(lambda t: 0)
-        
-        u = lambda t: np.array([f(t) for f in input_fluxes], dtype=np.float) if t_valid(t) else np.zeros((self.nr_pools,))
         return u
 
     # fixme: returns a vector
     def output_rate_vector_at_t(self, t):
-        n = self.nr_pools
-
         sol_funcs = self.sol_funcs()
         output_vec_at_t = self.output_vector_func(t)
 
-        rate_vec = np.zeros((n,))
-        for pool in range(n):
-            x = sol_funcs[pool](t)
-            if x != 0:
-                rate_vec[pool] = output_vec_at_t[pool] / x
+        x = np.stack([sol_func(t) for sol_func in sol_funcs], axis = -1)
+        rate_vec = np.zeros(np.shape(output_vec_at_t))
+        np.divide(output_vec_at_t, x, out = rate_vec, where = (x != 0))
 
         return rate_vec
 
@@ -264,6 +403,33 @@ class SmoothModelRun:
         return(self._flux_vector(self.model.external_outputs))
 
 
+    # internal fluxes as array of shape (len(times), n, n),
+    # entry [ti, i, j] is the flux from pool i to pool j at times[ti]
+    @property
+    def internal_flux_matrix(self):
+        n = self.nr_pools
+        keys = list(self.model.internal_fluxes.keys())
+        res = np.zeros((len(self.times), n, n))
+        if keys:
+            vals = self._flux_array([self.model.internal_fluxes[key] for key in keys])
+            for k, (i, j) in enumerate(keys):
+                res[:, i, j] = vals[:, k]
+
+        return res
+
+
+    # external input and output fluxes as arrays of shape (len(times), n),
+    # other than external_input_vector the inputs at times[0] are kept
+    @property
+    def external_input_flux_vector(self):
+        return self._flux_dict_array(self.model.input_fluxes)
+
+
+    @property
+    def external_output_flux_vector(self):
+        return self._flux_dict_array(self.model.output_fluxes)
+
+
     @property    
     def output_rate_vector(self):
         n = self.nr_pools
@@ -271,11 +437,10 @@ class SmoothModelRun:
         soln = self.solve()
         output_vec = self.external_output_vector
 
-        # take care of possible division by zero
-        output_vec[soln==0] = 0
-        soln[soln==0] = 0
-
-        return output_vec/soln
+        # the output rates of empty pools are not defined, they are nan
+        output_vec = np.where(soln == 0, 0, output_vec)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return output_vec/soln
 
 
 
@@ -294,26 +459,26 @@ class SmoothModelRun:
     # returns a function p that takes an age array "ages" as argument
     # and gives back a three-dimensional ndarray (ages x times x pools)
     # start_age_densities is a array-valued function of age
-    def pool_age_densities_func(self, start_age_densities = None):
-        p1 = self._age_densities_1(start_age_densities)
-        p2 = self._age_densities_2()
+    # with grid = True the field is swept along the characteristics of 
+    # the regular time grid, then the times must be equidistant and all 
+    # ages must be multiples of the time step
+    def pool_age_densities_func(self, start_age_densities = None, grid = False):
+        if grid:
+            p_grid = self._age_densities_grid(start_age_densities)
+        else:
+            p1 = self._age_densities_1(start_age_densities)
+            p2 = self._age_densities_2()
         
         def p(ages):
-            if hasattr(self, '_computed_age_density_fields'):
-                if (start_age_densities, tuple(ages)) in self._computed_age_density_fields.keys():
-                    #print('using cached result')
-                    return self._computed_age_density_fields[(start_age_densities, tuple(ages))]
-            else:
-                self._computed_age_density_fields = {}
-        
-            field_list = []
-            for a in tqdm(ages):
-                field_list.append(p1(np.array([a])) + p2(np.array([a])))
+            # functions are compared by code and the values they see
+            key = ResultCache.key('age_density_field', start_age_densities, np.array(ages, dtype = 'float64'), grid)
 
-            field = np.array(field_list)[:,0,:,:]
-            
-            self._computed_age_density_fields[(start_age_densities, tuple(ages))] = field
-            return field
+            def compute():
+                if grid:
+                    return p_grid(ages)
+                return p1(ages) + p2(ages)
+
+            return self.result_cache.cached(key, compute)
                 
         return p
 
@@ -533,15 +698,38 @@ class SmoothModelRun:
     # not that easy to resolve, since here we do not use age_densities,
     # instead ages is really needed to be able to make the shift or call the state_transition_operator
     def forward_transit_time_density_func(self, cut_off = True):
-        p_sv = self.forward_transit_time_density_single_value(cut_off)
-        pp = lambda a: np.array([p_sv(a,t) for t in self.times], np.float)
-        #p = lambda ages: np.array([pp(a) for a in ages], np.float)
+        times = self.times
+        t0 = times[0]
+        t_max = times[-1]
+        n = self.nr_pools
+        input_func = self.external_input_vector_func()
+        U = np.array([np.array(input_func(t), dtype = 'float64').reshape((n,)) for t in times])
+        no_input = (U.sum(axis = 1) == 0)
+
         def p(ages):
-            field_list = []
-            for a in tqdm(ages):
-                field_list.append(pp(a))
+            ages = np.array(ages, dtype = 'float64').reshape((-1,))
+            A, T = np.meshgrid(ages, times, indexing = 'ij')
+            field = np.zeros(A.shape)
+
+            # we cannot compute the density if t+a is out of bounds
+            nan_mask = np.zeros(A.shape, dtype = bool)
+            if cut_off: nan_mask |= (T+A > t_max)
+            nan_mask |= (T+A >= t0) & no_input[np.newaxis,:]
+            
+            # nothing leaves before t0 or at negative ages
+            todo = (A >= 0) & (T+A >= t0) & ~nan_mask
+            if todo.any():
+                ti = np.where(todo)[1]
+                S = T[todo]+A[todo]
+                vals = self._state_transition_operator_batch(S, T[todo], U[ti])
 
-            field = np.array(field_list)
+                # the leaving mass is the negative column sum of A(t+a)
+                # applied to Phi(t+a, t)u(t)
+                u_S, inverse = np.unique(S, return_inverse = True)
+                col_sums = np.array([np.array(self.A(s), dtype = 'float64').sum(axis = 0) for s in u_S])
+                field[todo] = -(col_sums[inverse] * vals).sum(axis = 1)
+
+            field[nan_mask] = np.nan
 
             return field
 
@@ -587,7 +775,55 @@ class SmoothModelRun:
         pass
 
 
-    def forward_transit_time_moment(self, order):
+    # the k-th moment of the forward transit time of the mass entering at t
+    # is the integral over [0, oo) of k*a**(k-1) times the fraction of it
+    # still in the system at t+a, this fraction is computed for all 
+    # quadrature nodes by one integration of the no-input system per start time,
+    # with processes > 1 the start times are distributed to forked processes
+    # method = 'quad' uses scipy's adaptive quad, which is much slower
+    def forward_transit_time_moment(self, order, method = 'exp_sinh', processes = 1):
+        if method == 'quad':
+            return self._forward_transit_time_moment_quad(order)
+        if method != 'exp_sinh':
+            raise(Exception("Unknown method '" + str(method) + "'"))
+
+        k = order
+        times = self.times
+        n = self.nr_pools
+        input_vector = self.external_input_vector
+        if k == 0:
+            return np.where(input_vector.sum(1) == 0, np.nan, 1.0)
+
+        if self._is_linear_autonomous:
+            A = self._constant_A
+            if self._invertible_constant_A and np.all(np.linalg.eigvals(A).real < 0):
+                # E(T^k) = k! 1^T (-A)^(-k) u / 1^T u
+                B = np.linalg.matrix_power(np.linalg.inv(-A), k)
+                col_sums = B.sum(axis = 0)*np.prod(range(1, k+1))
+                U = input_vector
+                with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                    res = U.dot(col_sums)/U.sum(1)
+                res[U.sum(1) == 0] = np.nan
+                return res
+
+        nodes, weights = exp_sinh_nodes()
+        kernel = weights*k*nodes**(k-1)
+
+        def moment_at_ti(ti):
+            u = input_vector[ti] 
+            
+            # if we have no inputs, there cannot be a transit(time)
+            if u.sum() == 0:    
+                return np.nan
+
+            X = self._no_input_trajectory(times[ti], u, nodes)
+            return kernel.dot(X.sum(axis = 1))/u.sum()
+
+        res = np.array(fork_map(moment_at_ti, range(len(times)), processes))
+        return res
+
+
+    def _forward_transit_time_moment_quad(self, order):
         k = order
         times = self.times
         Phi = self._state_transition_operator
@@ -621,78 +857,100 @@ class SmoothModelRun:
         return res
 
     #fixme: split into two functions for SCCS and MH
-    def apply_to_forward_transit_time_simulation(self, f_dict = {'mean': np.mean}, N = 10000, M = 2, k = 5, MH = False):
+    def apply_to_forward_transit_time_simulation(self, f_dict = {'mean': np.mean}, N = 10000, M = 2, k = 5, MH = False, processes = 1, seed = None, nr_chains = 10, return_diagnostics = False):
         # f is a Python function, for the mean, take f = np.mean
         # N is the number of simulations per each time step
         # M is the number of collocation points for stochastic collocation sampling
         # allowed values for M are 2, 3, 4, ..., 11
-        # other values lead to inverse transform sampling (slow)
+        # other values lead to inverse transform sampling
         # k is the order of the smoothing and interpolating spline
         # 'smoothin_spline' is best used for inverse transform sampling, because of additional smoothing for low
         # number of random variates
         # for SCMCS (M in [2,...,11]), 'interpolation' is better, because the higher number of random variates 
         # (because of faster sampling) makes their mean already quite precise (in the framework of what is possible with SCMCS)
-  
-        times = self.times
-        Phi = self._state_transition_operator
-        input_func = self.external_input_vector_func()
-
-        if not MH:
-            self.n = 0
-            def F_FTT(a, t):
-                u = input_func(t)
-                if u.sum() == 0: 
-                    return np.nan
-                
-                if (a <= 0): return 0.0
+        # MH = True uses nr_chains Metropolis-Hastings chains side by side
+        # the time steps are distributed to processes forked processes,
+        # every time step draws from its own random stream derived from seed,
+        # so the results do not depend on processes
+        # with return_diagnostics (res, diagnostics) is returned, 
+        # see _forward_transit_time_simulation
+        sampling = 'MH' if MH else 'collocation'
+        return self._forward_transit_time_simulation(f_dict, self.times, N, M, k, sampling, processes, seed, nr_chains, return_diagnostics)
 
-                self.n += 1
-                return 1 - Phi(t+a, t, u).sum()/u.sum()
-    
-            
-            def simulate(n, CDF):
-                # compute lagrange polynomial p if M is in [2, ..., 11]
-                g = stochastic_collocation_transform(M, CDF)
-                if g is None: 
-                    # inverse transform sampling
-                    print('inverse transform sampling')
-                    rvs = np.array([draw_rv(CDF) for _ in range(n)])
-                else:
-                    norms = np.random.normal(size = n)
-                    rvs = g(norms)
-        
-                return rvs
 
-        else:
-            self.m = 0
-            p_sv = self.forward_transit_time_density_single_value(cut_off = False)
-            def f_FTT(a, t):
-                self.m += 1
-                return p_sv(a, t)
+    # use inverse transform sampling
+    def apply_to_forward_transit_time_simulation_its(self, f_dict, times, N = 1000, k = 5, processes = 1, seed = None, return_diagnostics = False):
+        # f is a Python function, for the mean, take f = np.mean
+        # N is the number of simulations per each time step
+        # times is an np.array of interpolation points
+        # k is the order of the smoothing and interpolating spline
+        # 'smoothin_spline' is best used for inverse transform sampling, because of additional smoothing for low
+        # number of random variates
+        return self._forward_transit_time_simulation(f_dict, times, N, None, k, 'its', processes, seed, None, return_diagnostics)
+
+
+    # the forward transit time CDF of the mass entering at t is tabulated on
+    # exp-sinh ages by one integration of the no-input system, inverse 
+    # transform and collocation samples are drawn from this table,
+    # the MH chains evaluate the density in one batch per step and start
+    # at values drawn from the table
+    # diagnostics contains per time: the duration in seconds and the number 
+    # of state transition operator evaluations (integrations or batches)
+    def _forward_transit_time_simulation(self, f_dict, times, N, M, k, sampling, processes, seed, nr_chains, return_diagnostics):
+        times = np.array(times, dtype = 'float64')
+        n = self.nr_pools
+        input_func = self.external_input_vector_func()
+        ages, _ = exp_sinh_nodes(h = 1/128)
+        streams = np.random.SeedSequence(seed).spawn(len(times))
 
+        def simulate(ti):
+            start = time.time()
+            rng = np.random.default_rng(streams[ti])
+            t = times[ti]
+            u = np.array(input_func(t), dtype = 'float64').reshape((n,))
+            calls = 0
 
-        res = {f_name: {'values': [], 'smoothing_spline': None, 'interpolation': None} for f_name in f_dict.keys()}
-        for t in times:
-            print('time', t)
             # no iput means no forward transit time
-            u = input_func(t)
             if u.sum() == 0: 
                 rvs = np.nan
+            elif sampling == 'MH':
+                def PDF(a):
+                    # the leaving mass is the negative column sum of A(t+a)
+                    # applied to Phi(t+a, t)u(t)
+                    S = t+a
+                    X = self._state_transition_operator_batch(S, t, np.tile(u, (len(a), 1)))
+                    col_sums = np.array([np.array(self.A(s), dtype = 'float64').sum(axis = 0) for s in S])
+                    return -(col_sums*X).sum(axis = 1)/u.sum()
+
+                # the short chains start at values drawn from the tabulated
+                # distribution, from a common start they would be biased
+                CDF_values = 1 - self._no_input_trajectory(t, u, ages).sum(axis = 1)/u.sum()
+                starts = tabulated_inverse_CDF(ages, CDF_values, rng.uniform(size = nr_chains))
+                starts[~np.isfinite(starts)] = ages[-1]
+                rvs, calls = MH_sampling_chains(N, PDF, nr_chains, start = np.maximum(starts, ages[0]), rng = rng)
+                calls += 1
             else:
-                if not MH:
-                    rvs = simulate(N, lambda a: F_FTT(a, t))
-                    print(self.n, 'calls of state transition operator')
+                CDF_values = 1 - self._no_input_trajectory(t, u, ages).sum(axis = 1)/u.sum()
+                calls = 1
+                g = None
+                if sampling == 'collocation':
+                    # compute lagrange polynomial p if M is in [2, ..., 11]
+                    CDF = lambda a: np.interp(a, ages, CDF_values, left = 0.0)
+                    g = stochastic_collocation_transform(M, CDF, vectorized = True)
+                if g is None: 
+                    rvs = tabulated_inverse_CDF(ages, CDF_values, rng.uniform(size = N))
                 else:
-                    rvs = MH_sampling(N, lambda a: f_FTT(a, t))
-                    print(self.m, 'calls of forward transit time density')
+                    rvs = g(rng.normal(size = N))
 
-            for f_name, f in f_dict.items():
-                value = f(rvs)
-                res[f_name]['values'].append(value)
-                print(f_name, value)
-                
+            values = {f_name: f(rvs) for f_name, f in f_dict.items()}
+            return values, time.time()-start, calls
+
+        start = time.time()
+        results = fork_map(simulate, range(len(times)), processes)
+
+        res = {f_name: {'values': [], 'smoothing_spline': None, 'interpolation': None} for f_name in f_dict.keys()}
         for f_name in res.keys():
-            y = np.array(res[f_name]['values'])
+            y = np.array([values[f_name] for values, _, _ in results], dtype = 'float64')
             z = y.copy()
             res[f_name]['values'] = y.copy()
 
@@ -702,60 +960,39 @@ class SmoothModelRun:
             res[f_name]['smoothing_spline'] = UnivariateSpline(times, y, w=~w, k=k, check_finite=True)
             res[f_name]['interpolation'] = interp1d(times[~w], z[~w], kind=k)
 
-        return res
+        diagnostics = {
+            'times': times,
+            'durations': np.array([duration for _, duration, _ in results]),
+            'calls': np.array([calls for _, _, calls in results]),
+            'total_duration': time.time()-start,
+            'processes': processes}
 
-    # use inverse transform sampling
-    def apply_to_forward_transit_time_simulation_its(self, f_dict, times, N = 1000, k = 5):
-        # f is a Python function, for the mean, take f = np.mean
-        # N is the number of simulations per each time step
-        # times is an np.array of interpolation points
-        # k is the order of the smoothing and interpolating spline
-        # 'smoothin_spline' is best used for inverse transform sampling, because of additional smoothing for low
-        # number of random variates
-  
-        Phi = self._state_transition_operator
-        input_func = self.external_input_vector_func()
-
-        def F_FTT(a, t):
-            u = input_func(t)
-            if u.sum() == 0: 
-                return np.nan
-            
-            if (a <= 0): return 0.0
+        if return_diagnostics:
+            return res, diagnostics
+        return res
 
-            return 1 - Phi(t+a, t, u).sum()/u.sum()
 
-        res = {f_name: {'values': [], 'smoothing_spline': None, 'interpolation': None} for f_name in f_dict.keys()}
-        for t in times:
-            print('time', t)
-            # no iput means no forward transit time
-            u = input_func(t)
-            if u.sum() == 0: 
-                rvs = np.nan
-            else:
-                CDF = lambda a: F_FTT(a, t)
-                rvs = np.array([draw_rv(CDF) for _ in range(N)])
+    # returns Phi(t+a, t)x for all ages a as (len(ages) x n) array,
+    # computed by one integration of the no-input system
+    def _no_input_trajectory(self, t, x, ages):
+        n = self.nr_pools
+        x = np.array(x, dtype = 'float64').reshape((n,))
+        ages = np.array(ages, dtype = 'float64').reshape((-1,))
+        if np.any(ages < 0):
+            raise(Exception("Evaluation before t0 is not possible"))
 
-            for f_name, f in f_dict.items():
-                value = f(rvs)
-                res[f_name]['values'].append(value)
-                print(f_name, value)
-                
-        def compute_splines(res, times):
-            for f_name in res.keys():
-                y = np.array(res[f_name]['values'])
-                z = y.copy()
-                res[f_name]['values'] = y.copy()
-
-                # give weight zero to nan values fo compting the spline
-                w = np.isnan(y)
-                y[w] = 0.
-                res[f_name]['smoothing_spline'] = UnivariateSpline(times, y, w=~w, k=k, check_finite=True)
-                res[f_name]['interpolation'] = interp1d(times[~w], z[~w], kind=k)
+        if self._is_linear_autonomous:
+            return np.einsum('ijk,k->ij', self._expm_batch(ages), x)
 
-            return res
+        u_ages, inverse = np.unique(ages, return_inverse = True)
+        res = np.zeros((len(u_ages), n))
+        res[:] = x
+        later = u_ages > 0
+        if later.any():
+            int_times = np.concatenate(([t], t+u_ages[later]))
+            res[later] = odeint(self._no_input_num_rhs, x, int_times, mxstep = 10000)[1:]
 
-        return compute_splines(res, times)
+        return res[inverse]
 
 
     ##### comma separated values output methods #####
@@ -842,6 +1079,75 @@ class SmoothModelRun:
         save_csv(filename, melted, header)
         
 
+    ##### binary output methods #####
+
+
+    # The fields are written to a chunked FieldStore in the directory
+    # filename, with the ages, times and pool names as coordinates.
+    # The pools are followed by the system, like in the csv files.
+
+
+    @property
+    def _pool_and_system_names(self):
+        return [str(sv) for sv in self.model.state_vector] + ['system']
+
+
+    def save_pools_and_system_density_store(self, filename, pool_age_densities, system_age_density, ages, chunk_rows = 64):
+        n = self.nr_pools
+        with FieldStore.create(filename, ['age', 'time', 'pool'], {'time': self.times, 'pool': self._pool_and_system_names}, chunk_rows = chunk_rows) as store:
+            for k in range(0, len(ages), chunk_rows):
+                rows = np.zeros((len(ages[k:k+chunk_rows]), len(self.times), n+1))
+                rows[:,:,:n] = pool_age_densities[k:k+chunk_rows]
+                rows[:,:,n] = system_age_density[k:k+chunk_rows]
+                store.append(rows, ages[k:k+chunk_rows])
+
+
+    # computes the pool and system age densities for chunk_rows ages at a
+    # time and appends them to the store, so that the whole field
+    # never needs to be in memory
+    def pools_and_system_density_store(self, filename, ages, start_age_densities = None, grid = False, chunk_rows = 64):
+        p = self.pool_age_densities_func(start_age_densities, grid)
+        with FieldStore.create(filename, ['age', 'time', 'pool'], {'time': self.times, 'pool': self._pool_and_system_names}, chunk_rows = chunk_rows) as store:
+            for k in range(0, len(ages), chunk_rows):
+                pool_age_densities = p(ages[k:k+chunk_rows])
+                rows = np.concatenate((pool_age_densities, pool_age_densities.sum(2)[:,:,np.newaxis]), axis = 2)
+                store.append(rows, ages[k:k+chunk_rows])
+
+        return self.load_store(filename)
+
+
+    def save_pools_and_system_value_store(self, filename, pools_ndarr, system_arr):
+        values = self.combine_pools_and_system_values(pools_ndarr, system_arr)
+        with FieldStore.create(filename, ['time', 'pool'], {'pool': self._pool_and_system_names}, chunk_rows = max(len(self.times), 1)) as store:
+            store.append(values, self.times)
+
+
+    def save_value_store(self, filename, ndarr):
+        with FieldStore.create(filename, ['time'], {}, chunk_rows = max(len(self.times), 1)) as store:
+            store.append(ndarr, self.times)
+
+
+    def save_density_store(self, filename, density, ages, times = None, chunk_rows = 64):
+        if times is None: times = self.times
+        with FieldStore.create(filename, ['age', 'time'], {'time': times}, chunk_rows = chunk_rows) as store:
+            store.append(density, ages)
+
+
+    ##### binary input methods #####
+
+
+    # the returned FieldStore reads the values lazily,
+    # e.g. store[:, ::10, -1] or store.to_array()
+    def load_store(self, filename, check_times = True):
+        store = FieldStore.open(filename)
+        if check_times and ('time' in store.dims):
+            times = store.coords['time']
+            if (len(times) != len(self.times)) or not np.allclose(times, self.times, rtol = 1e-12, atol = 0):
+                raise(Exception('The stored field does not correspond to the times of this model run.'))
+
+        return store
+
+
     ##### comma separated values input methods #####
 
 
@@ -893,6 +1199,69 @@ class SmoothModelRun:
         return (pool_values, system_values)
 
 
+    # the density at age a_k = k*dt and time t_j = t0 + j*dt is carried
+    # along its characteristic by the step propagators,
+    # p(a_k+1, t_j+1) = Phi(t_j+1, t_j) p(a_k, t_j),
+    # starting from the start age densities at t0 and the inputs at age 0
+    def _age_densities_grid(self, start_age_densities = None):
+        times = self.times
+        t0 = times[0]
+        n = self.nr_pools
+        u = self.external_input_vector_func()
+
+        if start_age_densities is None:
+            # all mass is assumed to have age 0 at the beginning
+            def start_age_densities(a):
+                if a != 0: return np.array((0,)*self.nr_pools)
+                return np.array(self.start_values)
+
+        dt = (times[-1]-t0)/(len(times)-1) if len(times) > 1 else 0
+        if (len(times) > 1) and not np.allclose(np.diff(times), dt, rtol = 1e-8, atol = 0):
+            raise(Exception("The grid mode needs equidistant times."))
+
+        def p(ages):
+            ages = np.array(ages, dtype = 'float64').reshape((-1,))
+            if len(times) > 1:
+                ks = ages/dt
+            else:
+                ks = ages
+            age_indices = np.round(ks).astype('int64')
+            if np.any(age_indices < 0) or not np.allclose(ks, age_indices, rtol = 0, atol = 1e-8):
+                raise(Exception("In grid mode the ages must be nonnegative multiples of the time step."))
+
+            nr_ages = (age_indices.max()+1) if len(ages) > 0 else 0
+            nr_times = len(times)
+            field = np.zeros((nr_ages, nr_times, n))
+            if nr_ages == 0:
+                return field
+
+            # boundaries: mass present at t0 and inputs with age 0
+            for k in range(nr_ages):
+                field[k, 0] = np.array(start_age_densities(k*dt), dtype = 'float64').reshape((n,))
+            for j in range(1, nr_times):
+                field[0, j] = np.array(u(times[j]), dtype = 'float64').reshape((n,))
+
+            if self._is_linear_autonomous and (nr_times > 1):
+                M = self._expm_batch([dt])[0]
+            for j in range(nr_times-1):
+                X = field[:-1, j]
+                if self._is_linear_autonomous:
+                    field[1:, j+1] = X.dot(M.T)
+                elif self._is_linear:
+                    M_j = self._state_transition_operator_matrices(times[j], [times[j+1]])[0]
+                    field[1:, j+1] = X.dot(M_j.T)
+                else:
+                    todo = np.any(X != 0, axis = 1)
+                    if todo.any():
+                        field[1:, j+1][todo] = self._no_input_sol_batch(times[j], np.repeat(times[j+1], todo.sum()), X[todo])
+
+            #fixme: cut off accidental negative values
+            np.maximum(field, 0, out = field)
+            return field[age_indices]
+
+        return p
+
+
     ##### plotting methods #####
 
     
@@ -969,14 +1338,14 @@ class SmoothModelRun:
     
 
     def plot_internal_fluxes(self, fig, fontsize = 10):
-        internal_flux_funcs = self.internal_flux_funcs()
-        n = len(internal_flux_funcs.keys())
+        internal_fluxes = self.internal_flux_matrix
+        n = len(self.model.internal_fluxes.keys())
         times = self.times
         #n=self.nr_pools
         i = 1
-        for key, value in internal_flux_funcs.items():
+        for key in self.model.internal_fluxes.keys():
             ax = fig.add_subplot(n,1,i)
-            ax.plot(times, [internal_flux_funcs[key](t) for t in times])
+            ax.plot(times, internal_fluxes[:, key[0], key[1]])
     
             ax.set_title('Flux from $' + latex(self.model.state_variables[key[0]]) + '$ to $'
                                        + latex(self.model.state_variables[key[1]]) + '$',
@@ -990,13 +1359,13 @@ class SmoothModelRun:
 
     def plot_external_output_fluxes(self, fig, fontsize = 10):
         times = self.times
-        output_flux_funcs = self.output_flux_funcs()
-        n = len(output_flux_funcs.keys())
+        output_fluxes = self.external_output_flux_vector
+        n = len(self.model.output_fluxes.keys())
         
         i = 1
-        for key, value in output_flux_funcs.items():
+        for key in self.model.output_fluxes.keys():
             ax = fig.add_subplot(n,1,i)
-            ax.plot(times, [output_flux_funcs[key](t) for t in times])
+            ax.plot(times, output_fluxes[:, key])
             ax.set_title('External outflux from $' + latex(self.model.state_variables[key]) + '$', fontsize=fontsize)
             ax.set_xlabel(self._add_time_unit('$' + latex(self.model.time_symbol) + '$'), fontsize=fontsize)
             ax.set_ylabel(self._add_flux_unit('flux'), fontsize=fontsize)
@@ -1007,12 +1376,12 @@ class SmoothModelRun:
     
     def plot_external_input_fluxes(self, fig, fontsize = 10):
         times = self.times
-        input_flux_funcs = self.external_input_flux_funcs()
-        n = len(input_flux_funcs.keys())
+        input_fluxes = self.external_input_flux_vector
+        n = len(self.model.input_fluxes.keys())
         i = 1
-        for key, value in input_flux_funcs.items():
+        for key in self.model.input_fluxes.keys():
             ax = fig.add_subplot(n,1,i)
-            ax.plot(times, [input_flux_funcs[key](t) for t in times])
+            ax.plot(times, input_fluxes[:, key])
             ax.set_title('External influx to $' + latex(self.model.state_variables[key]) + '$', fontsize=fontsize)
             ax.set_xlabel(self._add_time_unit('$' + latex(self.model.time_symbol) + '$'), fontsize=fontsize)
             ax.set_ylabel(self._add_flux_unit('flux'), fontsize=fontsize)
@@ -1406,14 +1775,21 @@ class SmoothModelRun:
         return a_star
 
 
-    def distribution_quantiles(self, quantile, F_sv, norm_consts = None, start_values = None,  method = 'brentq', tol = 1e-8):
+    # method = 'vectorized' solves for all times together, F_vec(ages, times)
+    # can then be given to evaluate F_sv for many (age, time) pairs at once,
+    # every tenth time is solved first and the quantiles at the other 
+    # times are searched next to the interpolated quantile trajectory
+    def distribution_quantiles(self, quantile, F_sv, norm_consts = None, start_values = None,  method = 'brentq', tol = 1e-8, F_vec = None):
         times = self.times
         
         if start_values is None:
-            start_values = np.zeros((times,))
+            start_values = np.zeros((len(times),))
 
         if norm_consts is None:
-            norm_consts = np.ones((times,))
+            norm_consts = np.ones((len(times),))
+
+        if method == 'vectorized':
+            return self._distribution_quantiles_vectorized(quantile, F_sv, norm_consts, start_values, tol, F_vec)
 
         def quantile_at_ti(ti):
             #print('ti', ti)
@@ -1442,6 +1818,36 @@ class SmoothModelRun:
         return np.array(q_lst)
 
 
+    def _distribution_quantiles_vectorized(self, quantile, F_sv, norm_consts, start_values, tol, F_vec = None):
+        times = self.times
+        m = len(times)
+        if F_vec is None:
+            F_vec = lambda ages, ts: np.array([F_sv(a, t) for a, t in zip(ages, ts)])
+
+        norm_consts = np.array(norm_consts, dtype = 'float64')
+        levels = quantile*norm_consts
+        levels[norm_consts == 0] = np.nan
+
+        def solve(tis, start):
+            CDF = lambda ages, indices: F_vec(ages, times[tis[indices]])
+            return generalized_inverse_CDF_vectorized(CDF, levels[tis], start, tol)
+
+        res = np.ones((m,))*np.nan
+        coarse = np.unique(np.concatenate((np.arange(0, m, 10), [m-1])))
+        res[coarse] = solve(coarse, np.array(start_values, dtype = 'float64')[coarse])
+
+        rest = np.setdiff1d(np.arange(m), coarse)
+        if len(rest) > 0:
+            known = coarse[~np.isnan(res[coarse])]
+            if len(known) > 0:
+                start = np.interp(times[rest], times[known], res[known])
+            else:
+                start = np.array(start_values, dtype = 'float64')[rest]
+            res[rest] = solve(rest, start)
+
+        return res
+
+
     ## by ode ##
 
 
@@ -1707,28 +2113,85 @@ class SmoothModelRun:
     ########## private methods #########
 
 
+    # the returned function also accepts an array of times,
+    # it evaluates the dense solution and does not integrate again
     def _solve_age_moment_system_single_value(self, max_order, start_age_moments = None, start_values = None):
         t0 = self.times[0]
         t_max = self.times[-1]
+        dense_sol = self._dense_age_moment_solution(max_order, start_age_moments, start_values)
 
         def func(t):
-            if t < t0:
-                # times x pools 
-                res = np.zeros((1, self.nr_pools))
-                res[res==0] = np.nan
-                return res
-            
-            #fixme: do we really want to cut off here? 
-            if t > t_max: t = t_max
-
-            new_times = [t0, t]
-            soln = self._solve_age_moment_system(max_order, start_age_moments, times = new_times, start_values = start_values)
+            if np.ndim(t) == 0:
+                if t < t0:
+                    # times x pools 
+                    res = np.zeros((1, self.nr_pools))
+                    res[res==0] = np.nan
+                    return res
+                
+                #fixme: do we really want to cut off here? 
+                return dense_sol(min(t, t_max))
 
-            return soln[-1]
+            t = np.array(t, dtype = 'float64')
+            res = dense_sol(np.clip(t, t0, t_max))
+            res[t < t0] = np.nan
+            return res
 
         return func 
 
 
+    # The solution of the age moment system as continuous function of time
+    # on [times[0], times[-1]], from one integration with dense output
+    # or in closed form. The functions for the start values of the run
+    # are cached.
+    def _dense_age_moment_solution(self, max_order, start_age_moments = None, start_values = None):
+        n = self.nr_pools
+        if start_age_moments is None:
+            start_age_moments = np.zeros((max_order, n))
+        start_age_moments_list = flatten([a.tolist() for a in 
+                            [start_age_moments[i,:] for i in range(start_age_moments.shape[0])]])
+        storage_key = tuple(start_age_moments_list) + ((max_order,),)
+
+        store = start_values is None
+        if store:
+            dense_sol = self.result_cache.get(('dense_solution', storage_key))
+            if dense_sol is not None:
+                return dense_sol
+            start_values = self.start_values
+
+        t0 = self.times[0]
+        t_max = self.times[-1]
+        if self._has_constant_inputs and self._invertible_constant_A:
+            def dense_sol(t):
+                ts = np.array(t, dtype = 'float64')
+                soln = self._solve_age_moment_system_closed_form(max_order, start_age_moments, np.concatenate(([t0], ts.reshape((-1,)))), start_values)
+                return soln[1:].reshape(ts.shape + (soln.shape[1],))
+        else:
+            srm = self.model
+            state_vector, rhs = srm.age_moment_system(max_order)
+       
+            new_start_values = np.zeros((n*(max_order+1),))
+            new_start_values[:n] = np.array((start_values)).reshape((n,)) 
+            new_start_values[n:] = np.array((start_age_moments_list))
+
+            dense_sol = numsol_symbolic_system(
+                state_vector,
+                srm.time_symbol,
+                rhs,
+                self.parameter_set,
+                self.func_set,
+                new_start_values, 
+                self.times,
+                self.integrator,
+                self.use_jacobian,
+                dense_output = True
+            )
+
+        if store:
+            self.result_cache.put(('dense_solution', storage_key), dense_sol)
+
+        return dense_sol
+
+
     def _solve_age_moment_system(self, max_order, start_age_moments = None, times = None, start_values = None, store = True):
         store = True
         if not ((times is None) and (start_values is None)): store = False
@@ -1753,31 +2216,32 @@ class SmoothModelRun:
 
         # return cached result if possible
         if store:
-            if hasattr(self, "_previously_computed_age_moment_sol"):
-                if storage_key in self._previously_computed_age_moment_sol.keys():
-                    #print('using cached age moment system:', storage_key)
-                    #print(self._previously_computed_age_moment_sol[storage_key])
-                    return self._previously_computed_age_moment_sol[storage_key]
-            else:
-                self._previously_computed_age_moment_sol = {}
+            cached_soln = self.result_cache.get(('age_moment_sol', storage_key))
+            if cached_soln is not None:
+                return cached_soln
 
-        srm = self.model
-        state_vector, rhs = srm.age_moment_system(max_order)
+        if self._has_constant_inputs and self._invertible_constant_A:
+            soln = self._solve_age_moment_system_closed_form(max_order, start_age_moments, times, start_values)
+        else:
+            srm = self.model
+            state_vector, rhs = srm.age_moment_system(max_order)
        
-        # compute solution
-        new_start_values = np.zeros((n*(max_order+1),))
-        new_start_values[:n] = np.array((start_values)).reshape((n,)) 
-        new_start_values[n:] = np.array((start_age_moments_list))
-
-        soln = numsol_symbolic_system(
-            state_vector,
-            srm.time_symbol,
-            rhs,
-            self.parameter_set,
-            self.func_set,
-            new_start_values, 
-            times
-        )
+            # compute solution
+            new_start_values = np.zeros((n*(max_order+1),))
+            new_start_values[:n] = np.array((start_values)).reshape((n,)) 
+            new_start_values[n:] = np.array((start_age_moments_list))
+
+            soln = numsol_symbolic_system(
+                state_vector,
+                srm.time_symbol,
+                rhs,
+                self.parameter_set,
+                self.func_set,
+                new_start_values, 
+                times,
+                self.integrator,
+                self.use_jacobian
+            )
         
         # save all solutions for order <= max_order
         if store:
@@ -1788,16 +2252,106 @@ class SmoothModelRun:
                 storage_key = tuple(shorter_start_age_moments_list) + ((order,),)
                 #print('saving', storage_key)
 
-                self._previously_computed_age_moment_sol[storage_key] = soln[:,:(order+1)*n]
-                #print(self._previously_computed_age_moment_sol[storage_key])
+                self.result_cache.put(('age_moment_sol', storage_key), soln[:,:(order+1)*n])
+
+        return soln
+
+
+    # for dx/dt = Ax + u with constant A and u the age moments are known
+    # explicitly, with tau = t-t0 the k-th moment vector M_k = x*m_k is
+    # M_k(t) = Phi(tau) sum_j binomial(k,j) tau^(k-j) M_j(t0) + I_k(tau) u,
+    # where I_k(tau) = int_0^tau a^k exp(A a) da 
+    #                = A^-1 (tau^k exp(A tau) - [k==0] Id) - k A^-1 I_(k-1)(tau)
+    def _solve_age_moment_system_closed_form(self, max_order, start_age_moments, times, start_values):
+        n = self.nr_pools
+        A = self._constant_A
+        A_inv = np.linalg.inv(A)
+        u = self._constant_u
+        x0 = np.array(start_values, dtype = 'float64').reshape((n,))
+
+        taus = np.array(times, dtype = 'float64') - times[0]
+        Phis = self._expm_batch(taus)
+
+        # moment vectors of the start age distribution
+        M0 = [x0] + [x0*np.array(start_age_moments[j-1,:], dtype = 'float64') for j in range(1, max_order+1)]
+
+        soln = np.zeros((len(taus), n*(max_order+1)))
+        I = np.einsum('ij,tjk->tik', A_inv, Phis - np.identity(n))
+        x = np.einsum('tij,j->ti', Phis, x0) + np.dot(I, u)
+        soln[:,:n] = x
+        
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            for k in range(1, max_order+1):
+                I = np.einsum('ij,tjk->tik', A_inv, (taus**k)[:,np.newaxis,np.newaxis]*Phis - k*I)
+                shifted = sum([float(binomial(k,j))*(taus**(k-j))[:,np.newaxis]*M0[j] for j in range(k+1)])
+                M_k = np.einsum('tij,tj->ti', Phis, shifted) + np.dot(I, u)
+                soln[:,k*n:(k+1)*n] = M_k/x
 
         return soln
 
 
-    #fixme: test
     @property
-    def _no_input_sol(self):
-        if not hasattr(self, '_saved_no_input_sol'):
+    def _is_linear_autonomous(self):
+        # the compartmental matrix is constant after the parameters are
+        # substituted, it depends neither on the state nor on time
+        if not hasattr(self, '_saved_is_linear_autonomous'):
+            cm_par = self.model.compartmental_matrix.subs(self.parameter_set)
+            self._saved_is_linear_autonomous = (len(cm_par.free_symbols) == 0) and (len(cm_par.atoms(AppliedUndef)) == 0)
+            if self._saved_is_linear_autonomous:
+                self._constant_A = np.array(cm_par, dtype = 'float64')
+
+        return self._saved_is_linear_autonomous
+
+
+    @property
+    def _has_constant_inputs(self):
+        if not self._is_linear_autonomous:
+            return False
+
+        if not hasattr(self, '_constant_u'):
+            u_par = self.model.external_inputs.subs(self.parameter_set)
+            if (len(u_par.free_symbols) == 0) and (len(u_par.atoms(AppliedUndef)) == 0):
+                self._constant_u = np.array(u_par, dtype = 'float64').reshape((self.nr_pools,))
+            else:
+                self._constant_u = None
+
+        return self._constant_u is not None
+
+    
+    @property
+    def _invertible_constant_A(self):
+        return self._is_linear_autonomous and (np.linalg.cond(self._constant_A) < 1e12)
+
+
+    # returns an array of shape (len(taus), n, n) with exp(A tau),
+    # only valid for linear autonomous models
+    def _expm_batch(self, taus):
+        A = self._constant_A
+        taus = np.array(taus, dtype = 'float64').reshape((-1,))
+
+        if not hasattr(self, '_A_eig'):
+            evals, V = np.linalg.eig(A)
+            if np.linalg.cond(V) < 1e8:
+                self._A_eig = (evals, V, np.linalg.inv(V))
+            else:
+                # A is (close to) defective, no stable eigendecomposition
+                self._A_eig = None
+            
+        u_taus, inverse = np.unique(taus, return_inverse = True)
+        if self._A_eig is None:
+            res = np.array([expm(A*tau) for tau in u_taus])
+        else:
+            evals, V, V_inv = self._A_eig
+            E = np.exp(np.outer(u_taus, evals))
+            res = np.einsum('ij,tj,jk->tik', V, E, V_inv)
+            if np.iscomplexobj(res): res = res.real
+
+        return res[inverse]
+
+
+    @property
+    def _no_input_num_rhs(self):
+        def build():
             m = self.model
             m_no_inputs = SmoothReservoirModel(
                     m.state_vector,
@@ -1806,13 +2360,22 @@ class SmoothModelRun:
                     m.output_fluxes,
                     m.internal_fluxes)
             
-            no_inputs_num_rhs = numerical_rhs(
+            return numerical_rhs(
                 m_no_inputs.state_vector, 
                 m_no_inputs.time_symbol, 
                 m_no_inputs.F, 
                 self.parameter_set,
                 self.func_set,
                 self.times)
+
+        return self.result_cache.cached('no_input_num_rhs', build)
+
+
+    #fixme: test
+    @property
+    def _no_input_sol(self):
+        def build():
+            no_inputs_num_rhs = self._no_input_num_rhs
     
             def no_input_sol(times, start_vector):
                 #print('nos', times, start_vector)
@@ -1821,70 +2384,236 @@ class SmoothModelRun:
                 sv = np.array(start_vector).reshape((self.nr_pools,))
                 return odeint(no_inputs_num_rhs, sv, times, mxstep = 10000)[-1]
         
-            self._saved_no_input_sol = no_input_sol
-
-        return self._saved_no_input_sol
-
-
-    #fixme: test
-    def build_state_transition_operator_cache(self, size = 101):
+            return no_input_sol
+
+        return self.result_cache.cached('no_input_sol', build)
+
+
+    # Phi(t_j, t_i) for all pairs of nc = size equidistant cache times
+    # t_i <= t_j are stored in an array of shape (nc, nc, n, n),
+    # ca[i, j] = Phi(s_j, t_i) with s_j = linspace(t_i, t_max, nc)[j].
+    # The rows i are independent and distributed to forked processes.
+    # With filename the values are written directly into a memory mapped
+    # file in the format of save_state_transition_operator_cache, so the
+    # cache never needs to fit into memory.
+    # dtype = 'float32' halves the size of the cache.
+    # With state_transition_operator_cache_mode = 'interpolate' the cache
+    # answers Phi(t, t0) without any integration, otherwise the no input
+    # system is integrated from t0 to the next cached time and from the
+    # last cached time to t.
+    def build_state_transition_operator_cache(self, size = 101, processes = 1, dtype = 'float64', filename = None):
         if size < 2:
             raise(Exception('Cache size must be at least 2'))
 
         times = self.times
         n = self.nr_pools
-        t_min = times[0]
-        t_max = times[-1]
         nc = size
-        cached_times = np.linspace(t_min, t_max, nc)
+        cached_times = np.linspace(times[0], times[-1], nc)
 
-        # build cache
-        print("creating cache")
-        ca = np.ndarray((nc, nc, n, n))
-        ca = np.zeros((nc, nc, n, n)) 
-        no_input_sol = self._no_input_sol
+        if filename is None:
+            ca = np.zeros((nc, nc, n, n), dtype = dtype)
+        else:
+            path = Path(filename)
+            path.mkdir(parents = True, exist_ok = True)
+            ca = np.lib.format.open_memmap(str(path.joinpath('values.npy')), mode = 'w+', dtype = dtype, shape = (nc, nc, n, n))
+
+        def build_row(tm1_index):
+            row = self._state_transition_operator_cache_row(cached_times[tm1_index], cached_times[-1], nc)
+            if filename is None:
+                return row
+            # the workers write into the shared file themselves
+            ca[tm1_index] = row
+            ca.flush()
+            return None
+
+        # the last row stays zero, there is nothing after t_max
+        rows = fork_map(build_row, range(nc-1), processes)
+        if filename is None:
+            for tm1_index, row in enumerate(rows):
+                ca[tm1_index] = row
+            self._set_state_transition_operator_cache(ca, size)
+        else:
+            ca.flush()
+            del ca
+            self._write_state_transition_operator_cache_metadata(path, size, dtype)
+            self.load_state_transition_operator_cache(filename)
 
-        for tm1_index in tqdm(range(nc-1)):
-            tm1 = cached_times[tm1_index]
-            sub_cached_times = np.linspace(tm1, t_max, nc)
-
-            for i in range(n):
-                e_i = np.zeros((n,1))
-                e_i[i] = 1
-                #ca[tm1_index,:,:,i] = no_input_sol(sub_cached_times, e_i) # leads to zig-zag functions, 
-                # the ends do not fit together
-                sv = e_i
-                st = tm1
-                for j in range(len(sub_cached_times)):
-                    new_sv = no_input_sol([st, sub_cached_times[j]], sv)
-                    ca[tm1_index,j,:,i] = new_sv.reshape((n,))
-                    sv = new_sv
-                    st = sub_cached_times[j]
-
-        print("cache created")
-
-        self._state_transition_operator_values = ca
-        self._cache_size = size
 
+    # Phi(s_j, tm1) for nc equidistant s_j from tm1 to t_max as (nc, n, n) array,
+    # the no input system is integrated step by step, since one integration
+    # over all s_j leads to zig-zag functions, the ends do not fit together
+    def _state_transition_operator_cache_row(self, tm1, t_max, nc):
+        n = self.nr_pools
+        row = np.zeros((nc, n, n))
+        sub_cached_times = np.linspace(tm1, t_max, nc)
+
+        # row i of X is the solution started in the i-th unit vector
+        X = np.identity(n)
+        st = tm1
+        for j, s in enumerate(sub_cached_times):
+            X = self._no_input_sol_batch(st, np.repeat(s, n), X)
+            row[j] = X.transpose()
+            st = s
+
+        return row
+
+
+    # The cache is saved to the directory filename as raw values.npy and
+    # metadata.json, so that it can be loaded lazily as memory map.
+    # A cache in memory can be converted to float32 by dtype.
+    def save_state_transition_operator_cache(self, filename, dtype = None):
+        if self._state_transition_operator_values is None:
+            raise(Exception('There is no state transition operator cache, build it first.'))
+
+        values = self._state_transition_operator_values
+        if dtype is None:
+            dtype = values.dtype
+
+        path = Path(filename)
+        path.mkdir(parents = True, exist_ok = True)
+        tmp_path = path.joinpath('values.%d.tmp.npy' % os.getpid())
+        np.save(str(tmp_path), np.asarray(values, dtype = dtype))
+        os.replace(str(tmp_path), str(path.joinpath('values.npy')))
+        self._write_state_transition_operator_cache_metadata(path, self._cache_size, dtype)
 
-    def save_state_transition_operator_cache(self, filename):
-        cache = {'values': self._state_transition_operator_values,
-                 'size': self._cache_size,
-                 'times': self.times}
-        
-        with open(filename, 'wb') as output:
-            pickle.dump(cache, output)
 
+    def _write_state_transition_operator_cache_metadata(self, path, size, dtype):
+        metadata = {'format_version': state_transition_operator_cache_format_version,
+                    'size': size,
+                    'nr_pools': self.nr_pools,
+                    'dtype': np.dtype(dtype).name,
+                    'times': [float(t) for t in self.times]}
 
+        tmp_path = path.joinpath('metadata.%d.tmp.json' % os.getpid())
+        with tmp_path.open('w') as f:
+            json.dump(metadata, f, indent = 1)
+        os.replace(str(tmp_path), str(path.joinpath('metadata.json')))
+
+
+    # The values are memory mapped read only and not copied into memory,
+    # several processes loading the same cache share the pages.
+    # Pickled caches of older versions can still be loaded.
     def load_state_transition_operator_cache(self, filename):
-        with open(filename, 'rb') as output:
-            cache = pickle.load(output)
-    
-        if not np.all(self.times == cache['times']):
+        path = Path(filename)
+        if path.is_file():
+            with path.open('rb') as output:
+                cache = pickle.load(output)
+
+            if not np.all(self.times == cache['times']):
+                raise(Exception('The cached state transition operator does not correspond to the current setting.'))
+
+            self._set_state_transition_operator_cache(cache['values'], cache['size'])
+            return
+
+        metadata_path = path.joinpath('metadata.json')
+        if not metadata_path.exists():
+            raise(Exception('There is no state transition operator cache in ' + str(path)))
+
+        with metadata_path.open() as f:
+            metadata = json.load(f)
+
+        if metadata.get('format_version') != state_transition_operator_cache_format_version:
+            raise(Exception('The state transition operator cache in ' + str(path) + ' has an unknown format version.'))
+
+        if (metadata['nr_pools'] != self.nr_pools) or (len(metadata['times']) != len(self.times)) or (not np.all(self.times == np.array(metadata['times']))):
             raise(Exception('The cached state transition operator does not correspond to the current setting.'))
 
-        self._state_transition_operator_values = cache['values']
-        self._cache_size = cache['size']
+        values = np.load(str(path.joinpath('values.npy')), mmap_mode = 'r')
+        nc = metadata['size']
+        if values.shape != (nc, nc, self.nr_pools, self.nr_pools):
+            raise(Exception('The state transition operator cache in ' + str(path) + ' is incomplete.'))
+
+        self._set_state_transition_operator_cache(values, nc)
+
+
+    def _set_state_transition_operator_cache(self, values, size):
+        self._state_transition_operator_values = values
+        self._cache_size = size
+        # the start times of the rows, computed once and not on every evaluation
+        self._cached_times = np.linspace(self.times[0], self.times[-1], size)
+        self.state_transition_operator_cache_error = 0.0
+
+
+    # Phi(t, t0) answered from the cache alone, without solving any ODE.
+    # t and t0 are arrays of the same length m (or t0 a scalar).
+    # With t_i the largest cached start time not after t0, row i of the
+    # cache holds Phi(s, t_i) on an equidistant grid in s covering t and t0,
+    # the semigroup property gives
+    #   Phi(t, t0) = Phi(t, t_i) Phi(t0, t_i)^(-1),
+    # exact for linear models, an approximation for nonlinear ones like
+    # the cache itself.
+    # Phi(., t_i) is interpolated quadratically between the neighbouring
+    # cached matrices, the difference to the linear interpolation estimates
+    # the interpolation error.
+    # Returns the matrices as (m, n, n) array and for each of them an
+    # estimate of the error in the maximum row sum norm.
+    def _state_transition_operator_cached(self, t, t0):
+        if self._state_transition_operator_values is None:
+            raise(Exception('There is no state transition operator cache, build or load it first.'))
+
+        n = self.nr_pools
+        t = np.array(t, dtype = 'float64').reshape((-1,))
+        t0 = np.broadcast_to(np.array(t0, dtype = 'float64').reshape((-1,)), t.shape)
+        if np.any(t0 > t):
+            raise(Exception("Evaluation before t0 is not possible"))
+
+        ct = self._cached_times
+        nc = self._cache_size
+        t_min, t_max = ct[0], ct[-1]
+        eps = 1e-12*max(1.0, abs(t_max))
+        if np.any(t0 < t_min-eps) or np.any(t > t_max+eps):
+            raise(Exception('The state transition operator cache covers only [' + str(t_min) + ', ' + str(t_max) + '].'))
+
+        ca = self._state_transition_operator_values
+        rows = np.clip(np.searchsorted(ct, t0, side = 'right')-1, 0, nc-2)
+        t_i = ct[rows]
+        h = (t_max-t_i)/(nc-1)
+
+        def interpolate(s):
+            # Phi(s, t_i) for all rows
+            p = np.clip((s-t_i)/h, 0, nc-1)
+            j = np.minimum(np.floor(p).astype('int'), nc-2)
+            w = (p-j)[:, None, None]
+            M_j = np.array(ca[rows, j], dtype = 'float64')
+            M_j1 = np.array(ca[rows, j+1], dtype = 'float64')
+            lin = (1-w)*M_j + w*M_j1
+            if nc < 3:
+                return lin, np.inf*np.ones(len(s))
+
+            # a third node, after the interval if possible
+            k = np.where(j+2 <= nc-1, j+2, j-1)
+            M_k = np.array(ca[rows, k], dtype = 'float64')
+            x = p[:, None, None]
+            x0, x1, x2 = [a[:, None, None] for a in (j, j+1, k)]
+            quad = M_j*(x-x1)*(x-x2)/((x0-x1)*(x0-x2)) \
+                + M_j1*(x-x0)*(x-x2)/((x1-x0)*(x1-x2)) \
+                + M_k*(x-x0)*(x-x1)/((x2-x0)*(x2-x1))
+
+            err = np.abs(quad-lin).sum(axis = 2).max(axis = 1)
+            return quad, err
+
+        norm = lambda M: np.abs(M).sum(axis = 2).max(axis = 1)
+
+        A, err_A = interpolate(t)
+        B, err_B = interpolate(t0)
+        B_inv = np.linalg.inv(B)
+        Phis = np.matmul(A, B_inv)
+        # first order perturbation of A B^(-1)
+        errs = (err_A+norm(Phis)*err_B)*norm(B_inv)
+
+        same = (t == t0)
+        Phis[same] = np.identity(n)
+        errs[same] = 0
+
+        if len(errs) > 0:
+            self.state_transition_operator_cache_error = max(self.state_transition_operator_cache_error, errs.max())
+
+        return Phis, errs
+
+
+    @property
+    def _interpolate_from_cache(self):
+        return (self._state_transition_operator_values is not None) and (self.state_transition_operator_cache_mode == 'interpolate')
 
 
     def _state_transition_operator(self, t, t0, x):
@@ -1894,6 +2623,12 @@ class SmoothModelRun:
             return x
        
         n = self.nr_pools
+        if self._is_linear_autonomous:
+            return self._expm_batch([t-t0])[0].dot(np.array(x).reshape((n,)))
+
+        if self._interpolate_from_cache:
+            return self._state_transition_operator_cached([t], [t0])[0][0].dot(np.array(x, dtype = 'float64').reshape((n,)))
+
         no_input_sol = self._no_input_sol
 
         if self._state_transition_operator_values is None:
@@ -1902,12 +2637,10 @@ class SmoothModelRun:
             soln = (no_input_sol([t0, t], x)).reshape((n,))        
         else:
             # use the already created cache
-            times = self.times
-            t_min = times[0]
-            t_max = times[-1]
+            t_max = self.times[-1]
             nc = self._cache_size
     
-            cached_times = np.linspace(t_min, t_max, nc)
+            cached_times = self._cached_times
             ca = self._state_transition_operator_values
     
             # find tm1
@@ -1922,7 +2655,7 @@ class SmoothModelRun:
     
             step_size = (t_max-tm1)/(nc-1)
             if step_size > 0:
-                tm2_ind = np.int(np.min([np.floor((t-tm1)/step_size), nc-1]))
+                tm2_ind = int(np.min([np.floor((t-tm1)/step_size), nc-1]))
                 tm2 = tm1 + tm2_ind*step_size
     
                 #print(t, t0, t==t0, tm1_ind, tm1, tm2_ind, tm2, step_size) 
@@ -1939,27 +2672,259 @@ class SmoothModelRun:
             soln = (no_input_sol([tm2, t],z)).reshape((n,))
     
         return soln
+
+
+    @property
+    def _is_linear(self):
+        if not hasattr(self, '_saved_is_linear'):
+            self._saved_is_linear = self.model.is_linear
+
+        return self._saved_is_linear
+
+
+    # returns an array of shape (len(ts), n, n) with Phi(t, t0) for t in ts,
+    # only valid for linear models, here Phi(t, t0) is the fundamental matrix
+    # of the no-input system that we obtain by integrating dPhi/dt = A(t)Phi
+    # once for all ts
+    def _state_transition_operator_matrices(self, t0, ts):
+        n = self.nr_pools
+        ts = np.array(ts, dtype = 'float64')
+        if np.any(ts < t0):
+            raise(Exception("Evaluation before t0 is not possible"))
+
+        if self._is_linear_autonomous:
+            return self._expm_batch(ts-t0)
+
+        if self._interpolate_from_cache:
+            return self._state_transition_operator_cached(ts, t0)[0]
+
+        u_ts, inverse = np.unique(ts, return_inverse = True)
+        res = np.zeros((len(u_ts), n, n))
+        res[:] = np.identity(n)
+
+        # Phi(t0, t0) = I, integrate only to later times
+        later = u_ts > t0
+        if later.any():
+            def rhs(Y, t):
+                Phi = Y.reshape((n, n))
+                return np.dot(self.A(t), Phi).reshape((n*n,))
+            
+            int_times = np.concatenate(([t0], u_ts[later]))
+            sol = odeint(rhs, np.identity(n).reshape((n*n,)), int_times, mxstep = 10000)
+            res[later] = sol[1:].reshape((-1, n, n))
+
+        return res[inverse]
+
+
+    # returns an array of shape (len(t0s), n, n) with Phi(t, s) for s in t0s,
+    # only valid for linear models, as a function of its second argument
+    # Phi(t, s) solves dPhi/ds = -Phi A(s), so we integrate backwards from t
+    def _state_transition_operator_matrices_backward(self, t, t0s):
+        n = self.nr_pools
+        t0s = np.array(t0s, dtype = 'float64')
+        if np.any(t0s > t):
+            raise(Exception("Evaluation before t0 is not possible"))
+
+        if self._is_linear_autonomous:
+            return self._expm_batch(t-t0s)
+
+        if self._interpolate_from_cache:
+            return self._state_transition_operator_cached(np.repeat(t, len(t0s)), t0s)[0]
+
+        u_t0s, inverse = np.unique(t0s, return_inverse = True)
+        res = np.zeros((len(u_t0s), n, n))
+        res[:] = np.identity(n)
+
+        earlier = u_t0s < t
+        if earlier.any():
+            def rhs(Y, s):
+                Phi = Y.reshape((n, n))
+                return -np.dot(Phi, self.A(s)).reshape((n*n,))
+            
+            int_times = np.concatenate(([t], u_t0s[earlier][::-1]))
+            sol = odeint(rhs, np.identity(n).reshape((n*n,)), int_times, mxstep = 10000)
+            res[earlier] = sol[1:][::-1].reshape((-1, n, n))
+
+        return res[inverse]
+
+
+    # the right hand side of the no-input system compiled once,
+    # F(*state_vector, t) returns a tuple with one entry per pool,
+    # None for piecewise defined models
+    @property
+    def _no_input_rhs_func(self):
+        def build():
+            m = self.model
+            m_no_inputs = SmoothReservoirModel(
+                    m.state_vector,
+                    m.time_symbol,
+                    {},
+                    m.output_fluxes,
+                    m.internal_fluxes)
+
+            F = m_no_inputs.F
+            if has_pw(F):
+                return None
+
+            tup = tuple(m.state_vector) + (m.time_symbol,)
+            cut_func_set = {key[:key.index('(')]: val for key, val in self.func_set.items()}
+            exprs = Tuple(*[sympify(expr, locals = _clash) for expr in F])
+            return cached_lambdify(tup, exprs, self.parameter_set, cut_func_set)
+
+        return self.result_cache.cached('no_input_rhs_func', build)
+
+
+    # integrates the no-input system for many start vectors X (m x n)
+    # starting at t0 as one stacked system, row i is evaluated at ts[i],
+    # the right hand side is evaluated for all rows at once, only
+    # functions in func_set that cannot handle arrays and piecewise
+    # defined models are evaluated row by row
+    def _no_input_sol_batch(self, t0, ts, X):
+        n = self.nr_pools
+        ts = np.array(ts, dtype = 'float64')
+        X = np.array(X, dtype = 'float64').reshape((-1, n))
+        k = X.shape[0]
+
+        u_ts, inverse = np.unique(ts, return_inverse = True)
+        res = np.zeros((len(u_ts), k, n))
+        res[:] = X
+
+        later = u_ts > t0
+        if later.any():
+            def vectorized_rhs(Y, t):
+                Y = Y.reshape((k, n))
+                vals = F(*([Y[:,i] for i in range(n)] + [t]))
+                # constant components come back as scalars
+                return np.stack([np.broadcast_to(np.array(val, dtype = 'float64'), (k,)) for val in vals], axis = 1).reshape((-1,))
+
+            def member_rhs(Y, t):
+                Y = Y.reshape((k, n))
+                return np.concatenate([np.array(num_rhs(Y[i], t), dtype = 'float64').reshape((n,)) for i in range(k)])
+
+            rhs = member_rhs
+            num_rhs = self._no_input_num_rhs
+            F = self._no_input_rhs_func
+            if F is not None:
+                try:
+                    vectorized_rhs(X.reshape((-1,)), t0)
+                    rhs = vectorized_rhs
+                except (TypeError, ValueError):
+                    pass
+
+            # the stacked system is integrated with the step sizes of its
+            # stiffest member, with the vectorized right hand side one
+            # odeint call is still much faster than k separate ones
+            int_times = np.concatenate(([t0], u_ts[later]))
+            sol = odeint(rhs, X.reshape((k*n,)), int_times, mxstep = 10000)
+            res[later] = sol[1:].reshape((-1, k, n))
+
+        return res[inverse, np.arange(k), :]
+  
+
+    # vectorized version of _state_transition_operator,
+    # t and t0 are arrays of length m, X is an (m x n) array,
+    # returns an (m x n) array with Phi(t[i], t0[i])X[i]
+    def _state_transition_operator_batch(self, t, t0, X):
+        n = self.nr_pools
+        t = np.array(t, dtype = 'float64').reshape((-1,))
+        t0 = np.array(t0, dtype = 'float64').reshape((-1,))
+        X = np.array(X, dtype = 'float64').reshape((-1, n))
+        t0 = np.broadcast_to(t0, t.shape)
+
+        if np.any(t0 > t):
+            raise(Exception("Evaluation before t0 is not possible"))
+
+        res = X.copy()
+
+        if self._is_linear_autonomous:
+            # Phi(t, t0) = exp(A(t-t0)) depends only on the time difference
+            todo = (t > t0)
+            if todo.any():
+                Phis = self._expm_batch(t[todo]-t0[todo])
+                res[todo] = np.einsum('ijk,ik->ij', Phis, X[todo])
+            return res
+
+        if self._interpolate_from_cache:
+            todo = (t > t0)
+            if todo.any():
+                Phis = self._state_transition_operator_cached(t[todo], t0[todo])[0]
+                res[todo] = np.einsum('ijk,ik->ij', Phis, X[todo])
+            return res
+
+        if self._state_transition_operator_values is not None:
+            # the cache is organized by single start times,
+            # keep the values consistent with the scalar method
+            for i in range(len(t)):
+                res[i] = self._state_transition_operator(t[i], t0[i], X[i]).reshape((n,))
+            return res
+
+        # nothing to do for t == t0, and no mass stays no mass
+        todo = (t > t0) & np.any(X != 0, axis = 1)
+        if not todo.any():
+            return res
+
+        u_t0 = np.unique(t0[todo])
+        u_t = np.unique(t[todo])
+        if self._is_linear and (len(u_t) < len(u_t0)):
+            # fewer end times than start times, integrate backwards
+            for s in u_t:
+                idx = np.where(todo & (t == s))[0]
+                Phis = self._state_transition_operator_matrices_backward(s, t0[idx])
+                res[idx] = np.einsum('ijk,ik->ij', Phis, X[idx])
+        else:
+            for s in u_t0:
+                idx = np.where(todo & (t0 == s))[0]
+                if self._is_linear:
+                    Phis = self._state_transition_operator_matrices(s, t[idx])
+                    res[idx] = np.einsum('ijk,ik->ij', Phis, X[idx])
+                else:
+                    res[idx] = self._no_input_sol_batch(s, t[idx], X[idx])
+
+        return res
         
 
     def _flux_vector(self, flux_vec_symbolic):
+        flux_vec_symbolic = sympify(flux_vec_symbolic, locals = _clash)
+        return self._flux_array(list(flux_vec_symbolic))
+
+
+    # {pool: flux} as (len(times), n) array, zero for pools without flux
+    def _flux_dict_array(self, expr_dict):
+        res = np.zeros((len(self.times), self.nr_pools))
+        keys = list(expr_dict.keys())
+        if keys:
+            res[:, keys] = self._flux_array([expr_dict[key] for key in keys])
+
+        return res
+
+
+    # evaluates the flux expressions exprs along the solution
+    # and returns an array of shape (len(times), len(exprs)),
+    # the lambdified expressions are applied to the whole solution at once,
+    # only functions in func_set that cannot handle arrays
+    # are evaluated time step by time step
+    def _flux_array(self, exprs):
         sol = self.solve()
         srm = self.model
-        n = self.nr_pools
-        times = self.times
+        times = np.array(self.times, dtype = 'float64')
         
         tup = tuple(srm.state_vector) + (srm.time_symbol,)
-        res = np.zeros((len(times), n))
-        
-        flux_vec_symbolic = sympify(flux_vec_symbolic, locals = _clash)
-        flux_vec_symbolic = flux_vec_symbolic.subs(self.parameter_set)
+        exprs = Tuple(*[sympify(expr, locals = _clash) for expr in exprs])
         cut_func_set = {key[:key.index('(')]: val for key, val in self.func_set.items()}
-        flux_vec_fun = lambdify(tup, flux_vec_symbolic, modules=[cut_func_set, 'numpy'])
-
-        res = np.zeros((len(times), n))
+        flux_fun = cached_lambdify(tup, exprs, self.parameter_set, cut_func_set)
+
+        args = [sol[:, pool] for pool in range(self.nr_pools)] + [times]
+        try:
+            with np.errstate(all = 'ignore'):
+                vals = flux_fun(*args)
+            # constant fluxes come back as scalars
+            return np.stack([np.broadcast_to(np.array(val, dtype = 'float64'), times.shape) for val in vals], axis = 1)
+        except (TypeError, ValueError):
+            pass
+
+        res = np.zeros((len(times), len(exprs)))
         for ti in range(len(times)):
-            args = [sol[ti, pool] for pool in range(n)] + [times[ti]]
-            val = flux_vec_fun(*args)
-            res[ti,:] = val.reshape((n,))
+            res[ti,:] = np.array(flux_fun(*[arg[ti] for arg in args]), dtype = 'float64').reshape((len(exprs),))
 
         return res
 
@@ -1999,9 +2964,30 @@ class SmoothModelRun:
     def _age_densities_1(self, start_age_densities = None):
         # for part that comes from initial value
 
-        ppp = self._age_densities_1_single_value(start_age_densities)
-        pp = lambda a: np.array([ppp(a,t) for t in self.times], np.float)
-        p1 = lambda ages: np.array([pp(a) for a in ages], np.float)
+        if start_age_densities is None:
+            # all mass is assumed to have age 0 at the beginning
+            def start_age_densities(a):
+                if a != 0: return np.array((0,)*self.nr_pools)
+                return np.array(self.start_values)
+
+        # cut off negative ages in start_age_densities
+        p0 = lambda a: start_age_densities(a) if a>=0 else np.zeros((self.nr_pools,))
+
+        times = self.times
+        t0 = times[0]
+        n = self.nr_pools
+
+        def p1(ages):
+            ages = np.array(ages, dtype = 'float64').reshape((-1,))
+            A, T = np.meshgrid(ages, times, indexing = 'ij')
+            A, T = A.reshape((-1,)), T.reshape((-1,))
+            X = np.array([np.array(p0(a-(t-t0)), dtype = 'float64').reshape((n,)) for a, t in zip(A, T)])
+
+            # all evaluations share the same start time t0
+            vals = self._state_transition_operator_batch(T, t0, X)
+
+            #fixme: cut off accidental negative values
+            return np.maximum(vals, 0).reshape((len(ages), len(times), n))
         
         return p1
 
@@ -2034,9 +3020,28 @@ class SmoothModelRun:
     # and gives back a three-dimensional ndarray (ages x times x pools)
     def _age_densities_2(self):
         # for part that comes from the input function u
-        ppp = self._age_densities_2_single_value()
-        pp = lambda a: np.array([ppp(a,t) for t in self.times], np.float)
-        p2 = lambda ages: np.array([pp(a) for a in ages], np.float)
+        times = self.times
+        t0 = times[0]
+        n = self.nr_pools
+        u = self.external_input_vector_func()
+
+        def p2(ages):
+            ages = np.array(ages, dtype = 'float64').reshape((-1,))
+            A, T = np.meshgrid(ages, times, indexing = 'ij')
+            A, T = A.reshape((-1,)), T.reshape((-1,))
+            res = np.zeros((len(A), n))
+
+            # only mass that entered after t0 has a positive age
+            inside = (A >= 0) & (T-t0 > A)
+            if inside.any():
+                Ti, Ai = T[inside], A[inside]
+                U = np.array([np.array(u(s), dtype = 'float64').reshape((n,)) for s in Ti-Ai])
+                vals = self._state_transition_operator_batch(Ti, Ti-Ai, U)
+
+                #fixme: cut off accidental negative values
+                res[inside] = np.maximum(vals, 0)
+
+            return res.reshape((len(ages), len(times), n))
 
         return p2
 
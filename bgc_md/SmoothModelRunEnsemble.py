@@ -0,0 +1,303 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+import numpy as np
+from scipy.optimize import root
+from sympy import Tuple, sympify
+from sympy.abc import _clash
+
+from .lambdify_cache import cached_lambdify
+from .integrators import integrate
+from .helpers_reservoir import fork_map, jacobian_sparsity
+from .SmoothModelRun import SmoothModelRun
+
+
+class SmoothModelRunEnsemble:
+    """Many runs of one SmoothReservoirModel that differ in parameters and start values.
+
+    Row k of parameter_matrix holds the values of parameter_symbols for
+    member k, row k of start_values_matrix its start values. Parameters
+    shared by all members can be given in parameter_set, they are
+    substituted before the right hand side is lambdified.
+    The right hand side is lambdified only once, with the state variables,
+    the time symbol and parameter_symbols as arguments. The members are
+    integrated together as one stacked system in chunks of chunk_size
+    members, the chunks are distributed to processes forked workers.
+    Since the integrator controls the error of the stacked system, the
+    members are solved with the same time steps and the results agree
+    with separate runs only up to the integration tolerance.
+    model_run() returns single members as objects of run_class.
+    """
+
+    def __init__(self, smooth_reservoir_model, parameter_symbols, parameter_matrix, start_values_matrix, times, parameter_set = None, func_set = None, integrator = 'odeint', chunk_size = 64, processes = 1, run_class = SmoothModelRun):
+        if parameter_set is None: parameter_set = dict()
+        if func_set is None: func_set = dict()
+
+        self.model = smooth_reservoir_model
+        self.parameter_symbols = list(parameter_symbols)
+        self.parameter_set = parameter_set
+        self.func_set = func_set
+        self.times = np.array(times, dtype = 'float64')
+        self.integrator = integrator
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.run_class = run_class
+
+        parameter_matrix = np.array(parameter_matrix, dtype = 'float64')
+        if parameter_matrix.ndim == 1:
+            parameter_matrix = parameter_matrix.reshape((-1, len(self.parameter_symbols)))
+        start_values_matrix = np.array(start_values_matrix, dtype = 'float64')
+        if start_values_matrix.ndim == 1:
+            start_values_matrix = start_values_matrix.reshape((1, -1))
+
+        if parameter_matrix.shape[1] != len(self.parameter_symbols):
+            raise(Exception("parameter_matrix needs one column per parameter symbol."))
+        if start_values_matrix.shape[1] != self.nr_pools:
+            raise(Exception("start_values_matrix needs one column per pool."))
+        if parameter_matrix.shape[0] != start_values_matrix.shape[0]:
+            # a single row is used for all members
+            if parameter_matrix.shape[0] == 1:
+                parameter_matrix = np.repeat(parameter_matrix, start_values_matrix.shape[0], axis = 0)
+            elif start_values_matrix.shape[0] == 1:
+                start_values_matrix = np.repeat(start_values_matrix, parameter_matrix.shape[0], axis = 0)
+            else:
+                raise(Exception("parameter_matrix and start_values_matrix need the same number of rows."))
+
+        self.parameter_matrix = parameter_matrix
+        self.start_values_matrix = start_values_matrix
+        self._rhs = None
+        self._sol = None
+        self._age_moment_sols = dict()
+
+
+    @classmethod
+    def from_model_runs(cls, model_runs, **kwargs):
+        # an ensemble of SmoothModelRun objects of the same model over the
+        # same times, e.g. Model.model_runs, parameters with the same value
+        # in all runs are substituted once, the members are of the class
+        # of the given runs
+        if len(model_runs) == 0:
+            raise(Exception("At least one model run is needed."))
+        mr0 = model_runs[0]
+        times = np.array(mr0.times, dtype = 'float64')
+        for mr in model_runs[1:]:
+            if type(mr) is not type(mr0):
+                raise(Exception("All model runs need to be of the same class."))
+            if mr.model is not mr0.model:
+                raise(Exception("All model runs need to belong to the same model."))
+            if not np.array_equal(np.array(mr.times, dtype = 'float64'), times):
+                raise(Exception("All model runs need to have the same times."))
+
+        symbols = list(mr0.parameter_set.keys())
+        for mr in model_runs[1:]:
+            if set(mr.parameter_set.keys()) != set(symbols):
+                raise(Exception("All model runs need values for the same parameters."))
+
+        values = np.array([[float(mr.parameter_set[s]) for s in symbols] for mr in model_runs])
+        if len(symbols) == 0:
+            values = values.reshape((len(model_runs), 0))
+        varying = [j for j in range(len(symbols)) if not np.all(values[:,j] == values[0,j])]
+        parameter_set = {symbols[j]: mr0.parameter_set[symbols[j]] for j in range(len(symbols)) if j not in varying}
+        start_values_matrix = np.array([np.array(mr.start_values, dtype = 'float64') for mr in model_runs])
+
+        kwargs.setdefault('func_set', mr0.func_set)
+        kwargs.setdefault('run_class', type(mr0))
+        return cls(mr0.model, [symbols[j] for j in varying], values[:,varying], start_values_matrix, times, parameter_set = parameter_set, **kwargs)
+
+
+    @property
+    def nr_pools(self):
+        return len(self.model.state_vector)
+
+
+    @property
+    def nr_members(self):
+        return self.start_values_matrix.shape[0]
+
+
+    def model_run(self, member):
+        # the SmoothModelRun of a single member, e.g. to look at it in detail
+        parameter_set = dict(self.parameter_set)
+        parameter_set.update({s: self.parameter_matrix[member,j] for j, s in enumerate(self.parameter_symbols)})
+        mr = self.run_class(self.model, parameter_set, self.start_values_matrix[member].copy(), self.times, self.func_set)
+        if hasattr(mr, 'integrator'):
+            mr.integrator = self.integrator
+        return mr
+
+
+    @property
+    def rhs(self):
+        # srm.F simplifies every component, we do it only once
+        if self._rhs is None:
+            self._rhs = self.model.F
+        return self._rhs
+
+
+    def _lambdify(self, state_vector, exprs):
+        # F(*state_vector, t, *parameter_symbols) returning the tuple of exprs,
+        # compiled once
+        tup = tuple(state_vector) + (self.model.time_symbol,) + tuple(self.parameter_symbols)
+        exprs = Tuple(*[sympify(expr, locals = _clash) for expr in exprs])
+        cut_func_set = {key[:key.index('(')]: val for key, val in self.func_set.items()}
+        return cached_lambdify(tup, exprs, self.parameter_set, cut_func_set)
+
+
+    def _stacked_rhs(self, F, n, parameter_matrix):
+        # the right hand side of the stacked system of len(parameter_matrix)
+        # members with n state variables each,
+        # the state vector holds their values row by row
+        m = parameter_matrix.shape[0]
+        pars = [parameter_matrix[:,j] for j in range(parameter_matrix.shape[1])]
+
+        def vectorized_rhs(X, t):
+            X = X.reshape((m, n))
+            vals = F(*([X[:,i] for i in range(n)] + [t] + pars))
+            # constant components come back as scalars
+            return np.stack([np.broadcast_to(np.array(val, dtype = 'float64'), (m,)) for val in vals], axis = 1).reshape((-1,))
+
+        def member_rhs(X, t):
+            # for functions in func_set that do not accept arrays
+            X = X.reshape((m, n))
+            res = np.zeros((m, n))
+            for k in range(m):
+                res[k,:] = np.array(F(*(list(X[k]) + [t] + [p[k] for p in pars])), dtype = 'float64').reshape((n,))
+            return res.reshape((-1,))
+
+        try:
+            with np.errstate(all = 'ignore'):
+                vectorized_rhs(np.ones((m*n,)), self.times[0])
+            return vectorized_rhs
+        except (TypeError, ValueError):
+            return member_rhs
+
+
+    def num_rhs(self, parameter_matrix):
+        # the right hand side of the stacked pool system
+        return self._stacked_rhs(self._lambdify(self.model.state_vector, self.rhs), self.nr_pools, parameter_matrix)
+
+
+    def _solve_system(self, state_vector, rhs, start_values_matrix):
+        # solves the system d state_vector/dt = rhs for all members,
+        # shape (members, times, len(state_vector))
+        n = len(state_vector)
+        times = self.times
+        F = self._lambdify(state_vector, rhs)
+        jac_sparsity = None
+        if self.integrator != 'odeint':
+            jac_sparsity = jacobian_sparsity(state_vector, rhs)
+
+        def solve_chunk(members):
+            start, stop = members
+            m = stop - start
+            start_values = start_values_matrix[start:stop]
+            if len(times) == 1 or times[0] == times[-1]:
+                return np.tile(start_values.reshape((m, 1, n)), (1, len(times), 1))
+
+            # the members do not interact, the Jacobian is block diagonal
+            chunk_sparsity = None
+            if jac_sparsity is not None:
+                chunk_sparsity = np.kron(np.eye(m, dtype = bool), jac_sparsity)
+
+            num_rhs = self._stacked_rhs(F, n, self.parameter_matrix[start:stop])
+            sol = integrate(num_rhs, start_values.reshape((-1,)), times, self.integrator, None, chunk_sparsity)
+            return sol.reshape((len(times), m, n)).transpose((1, 0, 2))
+
+        chunk_size = self.chunk_size if self.chunk_size else self.nr_members
+        chunks = [(start, min(start+chunk_size, self.nr_members)) for start in range(0, self.nr_members, chunk_size)]
+        return np.concatenate(fork_map(solve_chunk, chunks, self.processes), axis = 0)
+
+
+    def solve(self):
+        # the pool contents of all members, shape (members, times, pools)
+        if self._sol is None:
+            self._sol = self._solve_system(self.model.state_vector, self.rhs, self.start_values_matrix)
+
+        return self._sol
+
+
+    def evaluate(self, exprs, sol = None, times = None):
+        # exprs evaluated along the solution of all members (or along
+        # other states sol at times), shape (members, times, len(exprs))
+        if sol is None: sol = self.solve()
+        if times is None: times = self.times
+        m, nt, n = sol.shape
+        F = self._lambdify(self.model.state_vector, exprs)
+
+        # all members and times at once
+        args = [sol[:,:,i].reshape((-1,)) for i in range(n)] + [np.tile(np.array(times, dtype = 'float64').reshape((-1,)), m)]
+        args += [np.repeat(self.parameter_matrix[:,j], nt) for j in range(self.parameter_matrix.shape[1])]
+        try:
+            with np.errstate(all = 'ignore'):
+                vals = F(*args)
+            return np.stack([np.broadcast_to(np.array(val, dtype = 'float64'), (m*nt,)) for val in vals], axis = 1).reshape((m, nt, len(exprs)))
+        except (TypeError, ValueError):
+            pass
+
+        res = np.zeros((m*nt, len(exprs)))
+        for r in range(m*nt):
+            res[r,:] = np.array(F(*[arg[r] for arg in args]), dtype = 'float64').reshape((len(exprs),))
+        return res.reshape((m, nt, len(exprs)))
+
+
+    ##### age moments #####
+
+
+    def _age_moment_solution(self, max_order):
+        # the solution of the age moment system, the moments of the ages
+        # in all pools start at 0 (all mass has age 0 at the start)
+        if max_order not in self._age_moment_sols.keys():
+            if np.any(self.start_values_matrix == 0):
+                raise(Exception("The age moment system needs start values different from 0."))
+
+            state_vector, rhs = self.model.age_moment_system(max_order)
+            start_values_matrix = np.zeros((self.nr_members, len(state_vector)))
+            start_values_matrix[:,:self.nr_pools] = self.start_values_matrix
+            self._age_moment_sols[max_order] = self._solve_system(state_vector, rhs, start_values_matrix)
+
+        return self._age_moment_sols[max_order]
+
+
+    def age_moment_vector(self, order):
+        # shape (members, times, pools)
+        n = self.nr_pools
+        return self._age_moment_solution(order)[:,:,n*order:n*(order+1)]
+
+
+    def system_age_moment(self, order):
+        # shape (members, times)
+        n = self.nr_pools
+        ams = self._age_moment_solution(order)
+        soln = ams[:,:,:n]
+        age_moment_vector = np.nan_to_num(ams[:,:,n*order:n*(order+1)])
+        return (age_moment_vector*soln).sum(2)/soln.sum(2)
+
+
+    def backward_transit_time_moment(self, order):
+        # shape (members, times)
+        n = self.nr_pools
+        ams = self._age_moment_solution(order)
+        r = self.evaluate(list(self.model.external_outputs), ams[:,:,:n])
+        age_moment_vector = ams[:,:,n*order:n*(order+1)]
+        return (r*age_moment_vector).sum(2)/r.sum(2)
+
+
+    ##### steady states #####
+
+
+    def steady_states(self, t = None):
+        # the zeros of the right hand side at time t (default: the last
+        # time) found by root finding from the end of the runs,
+        # shape (members, pools), nan where no root was found
+        if t is None: t = self.times[-1]
+        n = self.nr_pools
+        F = self._lambdify(self.model.state_vector, self.rhs)
+        start = self.solve()[:,-1,:]
+
+        res = np.ones((self.nr_members, n))*np.nan
+        with np.errstate(all = 'ignore'):
+            for k in range(self.nr_members):
+                pars = list(self.parameter_matrix[k])
+                f = lambda x: np.array(F(*(list(x) + [t] + pars)), dtype = 'float64').reshape((n,))
+                sol = root(f, start[k])
+                if sol.success and np.all(np.isfinite(sol.x)):
+                    res[k,:] = sol.x
+
+        return res
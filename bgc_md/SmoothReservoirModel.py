@@ -235,7 +235,19 @@ class SmoothReservoirModel:
         # we can use it
         xi, T, N, C, u = self.xi_T_N_u_representation
         return(xi*T*N)
-    
+
+    @property
+    def is_linear(self):
+        # the model is linear if the compartmental matrix does not
+        # depend on the state variables, then the state transition
+        # operator is a matrix
+        free_symbols = self.compartmental_matrix.free_symbols
+        for sv in list(self.state_vector):
+            if sv in free_symbols:
+                return False
+
+        return True
+
     @property
     def mean_age_system(self):
         # we construct the nonlinear system for the combined solution
@@ -0,0 +1,91 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+from .DataFrame import DataFrame
+
+class VariableTable(DataFrame):
+    # A DataFrame of model variables that additionally holds its columns
+    # and hash indexes name -> row and key -> rows, so that lookups do not
+    # scan the table.
+    # The indexes are rebuilt whenever the table is changed by the methods
+    # of DataFrame.
+    # row numbers count like in __getitem__: 0 means the first line below the head
+    def __init__(self, list_of_rows = []):
+        super().__init__(list_of_rows)
+        self._build_indexes()
+
+
+    def _build_indexes(self):
+        head = self.head if self.list_of_rows else []
+        self.columns = {col_name: [row[col_index] for row in self.rows] for col_index, col_name in enumerate(head)}
+
+        self.name_index = {}
+        self.duplicate_names = []
+        for row_index, name in enumerate(self.columns.get('name', [])):
+            if name in self.name_index.keys():
+                self.duplicate_names.append(name)
+            else:
+                self.name_index[name] = row_index
+
+        # a variable can have several keys
+        self.key_index = {}
+        for row_index, entry in enumerate(self.columns.get('key', [])):
+            if not entry: continue
+            if not isinstance(entry, list):
+                entry = [entry]
+            for key in entry:
+                self.key_index.setdefault(key, []).append(row_index)
+
+
+    def get_column(self, column_head):
+        # return a list without column head
+        if isinstance(column_head, int):
+            column_head = self.head[column_head]
+        if not column_head in self.columns.keys():
+            raise(KeyError("There is no column head called " + column_head))
+        # a copy, callers may change the list
+        return list(self.columns[column_head])
+
+
+    def __getitem__(self, index_tuple):
+        row_index = index_tuple[0]
+        column_head = index_tuple[1]
+        if isinstance(column_head, int):
+            column_head = self.head[column_head]
+        if not column_head in self.columns.keys():
+            raise(KeyError("There is no column head called " + column_head))
+
+        # slicing in row_index possible
+        return self.columns[column_head][row_index]
+
+
+    def get_by_name(self, name, column_head):
+        # value in column_head of the variable called name,
+        # raises a KeyError if there is no such variable
+        return self[self.name_index[name], column_head]
+
+
+    def rows_of_key(self, key):
+        # row numbers of the variables with key, usually only one
+        return list(self.key_index.get(key, []))
+
+
+    def get_by_cond(self, target, condition, value):
+        #example: get 'name' where 'condition' == 'value'
+        if target in self.columns.keys() and condition == 'name':
+            row_index = self.name_index.get(value)
+            return None if row_index is None else self[row_index, target]
+        return super().get_by_cond(target, condition, value)
+
+
+    def remove_column(self, column_head):
+        super().remove_column(column_head)
+        self._build_indexes()
+
+
+    def append_column(self, column_head, column_list):
+        super().append_column(column_head, column_list)
+        self._build_indexes()
+
+
+    def append_row(self, row_list):
+        super().append_row(row_list)
+        self._build_indexes()
@@ -24,7 +24,7 @@ Exceptions:
 import re
 import yaml
 from mendeley import Mendeley
-from mendeley.exception import MendeleyException
+from mendeley.exception import MendeleyException, MendeleyApiException
 from string import Template
 import string
 import unicodedata
@@ -33,20 +33,41 @@ from bibtexparser.bparser import BibTexParser
 from bibtexparser.customization import homogenize_latex_encoding 
 from bibtexparser.customization import convert_to_unicode
 import requests
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 #imports from own package
 from . import gv
+from .helpers import load_yaml_str
+
+# if True, entries are only taken from the local bibliography store
+# and no network requests are made
+offline = False
 
 def online_entry(doi,abstract=True):
+    # 0th: check the local bibliography store,
+    # offline any stored entry is better than none
+    entry = bibliography_store.get(doi, abstract and not offline)
+    if entry is not None:
+        return entry
+
+    if offline:
+        print("Warning:doi " + doi + " is not in the local bibliography store (offline mode)")
+        raise DoiNotFoundException(doi)
+
     try: 
         # 1st: check on Mendeley, because they provide abstracts
         entry= _entry_from_str(_mendeley_str(doi, abstract=abstract))
+        bibliography_store.put(doi, entry, abstract)
         return entry
             
     except Exception as e: #fixme mm , maybe find out what exceptions mendeley has und only catch those
         # 2nd: check doi.org directly, no abstracts provided here                  
         try: 
             entry = _direct(doi)
+            bibliography_store.put(doi, entry, abstract)
             return entry
 
         except Exception: #fixme mm , maybe find out what exceptions occure and only catch those
@@ -54,6 +75,108 @@ def online_entry(doi,abstract=True):
             #reraise an exception
             raise DoiNotFoundException(doi) 
 
+
+def prefetch_dois(dois, abstract=True, max_workers=8):
+    """Fetch the entries of all dois not yet in the local bibliography store concurrently.
+
+    Returns the list of dois that could not be resolved.
+    """
+    missing = sorted(set(doi for doi in dois if bibliography_store.get(doi, abstract and not offline) is None))
+    if offline or not missing:
+        return missing
+
+    def fetch(doi):
+        try:
+            online_entry(doi, abstract)
+            return None
+        except DoiNotFoundException:
+            return doi
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        failed = [doi for doi in executor.map(fetch, missing) if doi is not None]
+
+    return failed
+
+
+def prefetch_record_dois(yaml_paths, abstract=True, max_workers=8):
+    """Fetch the entries of all dois in the given yaml files concurrently, see prefetch_dois."""
+    dois = []
+    for p in yaml_paths:
+        try:
+            with Path(p).open() as f:
+                dois += dois_in(load_yaml_str(f.read()))
+        except Exception:
+            # the error will be reported when the model is created
+            pass
+    return prefetch_dois(dois, abstract, max_workers)
+
+
+def dois_in(obj):
+    """Return all values of 'doi' keys in a (nested) dictionary as read from a yaml file."""
+    dois = []
+    if isinstance(obj, dict):
+        for key, val in obj.items():
+            if key == 'doi' and isinstance(val, str) and val:
+                dois.append(val)
+            else:
+                dois += dois_in(val)
+    elif isinstance(obj, list):
+        for val in obj:
+            dois += dois_in(val)
+    return dois
+
+
+class BibliographyStore():
+    """Local store of BibTeX entries by doi in a JSON-lines file.
+    
+    Every line holds the doi, the entry as dictionary and whether the 
+    abstract was requested when the entry was retrieved (it is not 
+    available for all dois). The file is read on first access and new 
+    entries are appended.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            entries = {}
+            if self.path.exists():
+                with self.path.open(encoding='utf8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                            entries[record['doi'].lower()] = record
+                        except (ValueError, KeyError):
+                            # skip broken lines
+                            pass
+            self._entries = entries
+        return self._entries
+
+    def get(self, doi, abstract=False):
+        with self._lock:
+            record = self._load().get(doi.lower())
+        if record is None:
+            return None
+        if abstract and not record['abstract']:
+            return None
+        return dict(record['entry'])
+
+    def put(self, doi, entry, abstract):
+        record = {'doi': doi, 'abstract': abstract, 'entry': dict(entry)}
+        with self._lock:
+            self._load()[doi.lower()] = record
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open('a', encoding='utf8') as f:
+                    f.write(json.dumps(record, sort_keys=True) + "\n")
+            except OSError:
+                # e.g. installed read-only, keep the entry in memory
+                pass
+
+bibliography_store = BibliographyStore(gv.resources_path.joinpath('bibliography.jsonl'))
+
 class DoiNotFoundException(Exception):
     """Raised if BibTex entry cannot be found online by doi"""
     def __init__(self, doi):
@@ -85,7 +208,6 @@ class BibtexEntry():
 
     @classmethod
     def from_doi(cls,doi,abstract=True):
-        entry=online_entry(doi,abstract=abstract)
         entry=online_entry(doi,abstract=abstract)
         # call normal init
         BE=cls(entry)
@@ -338,7 +460,7 @@ def _direct_data(doi):
     """Return the data coming directly from doi (as string) or 'None'."""
     url = "http://dx.doi.org/" + doi
     headers = {"accept": "application/x-bibtex"}
-    doi_result = requests.get(url, headers = headers).text
+    doi_result = _http_session().get(url, headers = headers, timeout = 30).text
 
     pattern = re.compile(r"<!DOCTYPE.*")
     if None == pattern.match(doi_result):
@@ -378,18 +500,58 @@ def _direct(doi):
     return entry
 
 
-def _mendeley_data(doi):
-    """Returns Mendeley data or 'None', retrieved by doi via Mendeley."""
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _http_session():
+    """One pooled http session shared by all requests to doi.org."""
+    with _sessions_lock:
+        if 'http' not in _sessions.keys():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions['http'] = session
+        return _sessions['http']
+
 
+def _new_mendeley_session():
+    """A Mendeley session authenticated with the client credentials."""
     config_file_name = gv.resources_path.joinpath('mendeley_user_config.yml').as_posix()
 
     with open(config_file_name) as f:
-        config = yaml.load(f)
+        config = yaml.safe_load(f)
 
     mendeley = Mendeley(config['clientId'], config['clientSecret'])
-    session = mendeley.start_client_credentials_flow().authenticate()
+    return mendeley.start_client_credentials_flow().authenticate()
+
+
+def _mendeley_session(renew=False):
+    """The authenticated Mendeley session, created again if its token has expired or if renew is True."""
+    with _sessions_lock:
+        session = _sessions.get('mendeley')
+        if session is not None and not renew:
+            # renew a minute early, the token must not expire during a request
+            expires_at = getattr(session, 'token', {}).get('expires_at')
+            renew = expires_at is not None and expires_at < time.time() + 60
+        if session is None or renew:
+            _sessions['mendeley'] = _new_mendeley_session()
+        return _sessions['mendeley']
+
+
+def _mendeley_data(doi):
+    """Returns Mendeley data or 'None', retrieved by doi via Mendeley."""
+
+    session = _mendeley_session()
 
-    doc = session.catalog.by_identifier(doi=doi, view='bib')
+    try:
+        doc = session.catalog.by_identifier(doi=doi, view='bib')
+    except MendeleyApiException as e:
+        # the token was revoked or expired on the server side
+        if e.status != 401:
+            raise
+        session = _mendeley_session(renew=True)
+        doc = session.catalog.by_identifier(doi=doi, view='bib')
 
     mendeley_doi = doc.identifiers['doi']
     if doi == mendeley_doi:
@@ -0,0 +1,81 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with Path(path).open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def package_version():
+    try:
+        from importlib.metadata import version
+        return version('bgc_md')
+    except Exception:
+        # not installed, e.g. run from a source checkout
+        return 'unknown'
+
+
+class BuildManifest:
+    """Records hashes of the inputs every output in a directory was built from.
+
+    An entry is up to date if its inputs (yaml records, templates, the source
+    files generating the report) and the package version are unchanged and
+    all its outputs still exist. The manifest is stored as json in the
+    directory itself.
+    """
+    file_name = 'build_manifest.json'
+    format_version = 1
+
+    def __init__(self, dir_path):
+        self.path = Path(dir_path).joinpath(self.file_name)
+        self.version = package_version()
+        self.entries = {}
+        if self.path.exists():
+            try:
+                with self.path.open() as f:
+                    content = json.load(f)
+                if content.get('format_version') == self.format_version:
+                    self.entries = content['entries']
+            except (ValueError, KeyError):
+                # a broken manifest means everything is rebuilt
+                self.entries = {}
+
+
+    def inputs_hash(self, input_paths):
+        h = hashlib.sha256()
+        h.update(self.version.encode())
+        for p in input_paths:
+            h.update(Path(p).name.encode())
+            h.update(file_hash(p).encode())
+        return h.hexdigest()
+
+
+    def is_up_to_date(self, key, input_paths, output_paths = ()):
+        if self.entries.get(key) != self.inputs_hash(input_paths):
+            return False
+
+        return all(Path(p).exists() for p in output_paths)
+
+
+    def update(self, key, input_paths):
+        self.entries[key] = self.inputs_hash(input_paths)
+
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+
+    def save(self):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = self.path.with_name(self.file_name + '.tmp')
+        with tmp_path.open('w') as f:
+            json.dump({'format_version': self.format_version, 'entries': self.entries}, f, indent = 1, sort_keys = True)
+        os.replace(str(tmp_path), str(self.path))
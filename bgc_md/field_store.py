@@ -0,0 +1,304 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class FieldStore:
+    """Chunked binary storage of a field like an age density (ages x times x pools).
+
+    A store is a directory with metadata.json and .npy files holding
+    chunk_rows consecutive rows along the first axis each. The metadata
+    contain the names of the dimensions and their coordinates, e.g.
+    ages, times and pool names; the coordinates of the first dimension
+    grow as rows are appended.
+    Rows can be appended as they are computed, a chunk is written as soon
+    as it is full, the rows of the last chunk on flush() or close().
+    Reading maps the chunks into memory and loads only the chunks that
+    are accessed.
+    """
+    format_version = 1
+    metadata_file_name = 'metadata.json'
+
+    def __init__(self, path, metadata, mode = 'r'):
+        self.path = Path(path)
+        self.metadata = metadata
+        self.mode = mode
+        first = self.dims[0]
+        # rows in files, the last chunk may be incomplete in read mode
+        self._file_rows = metadata['nr_rows']
+        self._file_coords = list(metadata['coords'][first])
+        # rows of the last chunk not yet written in append mode
+        self._buffer = []
+        self._buffer_coords = []
+        self._chunks = {}
+
+        if mode == 'a':
+            # continue the last chunk if it is incomplete
+            c = self.chunk_rows
+            nr_full = (self._file_rows // c)*c
+            if nr_full < self._file_rows:
+                self._buffer = list(np.load(str(self._chunk_path(nr_full // c))))
+                self._buffer_coords = self._file_coords[nr_full:]
+                self._file_rows = nr_full
+                self._file_coords = self._file_coords[:nr_full]
+        elif mode != 'r':
+            raise(Exception("Unknown mode '" + str(mode) + "', use 'r' or 'a'."))
+
+
+    @classmethod
+    def create(cls, path, dims, coords, dtype = 'float64', chunk_rows = 64):
+        # dims names the axes, coords maps the names of all but the first
+        # axis to their coordinates, the coordinates along the first axis
+        # are given with the rows when they are appended
+        path = Path(path)
+        path.mkdir(parents = True, exist_ok = True)
+        for p in path.glob('chunk_*.npy'):
+            p.unlink()
+
+        metadata = {'format_version': cls.format_version,
+                    'dims': list(dims),
+                    'coords': {dim: _to_list(coords[dim]) for dim in dims[1:]},
+                    'dtype': np.dtype(dtype).name,
+                    'chunk_rows': int(chunk_rows),
+                    'nr_rows': 0}
+        metadata['coords'][dims[0]] = []
+
+        store = cls(path, metadata, 'a')
+        store._write_metadata()
+        return store
+
+
+    @classmethod
+    def open(cls, path, mode = 'r'):
+        # mode 'r' for reading, 'a' for appending further rows
+        path = Path(path)
+        metadata_path = path.joinpath(cls.metadata_file_name)
+        if not metadata_path.exists():
+            raise(Exception('There is no field store in ' + str(path)))
+
+        with metadata_path.open() as f:
+            metadata = json.load(f)
+        if metadata.get('format_version') != cls.format_version:
+            raise(Exception('The field store in ' + str(path) + ' has an unknown format version.'))
+
+        return cls(path, metadata, mode)
+
+
+    @property
+    def dims(self):
+        return self.metadata['dims']
+
+
+    @property
+    def coords(self):
+        coords = {dim: np.array(values) for dim, values in self.metadata['coords'].items()}
+        coords[self.dims[0]] = np.array(self._file_coords + self._buffer_coords)
+        return coords
+
+
+    @property
+    def chunk_rows(self):
+        return self.metadata['chunk_rows']
+
+
+    @property
+    def dtype(self):
+        return np.dtype(self.metadata['dtype'])
+
+
+    @property
+    def row_shape(self):
+        return tuple(len(self.metadata['coords'][dim]) for dim in self.dims[1:])
+
+
+    @property
+    def shape(self):
+        return (len(self),) + self.row_shape
+
+
+    def __len__(self):
+        return self._file_rows + len(self._buffer)
+
+
+    def append(self, rows, coords):
+        # rows has the shape (k,) + row_shape, coords are the k
+        # coordinates of the rows along the first axis
+        if self.mode != 'a':
+            raise(Exception('The field store was not opened for appending.'))
+
+        rows = np.asarray(rows, dtype = self.dtype).reshape((-1,) + self.row_shape)
+        coords = _to_list(np.asarray(coords).reshape((-1,)))
+        if len(coords) != rows.shape[0]:
+            raise(Exception('There must be one coordinate per row.'))
+
+        self._buffer.extend(list(rows))
+        self._buffer_coords.extend(coords)
+        c = self.chunk_rows
+        while len(self._buffer) >= c:
+            self._write_chunk(self._buffer[:c])
+            self._file_rows += c
+            self._file_coords.extend(self._buffer_coords[:c])
+            self._buffer = self._buffer[c:]
+            self._buffer_coords = self._buffer_coords[c:]
+            self._write_metadata()
+
+
+    def flush(self):
+        # writes the incomplete last chunk, its rows stay in the
+        # buffer to be completed by further appends
+        if self.mode != 'a':
+            return
+        if self._buffer:
+            self._write_chunk(self._buffer)
+        self._write_metadata()
+
+
+    def close(self):
+        self.flush()
+        if self.mode == 'a':
+            self._file_rows += len(self._buffer)
+            self._file_coords.extend(self._buffer_coords)
+            self._buffer = []
+            self._buffer_coords = []
+            self.mode = 'r'
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def _chunk_path(self, chunk_index):
+        return self.path.joinpath('chunk_%06d.npy' % chunk_index)
+
+
+    def _write_chunk(self, rows):
+        chunk_index = self._file_rows // self.chunk_rows
+        path = self._chunk_path(chunk_index)
+        tmp_path = path.with_name(path.stem + '.%d.tmp.npy' % os.getpid())
+        np.save(str(tmp_path), np.array(rows, dtype = self.dtype))
+        os.replace(str(tmp_path), str(path))
+        self._chunks.pop(chunk_index, None)
+
+
+    def _write_metadata(self):
+        self.metadata['nr_rows'] = len(self)
+        self.metadata['coords'][self.dims[0]] = self._file_coords + self._buffer_coords
+
+        path = self.path.joinpath(self.metadata_file_name)
+        tmp_path = path.with_name(path.name + '.%d.tmp' % os.getpid())
+        with tmp_path.open('w') as f:
+            json.dump(self.metadata, f, indent = 1)
+        os.replace(str(tmp_path), str(path))
+
+
+    def _chunk(self, chunk_index):
+        if chunk_index not in self._chunks.keys():
+            self._chunks[chunk_index] = np.load(str(self._chunk_path(chunk_index)), mmap_mode = 'r')
+        return self._chunks[chunk_index]
+
+
+    def rows(self, start = 0, stop = None):
+        # the rows start to stop (exclusive) as array,
+        # only the chunks containing them are read
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return self[start:max(start, stop)]
+
+
+    def _row_axis(self, rest):
+        # the axis of the result of [(rows,) + rest] the rows end up in,
+        # advanced indices separated by others move their axes to the front
+        if not any(isinstance(r, (list, np.ndarray)) for r in rest):
+            return 0
+        dummy = np.broadcast_to(np.zeros((), dtype = self.dtype), (3,) + self.row_shape)
+        shape_2 = dummy[(slice(0, 2),) + rest].shape
+        shape_3 = dummy[(slice(0, 3),) + rest].shape
+        return [k for k in range(len(shape_2)) if shape_2[k] != shape_3[k]][0]
+
+
+    def _read(self, rows, rest):
+        # the rows with the increasing indices rows (a slice with positive
+        # step or a sorted index array) indexed by rest, every chunk is
+        # indexed before the parts are put together, so only the selected
+        # entries are loaded into memory
+        axis = self._row_axis(rest)
+        advanced_rest = any(isinstance(r, (list, np.ndarray)) for r in rest)
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            rows = np.arange(start, stop, step)
+
+        c = self.chunk_rows
+        parts = []
+        in_buffer = rows >= self._file_rows
+        file_rows = rows[~in_buffer]
+        for chunk_index in np.unique(file_rows // c):
+            local = file_rows[file_rows // c == chunk_index] - chunk_index*c
+            chunk = self._chunk(chunk_index)
+            if len(local) > 1 and np.all(np.diff(local) == local[1]-local[0]):
+                # regular steps, a view of the memory map
+                local = slice(local[0], local[-1]+1, local[1]-local[0])
+            elif len(local) == 1:
+                local = slice(local[0], local[0]+1)
+            if isinstance(local, slice) or not advanced_rest:
+                parts.append(np.array(chunk[(local,) + rest]))
+            else:
+                parts.append(np.array(chunk[local][(slice(None),) + rest]))
+
+        if np.any(in_buffer):
+            buffer = np.array([self._buffer[r - self._file_rows] for r in rows[in_buffer]], dtype = self.dtype)
+            parts.append(buffer[(slice(None),) + rest])
+
+        if len(parts) == 0:
+            empty = np.zeros((0,) + self.row_shape, dtype = self.dtype)
+            return empty[(slice(None),) + rest]
+        return np.concatenate(parts, axis = axis)
+
+
+    def __getitem__(self, index):
+        # numpy indexing, the first index selects the chunks to be read
+        if not isinstance(index, tuple):
+            index = (index,)
+        if index[0] is Ellipsis:
+            index = (slice(None),) + index
+        first, rest = index[0], tuple(index[1:])
+        advanced_rest = any(isinstance(r, (list, np.ndarray)) for r in rest)
+
+        if isinstance(first, (int, np.integer)):
+            if first < 0: first += len(self)
+            if not 0 <= first < len(self):
+                raise(IndexError('row index out of range'))
+            if not advanced_rest:
+                return self._read(slice(first, first+1), rest)[0]
+            first = np.array(first)
+        elif isinstance(first, slice) and (first.step is None or first.step > 0):
+            return self._read(first, rest)
+        else:
+            first = np.arange(len(self))[first]
+
+        # index arrays and reversed slices, the rows are read in
+        # increasing order and rearranged afterwards
+        rows, inverse = np.unique(first, return_inverse = True)
+        inverse = inverse.reshape(np.shape(first))
+        if advanced_rest:
+            # numpy broadcasts the row indices with the other index arrays,
+            # only the selected rows are read
+            return self._read(rows, ())[(inverse,) + rest]
+        return np.take(self._read(rows, rest), inverse, axis = 0)
+
+
+    def to_array(self):
+        return self.rows(0, None)
+
+
+def _to_list(values):
+    # json serializable coordinates
+    if isinstance(values, np.ndarray):
+        return values.tolist()
+    return [v.item() if isinstance(v, np.generic) else v for v in values]
@@ -2,12 +2,19 @@
 
 import copy
 import sys
+import types
 import numpy as np 
 
 from sympy import sympify, Symbol, MatrixSymbol 
 from sympy.abc import _clash
 from sympy.parsing import sympy_parser
 from pytexit import py2tex
+import yaml
+try:
+    # the libyaml based loader is much faster
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 
 def pp(strng,env,comment=""):
@@ -45,6 +52,10 @@ def eval_expressions(expression_list, g, l):
                raise Exception("The expression that could not be evaluated was: " + expr + "\n" + e.__str__())
 
         
+def load_yaml_str(yaml_str):
+    return yaml.load(yaml_str, Loader=YamlLoader)
+
+
 def retrieve_or_default(complete_dict,key):
 #    default="a value for the key:\""+str(key)+"\" is not available"
     default = None
@@ -123,7 +134,24 @@ def get_size(obj, seen=None):
     # Important mark as seen *before* entering recursion to gracefully handle
     # self-referential objects
     seen.add(obj_id)
-    if isinstance(obj, dict):
+    if isinstance(obj, np.ndarray):
+        # the data of views belong to their base arrays,
+        # iterating over the entries would take forever
+        if obj.base is not None:
+            size += obj.nbytes
+    elif isinstance(obj, (types.ModuleType, type)):
+        # shared by everybody
+        pass
+    elif isinstance(obj, types.FunctionType):
+        # closures hold the data of e.g. interpolating functions
+        for cell in (obj.__closure__ or ()):
+            try:
+                size += get_size(cell.cell_contents, seen)
+            except ValueError:
+                # empty cell
+                pass
+        size += get_size(obj.__defaults__, seen)
+    elif isinstance(obj, dict):
         size += sum([get_size(v, seen) for v in obj.values()])
         size += sum([get_size(k, seen) for k in obj.keys()])
     elif hasattr(obj, '__dict__'):
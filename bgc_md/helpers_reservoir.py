@@ -1,8 +1,9 @@
 # vim:set ff=unix expandtab ts=4 sw=4:
 
+import multiprocessing
 import numpy as np 
 
-from sympy import flatten, gcd, lambdify, DiracDelta, solve
+from sympy import flatten, gcd, lambdify, DiracDelta, solve, Matrix, Derivative
 from sympy.polys.polyerrors import PolynomialError
 from scipy.integrate import odeint
 from scipy.optimize import brentq
@@ -11,6 +12,9 @@ from scipy.interpolate import lagrange
 
 from string import Template
 
+from .lambdify_cache import cached_lambdify
+from .integrators import integrate, integrate_dense
+
 
 #fixme: test
 def has_pw(expr):
@@ -94,8 +98,6 @@ def factor_out_from_matrix(M):
 
 
 def numerical_rhs(state_vector, time_symbol, rhs, parameter_set, func_set, times):
-    rhs_par = rhs.subs(parameter_set)
-
     # first check if the rhs is defined piecewise since lambdify does not work then
     if not has_pw(rhs):
     #if False:
@@ -119,7 +121,9 @@ def numerical_rhs(state_vector, time_symbol, rhs, parameter_set, func_set, times
         #FL = lambdify(tup, rhs_par, modules=[cut_func_set,"numpy"])
         
         #FL = lambdify(tup, rhs_par, modules=[cut_func_set, TRANSLATIONS])
-        FL = lambdify(tup, rhs_par, modules=[cut_func_set, 'numpy'])
+        # the parameters are substituted and the result is compiled
+        # only once per model and parameter set
+        FL = cached_lambdify(tup, rhs, parameter_set, cut_func_set)
         
         # 2.)  Write a wrapper that transformes Matrices to lists (or numpy.ndarrays)
         # 
@@ -172,6 +176,7 @@ def numerical_rhs(state_vector, time_symbol, rhs, parameter_set, func_set, times
 
             return f
         
+        rhs_par = rhs.subs(parameter_set)
         num_rhs = funcmaker(rhs_par, state_vector, time_symbol) 
 
     def bounded_num_rhs(X,t):
@@ -203,6 +208,35 @@ def numerical_rhs(state_vector, time_symbol, rhs, parameter_set, func_set, times
     return bounded_num_rhs
 
 
+def jacobian_sparsity(state_vector, rhs):
+    # boolean array with the structurally nonzero entries of d rhs/d state_vector
+    J = Matrix(rhs).jacobian(Matrix(state_vector))
+    return np.array([[J[i,j] != 0 for j in range(J.cols)] for i in range(J.rows)], dtype = bool)
+
+
+def numerical_jacobian(state_vector, time_symbol, rhs, parameter_set, func_set, times):
+    # returns a function jac(X, t) with the derivative of rhs with
+    # respect to the state variables, or None if it cannot be lambdified
+    # (piecewise expressions or derivatives of functions in func_set)
+    J = Matrix(rhs).jacobian(Matrix(state_vector))
+    if has_pw(J) or J.atoms(Derivative):
+        return None
+
+    tup = tuple(state_vector) + (time_symbol,)
+    cut_func_set = {key[:key.index('(')]: val for key, val in func_set.items()}
+    FL = cached_lambdify(tup, J, parameter_set, cut_func_set)
+    n = len(state_vector)
+    t_max = times[-1]
+
+    def jac(X, t):
+        # as in numerical_rhs the last time is used beyond t_max
+        Xt = tuple(X) + (min(t, t_max),)
+        # constant entries are not broadcast by lambdify
+        return np.array(FL(*Xt), dtype = 'float64').reshape((n, n))
+
+    return jac
+
+
 def numsol_symbolic_system(
         state_vector, 
         time_symbol, 
@@ -210,12 +244,21 @@ def numsol_symbolic_system(
         parameter_set, 
         func_set, 
         start_values, 
-        times
+        times,
+        method = 'odeint',
+        use_jacobian = False,
+        dense_output = False
     ):
+    # method is one of the integrators registered in bgc_md.integrators,
+    # with use_jacobian the derivative of rhs is computed symbolically
+    # and passed to the integrator together with its sparsity pattern,
+    # with dense_output the continuous solution over [times[0], times[-1]]
+    # (interpolated between times for integrators without dense output)
+    # is returned as function instead of the values at times
 
     nr_pools = len(state_vector)
     
-    if times[0] == times[-1]: return start_values.reshape((1, nr_pools))
+    if times[0] == times[-1] and not dense_output: return start_values.reshape((1, nr_pools))
 
     num_rhs = numerical_rhs(
         state_vector,
@@ -226,7 +269,48 @@ def numsol_symbolic_system(
         times
     )
 
-    return odeint(num_rhs, start_values, times, mxstep=10000)
+    jac, jac_sparsity = None, None
+    if use_jacobian:
+        jac_sparsity = jacobian_sparsity(state_vector, rhs)
+        jac = numerical_jacobian(state_vector, time_symbol, rhs, parameter_set, func_set, times)
+
+    if dense_output:
+        return integrate_dense(num_rhs, start_values, times, method, jac, jac_sparsity)
+
+    return integrate(num_rhs, start_values, times, method, jac, jac_sparsity)
+
+
+def exp_sinh_nodes(h = 1/32, s_max = 3.5):
+    # nodes and weights of the exp-sinh rule for integrals over [0, oo),
+    # a = exp(pi/2*sinh(s)) on an equidistant grid in s with step size h,
+    # the default covers ages from about 1e-11 to 1e11
+    s = np.arange(-s_max, s_max+h/2, h)
+    nodes = np.exp(np.pi/2*np.sinh(s))
+    weights = h*np.pi/2*np.cosh(s)*nodes
+    return nodes, weights
+
+
+_fork_map_func = None
+
+def _fork_map_call(arg):
+    return _fork_map_func(arg)
+
+def fork_map(func, iterable, processes = 1):
+    # like map, but distributed to forked worker processes,
+    # func itself is inherited by the workers and needs not to be picklable,
+    # only its arguments and return values
+    args = list(iterable)
+    if (processes is None) or (processes <= 1) or (len(args) <= 1):
+        return [func(arg) for arg in args]
+
+    global _fork_map_func
+    _fork_map_func = func
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(min(processes, len(args))) as pool:
+            return pool.map(_fork_map_call, args)
+    finally:
+        _fork_map_func = None
 
 
 def arrange_subplots(n):
@@ -246,24 +330,16 @@ def arrange_subplots(n):
 
 
 def melt(ndarr, identifiers = None):
+    # rows (identifiers of all axes..., value) of all entries of ndarr
+    # in C order, by default the identifiers are the indices
     shape = ndarr.shape
 
-    if identifiers == None:
+    if identifiers is None:
         identifiers =  [range(shape[dim]) for dim in range(len(shape))]
 
-    def rek(struct, ids, melted_list, dim):
-        if type(struct) != np.ndarray:
-            melted_list.append(ids + [struct])
-        else:
-            shape = struct.shape
-            for k in range(shape[0]):
-                rek(struct[k], ids + [identifiers[dim][k]], melted_list, dim+1)
-
-    melted_list = []
-    rek(ndarr, [], melted_list, 0)
-    rows = len(melted_list)
-    cols = len(melted_list[0])
-    melted = np.array(melted_list).reshape((rows, cols))
+    ids = [np.array(list(identifiers[dim]))[:shape[dim]] for dim in range(len(shape))]
+    grids = np.meshgrid(*ids, indexing = 'ij')
+    melted = np.column_stack([grid.reshape((-1,)) for grid in grids] + [np.asarray(ndarr).reshape((-1,))])
     
     return melted
 
@@ -298,13 +374,101 @@ def generalized_inverse_CDF(CDF, u, start_dist = 1e-4, tol = 1e-8):
     return res
 
 
+# solves CDF_i(a_i) = us[i] for all i at once, 
+# CDF(ages, indices) returns the values of the CDFs with the given indices
+# at the ages (both arrays of the same length), 
+# start are guesses for the solutions, e.g. the quantiles of the 
+# previous time step, around which a bracket [lo, hi] with
+# CDF(lo) < u <= CDF(hi) is searched, the brackets are narrowed down
+# by alternating regula falsi and bisection steps until hi-lo < tol
+# the result is hi, nan if CDF becomes nan or u is not reached 
+def generalized_inverse_CDF_vectorized(CDF, us, start = None, tol = 1e-8, max_iter = 500):
+    us = np.array(us, dtype = 'float64').reshape((-1,))
+    m = len(us)
+    if start is None:
+        start = np.ones((m,))*1e-4
+    start = np.array(np.broadcast_to(start, (m,)), dtype = 'float64')
+    start[~(start > 0)] = 1e-4
+
+    def f(ages, indices):
+        return np.array(CDF(ages, indices), dtype = 'float64').reshape((-1,)) - us[indices]
+
+    res = np.ones((m,))*np.nan
+    active = ~np.isnan(us)
+    lo, hi = np.zeros((m,)), start.copy()
+    f_lo, f_hi = np.zeros((m,)), np.zeros((m,))
+
+    idx = np.where(active)[0]
+    f_hi[idx] = f(hi[idx], idx)
+    active[np.isnan(f_hi)] = False
+
+    # too far left: move the bracket to the right with growing steps
+    step = np.maximum(0.1*start, 0.1)
+    up = active & (f_hi < 0)
+    lo[up], f_lo[up] = hi[up], f_hi[up]
+    for _ in range(max_iter):
+        idx = np.where(up)[0]
+        if len(idx) == 0: break
+        hi[idx] = lo[idx] + step[idx]
+        step[idx] *= 2
+        f_hi[idx] = f(hi[idx], idx)
+        right = f_hi[idx] >= 0
+        left = f_hi[idx] < 0
+        lo[idx[left]], f_lo[idx[left]] = hi[idx[left]], f_hi[idx[left]]
+        up[idx[right]] = False
+        # nan
+        nan = np.isnan(f_hi[idx])
+        up[idx[nan]] = False
+        active[idx[nan]] = False
+    active[up] = False
+
+    # too far right: move the lower end to the left, at most to 0
+    step = np.maximum(0.1*start, 0.1)
+    down = active & (f_hi >= 0)
+    for _ in range(max_iter):
+        idx = np.where(down)[0]
+        if len(idx) == 0: break
+        lo[idx] = np.maximum(hi[idx] - step[idx], 0)
+        step[idx] *= 2
+        f_lo[idx] = f(lo[idx], idx)
+        left = f_lo[idx] < 0
+        down[idx[left]] = False
+        at_zero = ~left & (lo[idx] == 0)
+        # the CDF reaches u already at age 0
+        res[idx[at_zero]] = 0.0
+        active[idx[at_zero]] = False
+        down[idx[at_zero]] = False
+        still = ~left & ~at_zero
+        hi[idx[still]], f_hi[idx[still]] = lo[idx[still]], f_lo[idx[still]]
+
+    for it in range(max_iter):
+        idx = np.where(active & (hi-lo > tol))[0]
+        if len(idx) == 0: break
+        l, h = lo[idx], hi[idx]
+        c = (l+h)/2
+        if it % 2 == 0:
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                rf = l - f_lo[idx]*(h-l)/(f_hi[idx]-f_lo[idx])
+            inside = np.isfinite(rf) & (rf > l) & (rf < h)
+            c[inside] = rf[inside]
+
+        fc = f(c, idx)
+        left = fc < 0
+        lo[idx[left]], f_lo[idx[left]] = c[left], fc[left]
+        hi[idx[~left]], f_hi[idx[~left]] = c[~left], fc[~left]
+
+    res[active] = hi[active]
+    return res
+
+
 # draw a random variable with given CDF
 def draw_rv(CDF):
     return generalized_inverse_CDF(CDF, np.random.uniform())
 
 
 # return function g, such that g(normally distributed sv) is distributed according to CDF
-def stochastic_collocation_transform(M, CDF):
+# with vectorized = True CDF is called with arrays of ages
+def stochastic_collocation_transform(M, CDF, vectorized = False):
     # collocation points for normal distribution, taken from Table 10 in Appendix 3
     # of Grzelak2015SSRN
     cc_data = { 2: [1],
@@ -323,7 +487,12 @@ def stochastic_collocation_transform(M, CDF):
     cc_points = [-x for x in reversed(cc_data[M]) if x != 0.0] + cc_data[M]
     cc_points = np.array(cc_points)
     #print('start computing collocation transform')
-    ys = np.array([generalized_inverse_CDF(CDF, norm.cdf(x)) for x in cc_points])
+    # all collocation points at once
+    if vectorized:
+        CDF_vec = lambda ages, indices: CDF(ages)
+    else:
+        CDF_vec = lambda ages, indices: np.array([CDF(a) for a in ages])
+    ys = generalized_inverse_CDF_vectorized(CDF_vec, norm.cdf(cc_points))
     #print('ys', ys)
     #print('finished computing collocation transform')
 
@@ -359,6 +528,63 @@ def MH_sampling(N, PDF, start = 1.0):
     return xvec
 
 
+# Metropolis-Hastings sampling for PDFs with nonnegative support,
+# nr_chains chains are advanced together, PDF is called once per step
+# with the array of all proposals,
+# start is one start value for all chains or one per chain, since
+# every chain is only N/nr_chains steps long, the chains should start
+# at values spread over the distribution or discard the first
+# burn_in steps
+# no thinning
+# returns the N samples and the number of calls of PDF
+def MH_sampling_chains(N, PDF, nr_chains = 10, start = 1.0, rng = None, burn_in = 0):
+    if rng is None: rng = np.random.default_rng()
+    nr_chains = max(1, min(nr_chains, N))
+    nr_steps = -(-N // nr_chains)
+
+    x = np.ones((nr_chains,))*np.array(start, dtype = 'float64').reshape((-1,))[:nr_chains]
+    PDF_x = PDF(x)
+    calls = 1
+    norm_cdf_x = norm.cdf(x)
+    xvec = np.ndarray((nr_steps, nr_chains))
+
+    for i in range(-burn_in, nr_steps):
+        xs = x + rng.normal(size = nr_chains)
+        neg = xs <= 0
+        while neg.any():
+            xs[neg] = x[neg] + rng.normal(size = neg.sum())
+            neg = xs <= 0
+
+        PDF_xs = PDF(xs)
+        calls += 1
+        norm_cdf_xs = norm.cdf(xs)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            A = PDF_xs/PDF_x * norm_cdf_x/norm_cdf_xs
+
+        accept = rng.uniform(size = nr_chains) < A
+        x = np.where(accept, xs, x)
+        PDF_x = np.where(accept, PDF_xs, PDF_x)
+        norm_cdf_x = np.where(accept, norm_cdf_xs, norm_cdf_x)
+
+        if i >= 0:
+            xvec[i] = x
+
+    # the chains one after another
+    return xvec.transpose().reshape((-1,))[:N], calls
+
+
+# inverse transform of the uniform variates us for a CDF given by its values
+# at the increasing ages, linearly interpolated, ages of mass that is still 
+# there after the last age are infinite
+def tabulated_inverse_CDF(ages, CDF_values, us):
+    ages = np.concatenate(([0.0], ages))
+    CDF_values = np.maximum.accumulate(np.concatenate(([0.0], CDF_values)))
+    us = np.array(us, dtype = 'float64')
+    res = np.interp(us, CDF_values, ages)
+    res[us > CDF_values[-1]] = np.inf
+    return res
+
+
 def save_csv(filename, melted, header):
     #np.savetxt(filename, melted, header = header, delimiter=',', comments='', fmt="%10.8f")
     np.savetxt(filename, melted, header = header, delimiter=',', fmt="%10.8f")
@@ -0,0 +1,116 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import numpy as np
+from scipy.integrate import odeint, solve_ivp
+from scipy.interpolate import interp1d
+from scipy.sparse import csc_matrix
+
+
+# All integrators share the signature
+#   integrator(num_rhs, start_values, times, jac = None, jac_sparsity = None, **options)
+# with num_rhs(X, t) and jac(X, t) in the argument order of odeint.
+# They return an array of shape (len(times), len(start_values)).
+integrators = dict()
+
+# the solve_ivp methods giving the continuous solution for integrate_dense,
+# integrators without one are interpolated between the times
+dense_methods = dict()
+
+
+def register_integrator(name, integrator, dense_method = None):
+    integrators[name] = integrator
+    if dense_method is None:
+        dense_methods.pop(name, None)
+    else:
+        dense_methods[name] = dense_method
+
+
+def integrate(num_rhs, start_values, times, method = 'odeint', jac = None, jac_sparsity = None, **options):
+    if method not in integrators.keys():
+        raise(Exception("Unknown integrator '" + str(method) + "', available are: " + ", ".join(sorted(integrators.keys()))))
+
+    return integrators[method](num_rhs, start_values, times, jac, jac_sparsity, **options)
+
+
+def _odeint(num_rhs, start_values, times, jac = None, jac_sparsity = None, **options):
+    # LSODA, switches automatically between stiff and nonstiff methods
+    options.setdefault('mxstep', 10000)
+    return odeint(num_rhs, start_values, times, Dfun = jac, **options)
+
+
+def _solve_ivp_options(method, jac, jac_sparsity, options):
+    # the options of solve_ivp for method, with the defaults of odeint,
+    # the ones of solve_ivp are much coarser
+    options = dict(options)
+    options.setdefault('rtol', 1.49012e-8)
+    options.setdefault('atol', 1.49012e-8)
+
+    if jac is not None:
+        if (jac_sparsity is not None) and (method in ('BDF', 'Radau')) and (jac_sparsity.mean() < 0.5):
+            # the implicit methods use a sparse LU decomposition then
+            options['jac'] = lambda t, X: csc_matrix(jac(X, t))
+        else:
+            options['jac'] = lambda t, X: jac(X, t)
+    elif (jac_sparsity is not None) and (method in ('BDF', 'Radau', 'LSODA')):
+        # finite differences only for the nonzero entries
+        options['jac_sparsity'] = jac_sparsity
+
+    return options
+
+
+def solve_ivp_integrator(method):
+    def integrator(num_rhs, start_values, times, jac = None, jac_sparsity = None, **options):
+        options = _solve_ivp_options(method, jac, jac_sparsity, options)
+        times = np.array(times, dtype = 'float64')
+
+        fun = lambda t, X: num_rhs(X, t)
+        sol = solve_ivp(fun, (times[0], times[-1]), np.array(start_values, dtype = 'float64'), method = method, t_eval = times, **options)
+        if sol.status < 0:
+            raise(Exception("Integration with " + method + " failed: " + sol.message))
+        return sol.y.transpose()
+
+    return integrator
+
+
+def integrate_dense(num_rhs, start_values, times, method = 'odeint', jac = None, jac_sparsity = None, **options):
+    # integrates once over [times[0], times[-1]] and returns the continuous
+    # solution sol(t) of the integrator, an array of shape (n,)
+    # for scalar t and (len(t), n) for an array of times,
+    # for integrators without dense output the solution at times
+    # is interpolated linearly
+    if method not in integrators.keys():
+        raise(Exception("Unknown integrator '" + str(method) + "', available are: " + ", ".join(sorted(integrators.keys()))))
+
+    start_values = np.array(start_values, dtype = 'float64').reshape((-1,))
+    times = np.array(times, dtype = 'float64').reshape((-1,))
+    t0, t1 = times[0], times[-1]
+    n = len(start_values)
+
+    if t0 == t1:
+        return lambda t: np.tile(start_values, np.shape(t) + (1,)) if np.ndim(t) > 0 else start_values.copy()
+
+    if method in dense_methods.keys():
+        ivp_method = dense_methods[method]
+        options = _solve_ivp_options(ivp_method, jac, jac_sparsity, options)
+        fun = lambda t, X: num_rhs(X, t)
+        sol = solve_ivp(fun, (t0, t1), start_values, method = ivp_method, dense_output = True, **options)
+        if sol.status < 0:
+            raise(Exception("Integration with " + ivp_method + " failed: " + sol.message))
+        interpolant = lambda t: sol.sol(t).transpose()
+    else:
+        soln = integrate(num_rhs, start_values, times, method, jac, jac_sparsity, **options)
+        interpolant = interp1d(times, soln, axis = 0)
+
+    def dense_sol(t):
+        if np.ndim(t) == 0:
+            return np.array(interpolant(np.array([float(t)])), dtype = 'float64').reshape((n,))
+        t = np.array(t, dtype = 'float64')
+        return np.array(interpolant(t.reshape((-1,))), dtype = 'float64').reshape(t.shape + (n,))
+
+    return dense_sol
+
+
+# odeint has no dense output, LSODA is the same method
+register_integrator('odeint', _odeint, 'LSODA')
+for method in ('LSODA', 'BDF', 'Radau', 'RK45'):
+    register_integrator(method, solve_ivp_integrator(method), method)
@@ -0,0 +1,150 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import hashlib
+import inspect
+import os
+import types
+from collections import OrderedDict
+
+from sympy import lambdify, srepr, sympify
+from sympy.abc import _clash
+
+
+class LambdifyCache:
+    """Cache of lambdified sympy expressions.
+
+    The compiled functions are keyed by a stable hash of the arguments, the
+    expression, the parameter set substituted into it and the names of the
+    functions in func_set. The callables in func_set are bound anew on every
+    lookup, so only their names enter the key.
+    The code of at most maxsize functions is held in memory (least recently
+    used ones are evicted first), if cache_dir is given the generated source
+    is also written to disk and reused by later processes.
+    """
+
+    def __init__(self, maxsize = 128, cache_dir = None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._codes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def key(args, expr, parameter_set = None, func_set = None):
+        if parameter_set is None: parameter_set = dict()
+        if func_set is None: func_set = dict()
+
+        h = hashlib.sha256()
+        h.update(srepr(tuple(args)).encode())
+        h.update(srepr(expr).encode())
+        for k, v in sorted([(str(k), srepr(sympify(v))) for k, v in parameter_set.items()]):
+            h.update(('%s=%s;' % (k, v)).encode())
+        for name in sorted(func_set.keys()):
+            h.update(('%s;' % name).encode())
+
+        return h.hexdigest()
+
+
+    def lambdify(self, args, expr, parameter_set = None, func_set = None):
+        """Return a numpy function of args evaluating expr.subs(parameter_set).
+
+        func_set maps the names of undefined functions in expr
+        (without their signatures) to python callables.
+        """
+        if parameter_set is None: parameter_set = dict()
+        if func_set is None: func_set = dict()
+
+        key = self.key(args, expr, parameter_set, func_set)
+        namespace = _namespace(func_set)
+
+        code = self._codes.get(key)
+        if code is not None:
+            self.hits += 1
+            self._codes.move_to_end(key)
+            return types.FunctionType(code, namespace)
+
+        source = self._load(key)
+        if source is None:
+            self.misses += 1
+            expr_par = sympify(expr, locals = _clash).subs(parameter_set)
+            f = lambdify(args, expr_par, modules = [func_set, 'numpy'])
+            code = f.__code__
+            self._save(key, f)
+        else:
+            self.hits += 1
+            exec(source, namespace)
+            code = namespace[_function_name(source)].__code__
+
+        self._codes[key] = code
+        if len(self._codes) > self.maxsize:
+            self._codes.popitem(last = False)
+
+        return types.FunctionType(code, namespace)
+
+
+    def clear(self):
+        self._codes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.py')
+
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as f:
+            return f.read()
+
+
+    def _save(self, key, f):
+        if self.cache_dir is None:
+            return
+
+        try:
+            source = inspect.getsource(f)
+        except (OSError, TypeError):
+            # no source available, keep the function in memory only
+            return
+
+        os.makedirs(self.cache_dir, exist_ok = True)
+        # write to a temporary file first, concurrent processes
+        # must never read half written files
+        path = self._path(key)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as tmp:
+            tmp.write(source)
+        os.replace(tmp_path, path)
+
+
+_numpy_namespace = None
+
+def _namespace(func_set):
+    # the global namespace lambdify creates for modules = [func_set, 'numpy'],
+    # func_set takes precedence over numpy
+    global _numpy_namespace
+    if _numpy_namespace is None:
+        _numpy_namespace = dict(lambdify((), 0, modules = 'numpy').__globals__)
+
+    namespace = dict(_numpy_namespace)
+    namespace.update(func_set)
+    return namespace
+
+
+def _function_name(source):
+    return source[len('def '):source.index('(')].strip()
+
+
+default_cache = LambdifyCache()
+
+
+def cached_lambdify(args, expr, parameter_set = None, func_set = None):
+    return default_cache.lambdify(args, expr, parameter_set, func_set)
@@ -0,0 +1,94 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import hashlib
+import os
+import pickle
+import sys
+from pathlib import Path
+
+from .build_manifest import file_hash, package_version
+
+
+def model_source_paths():
+    # the modules that determine the state of an initialized Model
+    this = Path(__file__).parents[0]
+    return [this.joinpath(fn) for fn in ['Model.py', 'DataFrame.py', 'VariableTable.py', 'bibtexc.py', 'helpers.py', 'ReportInfraStructure.py']]
+
+
+class ModelCache:
+    """Pickled, fully initialized models in cache_dir.
+
+    A cached model is used if the yaml file it was created from, the
+    sources of the model classes, the package version and the python
+    version are the same. The (mtime, size) of the yaml file is
+    remembered in memory to avoid hashing it again in the same process.
+    """
+    _source_hash = None
+    _file_hashes = {}
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+
+    def key(self, yaml_file_path):
+        yaml_file_path = Path(yaml_file_path)
+        h = hashlib.sha256()
+        h.update(self.source_hash().encode())
+        h.update(self.yaml_hash(yaml_file_path).encode())
+        return h.hexdigest()
+
+
+    @classmethod
+    def source_hash(cls):
+        if cls._source_hash is None:
+            h = hashlib.sha256()
+            h.update(package_version().encode())
+            h.update(sys.version.encode())
+            for p in model_source_paths():
+                h.update(file_hash(p).encode())
+            cls._source_hash = h.hexdigest()
+        return cls._source_hash
+
+
+    @classmethod
+    def yaml_hash(cls, yaml_file_path):
+        st = yaml_file_path.stat()
+        stamp = (str(yaml_file_path.resolve()), st.st_mtime_ns, st.st_size)
+        if stamp not in cls._file_hashes.keys():
+            cls._file_hashes[stamp] = file_hash(yaml_file_path)
+        return cls._file_hashes[stamp]
+
+
+    def load(self, yaml_file_path):
+        path = self.cache_dir.joinpath(self.key(yaml_file_path) + '.pickle')
+        if not path.exists():
+            return None
+
+        try:
+            with path.open('rb') as f:
+                model = pickle.load(f)
+        except Exception:
+            # e.g. written by an incompatible version, just rebuild
+            return None
+
+        model.yaml_file_path = yaml_file_path
+        return model
+
+
+    def store(self, yaml_file_path, model):
+        if 'doi' in model.complete_dict.keys() and getattr(model, 'bibtex_entry', None) is None:
+            # the doi could not be resolved (e.g. offline),
+            # do not keep the incomplete model
+            return
+
+        try:
+            data = pickle.dumps(model)
+        except Exception:
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir.joinpath(self.key(yaml_file_path) + '.pickle')
+        tmp_path = path.with_name(path.name + '.%d.tmp' % os.getpid())
+        with tmp_path.open('wb') as f:
+            f.write(data)
+        os.replace(str(tmp_path), str(path))
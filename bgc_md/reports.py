@@ -2,15 +2,18 @@
 import logging
 import inspect
 import numpy as np
-import multiprocessing
 import yaml
 from pathlib import Path
 import subprocess
 from os.path import relpath, dirname
 import os
 import getopt, sys
+import time
+import traceback
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from string import Template
-from sympy import sympify, solve, Symbol, limit, oo, ceiling, simplify, Matrix
+from sympy import sympify, solve, Symbol, limit, oo, ceiling, simplify, Matrix, lambdify
 from sympy.core import Atom
 import matplotlib
 matplotlib.use("Agg")
@@ -23,7 +26,9 @@ from bgc_md.ReportInfraStructure import ReportElementList, Header, Math, Meta, T
 from .Model import Model, check_parameter_set_complete
 from .ModelList import ModelList
 import bgc_md.bibtexc as bibtexc
-from .helpers import py2tex_silent, key_from_dict_by_value
+from .helpers import py2tex_silent, key_from_dict_by_value, load_yaml_str
+from .build_manifest import BuildManifest
+from .steady_states import default_solver as steady_state_solver
 from bgc_md.plot_helpers import add_xhist_data_to_scatter
 from bgc_md.gv import indexcolors, filled_markers
 import bgc_md.gv as gv
@@ -48,6 +53,12 @@ common_parser.add_argument(
     ,default='.'
     ,help="where to generate the html files" 
 )
+common_parser.add_argument(
+    '-o'
+    ,'--offline'
+    ,action='store_true'
+    ,help="take the BibTeX entries only from the local bibliography store, without network requests"
+)
 
 #import mpld3 # interesting functionality for interactive web figures
 
@@ -58,6 +69,7 @@ def generate_model_run_report():
     parser.epilog= "Example: %s Henin1945Annalesagronomiques.yaml-t SoilModels/html" % parser.prog
 
     com=parser.parse_args()
+    bibtexc.offline=com.offline
     print("Creating report from " + com.path + " to " + com.target_dir)
     create_single_report(Path(com.path), Path(com.target_dir))
     sys.exit(0)
@@ -95,15 +107,55 @@ def generate_model_run_reports():
         ,help="create the model website from a directory  <src_dir> containing the yaml files"
         ,default=defaults()['dirs']['tested_records']
     )
+    parser.add_argument(
+        '-j'
+        ,'--jobs'
+        ,type=int
+        ,default=1
+        ,help="the number of processes rendering the model reports concurrently"
+    )
+    parser.add_argument(
+        '-f'
+        ,'--force'
+        ,action='store_true'
+        ,help="rebuild all reports even if their inputs did not change"
+    )
+    parser.add_argument(
+        '-c'
+        ,'--model_cache_dir'
+        ,type=str
+        ,default=None
+        ,help="a directory to keep the parsed models in, speeds up later builds"
+    )
     parser.description="Create model database websites."
 
     com = parser.parse_args()
-    generate_html_dir(com.src_dir,com.target_dir)
+    bibtexc.offline=com.offline
+    generate_html_dir(com.src_dir,com.target_dir,com.jobs,com.force,com.model_cache_dir)
+
+
+def prefetch_bibliography():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s'
+        ,'--src_dir'
+        ,type=str
+        ,help="fetch the BibTeX entries of all dois in the yaml files in <src_dir>"
+        ,default=defaults()['dirs']['tested_records']
+    )
+    parser.description="Fill the local bibliography store, later builds can use it with --offline."
+
+    com = parser.parse_args()
+    rec_list=sorted(Path(com.src_dir).glob('*.yaml'))
+    failed=bibtexc.prefetch_record_dois(rec_list)
+    print("stored the dois of %d records in %s, %d dois could not be resolved" % (len(rec_list), bibtexc.bibliography_store.path, len(failed)))
+    for doi in failed:
+        print(doi)
 
 
 # fixme mm 14.5.2018
 # deprecate! 
-def report_from_model(model):
+def report_from_model(model, symbolic_eigenvalues=False):
     #rel = model.get_meta_data_report()
     #rel = Meta(model.long_name, model.name, model.version)
     rel=ReportElementList()
@@ -365,29 +417,11 @@ def report_from_model(model):
 #        print(ss[i])
 
     # try to calculate the steady states for ten seconds
-    # after ten seconds stop it
-    q = multiprocessing.Queue()
-    def calc_steady_states(q):
-#        rhs = Matrix(list(model.rhs)[1:])
-#        sv = Matrix(list(model.state_vector['expr'])[1:])
-
-        ss = solve(model.rhs, model.state_vector['expr'], dict=True)
-
-#        ss = solve(rhs, sv, dict=True)
-#        srhs = rhs.subs(ss[0])
-#        for i in range(len(srhs)):
-#            print(simplify(srhs[i]))
-        q.put(ss)
-
-    p = multiprocessing.Process(target=calc_steady_states, args=(q,))
-    p.start()
-    p.join(10)
-    if p.is_alive():
-        p.terminate()
-        p.join()
+    # after ten seconds stop it, the solver caches the results
+    steady_states = steady_state_solver.formal_steady_states(model.rhs, model.state_vector['expr'])
+    formal_steady_states_timed_out = steady_states is None
+    if formal_steady_states_timed_out:
         steady_states = []
-    else:
-        steady_states = q.get()
 
 #    rhs = model.rhs
 #    srhs = rhs.subs(steady_states[0])
@@ -423,20 +457,23 @@ def report_from_model(model):
         time_symbol = None
 
     complete_parameter_sets = model.parameter_sets
-    if formal_steady_states and complete_parameter_sets:
+    if (formal_steady_states or formal_steady_states_timed_out) and complete_parameter_sets:
         rel += Text("\n")
         rel += Header("Steady states (potentially incomplete), according jacobian eigenvalues, damping ratio", 2)
-        for par_set in complete_parameter_sets:
-            header_str = "Parameter set: " + par_set['table_head']
-            rel += Header(header_str, 3)
 
-            rhs = model.rhs
-            steady_states = solve(rhs.subs(par_set['values']), model.state_vector['expr'], dict=True)
+        # collect all steady states first, the eigenvalues
+        # of all their jacobians are computed at once
+        ss_entries = []
+        for par_set in complete_parameter_sets:
+            # uses the formal steady states if possible, 
+            # falls back to numerical root finding if sympy times out
+            steady_states = steady_state_solver.parameter_set_steady_states(model.rhs, model.state_vector['expr'], par_set['values'], time_symbol)
             #steady_states = solve(rhs, model.state_vector['expr'], dict=True)
             for ss in steady_states:
                 # check if steady state calculation could solve for all state variables
 #                if len(ss) == len(model.state_vector['expr']):
                     ss_list = []
+                    limit_symbols = []
                     for sv_symbol in model.state_vector['expr']:
                         if sv_symbol in ss.keys():
                             ss_expr = ss[sv_symbol]
@@ -446,63 +483,69 @@ def report_from_model(model):
                         if time_symbol in ss_expr.free_symbols:
                             # take limit of time to infinity if steady state still depends on time
                             ss_expr = limit(ss_expr, time_symbol, oo)
-                            rel += Text("\nTaken limit ") + Math("$sv($t)", sv=sv_symbol, t=time_symbol)
-                            rel += Text(" for ") + Math("$t", t=time_symbol)
-                            rel += Text(" to infinity.\n\n")
+                            limit_symbols.append(sv_symbol)
     
                         sv_name = key_from_dict_by_value(model.symbols_by_type, sv_symbol)
     
                         ss_list.append({'name': sv_name, 'symbol': sv_symbol, 'value': ss_expr})
-                        
-                    for i in range(len(ss_list)):
-                        if ss_list[i]['value'].free_symbols == set():
-                            if ss_list[i]['value'] < 0:
-                                rel += Text('<font color="FF0000">')
-                                rel += Math(ss_list[i]['name'] + ": $v", v = round(ss_list[i]['value'], 3))
-                                rel += Text('</font>')
-                            else:
-                                rel += Math(ss_list[i]['name'] + ": $v", v = round(ss_list[i]['value'], 3))
-                        else:
-                                rel += Math(ss_list[i]['name'] + ": $v", v = ss_list[i]['value'])
-    
-                        if i< len(ss_list)-1:
-                            rel += Text(", ")
-    
-                    rel += Newline()*2
-    
-                    dic = par_set['values']
+
+                    dic = dict(par_set['values'])
                     for i in range(len(ss_list)):
                         dic[ss_list[i]['name']] = ss_list[i]['value']
+
+                    ss_entries.append({'par_set': par_set, 'ss_list': ss_list, 'limit_symbols': limit_symbols, 'dic': dic})
+
+        if not symbolic_eigenvalues:
+            numeric_evs = jacobian_eigenvalues(model, [entry['dic'] for entry in ss_entries])
+
+        for par_set in complete_parameter_sets:
+            header_str = "Parameter set: " + par_set['table_head']
+            rel += Header(header_str, 3)
+
+            for entry_index, entry in enumerate(ss_entries):
+                if entry['par_set'] is not par_set:
+                    continue
+
+                ss_list = entry['ss_list']
+                for sv_symbol in entry['limit_symbols']:
+                    rel += Text("\nTaken limit ") + Math("$sv($t)", sv=sv_symbol, t=time_symbol)
+                    rel += Text(" for ") + Math("$t", t=time_symbol)
+                    rel += Text(" to infinity.\n\n")
     
-                    jacobian = model.jacobian().subs(dic)
-                    if jacobian.free_symbols == set():
-                        evs = [complex(v) for v in jacobian.eigenvals().keys()]
+                for i in range(len(ss_list)):
+                    if ss_list[i]['value'].free_symbols == set():
+                        if ss_list[i]['value'] < 0:
+                            rel += Text('<font color="FF0000">')
+                            rel += Math(ss_list[i]['name'] + ": $v", v = round(ss_list[i]['value'], 3))
+                            rel += Text('</font>')
+                        else:
+                            rel += Math(ss_list[i]['name'] + ": $v", v = round(ss_list[i]['value'], 3))
                     else:
-                        evs = [v for v in jacobian.eigenvals().keys()]
+                            rel += Math(ss_list[i]['name'] + ": $v", v = ss_list[i]['value'])
+    
+                    if i< len(ss_list)-1:
+                        rel += Text(", ")
+    
+                rel += Newline()*2
 
+                if symbolic_eigenvalues:
+                    rel += symbolic_eigenvalue_report(model, entry['dic'])
+                elif numeric_evs[entry_index] is None:
+                    rel += Text("The jacobian is not numeric at this steady state, no eigenvalues computed.\n")
+                else:
+                    evs, rhos = numeric_evs[entry_index]
                     for i in range(len(evs)):
                         ev = evs[i]
-                        
-                        if jacobian.free_symbols == set():
-                            if ev.imag == 0:
-                                ev = ev.real
+                        if ev.imag == 0:
+                            ev = ev.real
     
-                            lamda_i = Symbol('lamda_'+ str(i+1))
-                            rel += Math("$s: $v", s = lamda_i, v = "{:.3f}".format(ev)) + Newline()
+                        lamda_i = Symbol('lamda_'+ str(i+1))
+                        rel += Math("$s: $v", s = lamda_i, v = "{:.3f}".format(ev)) + Newline()
         
-                            if ev.imag != 0:                        
-                                rho = -ev.real/np.sqrt(ev.real**2+ev.imag**2)
-                                rel += Math("$s: $v", s = Symbol("rho_"+ str(i+1)), v = "{:-3f}".format(rho)) + Newline()
-                        else:
-                            lamda_i = Symbol('lamda_'+ str(i+1))
-                            rel += Math("$s: $v", s = lamda_i, v = ev.evalf(4)) + Newline()
-        
-                            #if ev.imag != 0:                        
-                            #    rho = -ev.real/np.sqrt(ev.real**2+ev.imag**2)
-                            #    rel += Math("$s: $v", s = Symbol("rho_"+ str(i+1)), v = "{:-3f}".format(rho)) + Newline()
+                        if ev.imag != 0:                        
+                            rel += Math("$s: $v", s = Symbol("rho_"+ str(i+1)), v = "{:-3f}".format(rhos[i])) + Newline()
     
-        
-                    rel += Text("\n")*2
+                rel += Text("\n")*2
                         
 
     #fixme
@@ -572,6 +615,90 @@ def report_from_model(model):
     
 ######################################################################
 
+def numeric_parameter_values(symbols, dic):
+    # returns the float values of the symbols in dic or None,
+    # values can be expressions in other entries of dic
+    values = []
+    for sym in symbols:
+        if sym.name in dic.keys():
+            val = sympify(dic[sym.name])
+        elif sym in dic.keys():
+            val = sympify(dic[sym])
+        else:
+            return None
+
+        for _ in range(len(dic)):
+            if val.free_symbols == set(): break
+            val = val.subs(dic)
+
+        if val.free_symbols != set():
+            return None
+        try:
+            values.append(complex(val))
+        except TypeError:
+            return None
+
+    values = np.array(values)
+    if np.all(values.imag == 0):
+        values = values.real
+    return values
+
+def jacobian_eigenvalues(model, dics):
+    # the jacobian is lambdified once and evaluated for all 
+    # substitution dictionaries dics as one stacked array,
+    # returns (eigenvalues, damping ratios) or None for every dictionary
+    jacobian = model.jacobian()
+    n = jacobian.rows
+    args = sorted(jacobian.free_symbols, key=lambda sym: sym.name)
+    arg_values = [numeric_parameter_values(args, dic) for dic in dics]
+    valid = [i for i, vals in enumerate(arg_values) if vals is not None]
+
+    res = [None] * len(dics)
+    if not valid:
+        return res
+
+    J_func = lambdify(args, list(jacobian), 'numpy')
+    cols = np.array([arg_values[i] for i in valid]).reshape((len(valid), len(args)))
+    entries = J_func(*cols.T)
+    J = np.stack([np.broadcast_to(e, (len(valid),)) for e in entries], axis=-1).reshape((len(valid), n, n))
+    finite = np.all(np.isfinite(J), axis=(1,2))
+    
+    evs = np.full((len(valid), n), np.nan, dtype=complex)
+    evs[finite] = np.linalg.eigvals(J[finite])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rhos = -evs.real/np.abs(evs)
+    
+    for k, i in enumerate(valid):
+        if finite[k]:
+            res[i] = (evs[k], rhos[k])
+    return res
+
+def symbolic_eigenvalue_report(model, dic):
+    rel = ReportElementList()
+    jacobian = model.jacobian().subs(dic)
+    if jacobian.free_symbols == set():
+        evs = [complex(v) for v in jacobian.eigenvals().keys()]
+    else:
+        evs = [v for v in jacobian.eigenvals().keys()]
+
+    for i in range(len(evs)):
+        ev = evs[i]
+        
+        if jacobian.free_symbols == set():
+            if ev.imag == 0:
+                ev = ev.real
+    
+            lamda_i = Symbol('lamda_'+ str(i+1))
+            rel += Math("$s: $v", s = lamda_i, v = "{:.3f}".format(ev)) + Newline()
+        
+            if ev.imag != 0:                        
+                rho = -ev.real/np.sqrt(ev.real**2+ev.imag**2)
+                rel += Math("$s: $v", s = Symbol("rho_"+ str(i+1)), v = "{:-3f}".format(rho)) + Newline()
+        else:
+            lamda_i = Symbol('lamda_'+ str(i+1))
+            rel += Math("$s: $v", s = lamda_i, v = ev.evalf(4)) + Newline()
+    return rel
+
 def input_output_path(input_dir, output_dir):
     input_path = Path(input_dir)
     output_path = Path(output_dir)
@@ -608,7 +735,7 @@ def produce_model_report_markdown(yaml_file_name_list, md_file_name_list):
  
 
 def report_from_yaml_str(yaml_str):
-    complete_dict = yaml.load(yaml_str)
+    complete_dict = load_yaml_str(yaml_str)
     model = Model(complete_dict)
     return report_from_model(model)
     
@@ -878,30 +1005,105 @@ def create_overview_report(model_list, target_dir_path=Path('.'),output_file_nam
 
 
 
-def generate_html_dir(src_dir, target_dir):
+def report_source_paths():
+    # the files besides the yaml records the reports are generated from,
+    # if one of them changes all reports are rebuilt,
+    # all modules of the package count, since the reports use
+    # most of them directly or through Model
+    this=Path(__file__).parents[0]
+    code_paths=sorted(this.glob('*.py'))
+    return code_paths + [gv.resources_path.joinpath(fn) for fn in ['apa.csl','buttondown.css']]
+
+def generate_html_dir(src_dir, target_dir, jobs=1, force=False, model_cache_dir=None):
 
     target_dir_path = Path(target_dir)
     src_dir_path= Path(src_dir)
     print("Targetdirectory: "+str(target_dir_path))
     
     html_dir_path = target_dir_path.joinpath("html")
+    manifest = BuildManifest(html_dir_path)
+    if steady_state_solver.cache_dir is None:
+        # keep the steady states for the next build
+        steady_state_solver.cache_dir = target_dir_path.joinpath("steady_state_cache")
+    source_paths = report_source_paths()
     
-    rec_list=[ rec  for rec in src_dir_path.glob('*.yaml')]
-    for rec in rec_list:
+    rec_list=sorted([ rec  for rec in src_dir_path.glob('*.yaml')])
+    stale_list=[
+        rec for rec in rec_list 
+        if force or not manifest.is_up_to_date(rec.stem, [rec]+source_paths, [html_dir_path.joinpath(rec.stem,"Report.html")])
+    ]
+    print("%d of %d reports are up to date" % (len(rec_list)-len(stale_list), len(rec_list)))
+
+    # resolve all dois concurrently before the reports are built one by one,
+    # the overview may parse all records again
+    failed=bibtexc.prefetch_record_dois(rec_list)
+    if failed:
+        print("%d dois could not be resolved" % len(failed))
+
+    start = time.time()
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures=[executor.submit(build_single_report,rec,html_dir_path,model_cache_dir) for rec in stale_list]
+            results=[f.result() for f in as_completed(futures)]
+    else:
+        results=[build_single_report(rec,html_dir_path,model_cache_dir) for rec in stale_list]
+    
+    print_build_summary(results, time.time()-start)
+    for rec, model, duration, error in results:
+        if error is None:
+            manifest.update(rec.stem, [rec]+source_paths)
+        else:
+            manifest.remove(rec.stem)
+    manifest.save()
+
+    # the overview depends on all records
+    overview_file_name='list_report.html'
+    if force or not manifest.is_up_to_date(overview_file_name, rec_list+source_paths, [html_dir_path.joinpath(overview_file_name)]):
+        # reuse the models parsed for the single reports, only records
+        # that could not be parsed or sent back from the workers are parsed again
+        models={rec: model for rec, model, duration, error in results}
+        ml=ModelList(models[rec] if models.get(rec) is not None else Model.from_path(rec,model_cache_dir) for rec in rec_list)
+        create_overview_report(ml,html_dir_path,overview_file_name)
+        manifest.update(overview_file_name, rec_list+source_paths)
+        manifest.save()
+
+def build_single_report(rec, html_dir_path, model_cache_dir=None):
+    # returns (path, model, duration, error) and never raises,
+    # so that one broken record does not stop the build
+    start = time.time()
+    model = None
+    error = None
+    try:
+        model = Model.from_path(rec, model_cache_dir)
+        create_single_report(rec, html_dir_path, model)
+    except Exception as e:
+        error = traceback.format_exc()
+
+    if model is not None:
         try:
-            create_single_report(rec,html_dir_path)
-        except Exception as e:
-            print("##################")
-            print("problems with file: "+str(rec))
-            print(e)
-            print("##################")
+            # the model has to be sent back from the worker process
+            pickle.dumps(model)
+        except Exception:
+            model = None
+            
+    return (rec, model, time.time()-start, error)
+
+def print_build_summary(results, total_duration):
+    failures = [(rec, error) for rec, model, duration, error in results if error is not None]
+    for rec, error in failures:
+        print("##################")
+        print("problems with file: "+str(rec))
+        print(error)
+        print("##################")
     
-
-    ml=ModelList.from_dir_path(src_dir_path)
-    create_overview_report(ml,html_dir_path,'list_report.html')
-
-def create_single_report(yaml_file_path, target_dir_path):
-    model = Model.from_path(yaml_file_path)
+    print("report build times:")
+    for rec, model, duration, error in sorted(results, key=lambda r: r[2], reverse=True):
+        print("%8.2fs %s %s" % (duration, rec.name, "FAILED" if error is not None else ""))
+    print("built %d of %d reports in %.2fs" % (len(results)-len(failures), len(results), total_duration))
+
+def create_single_report(yaml_file_path, target_dir_path, model=None):
+    if model is None:
+        model = Model.from_path(yaml_file_path)
     dir_name = yaml_file_path.stem
     #dir_name = model.bibtex_entry.key
     #if model.modelID: dir_name += "-" + model.modelID
@@ -911,6 +1113,7 @@ def create_single_report(yaml_file_path, target_dir_path):
     html_file_path= target_dir_path.joinpath(dir_name,"Report.html")
     rel = report_from_model(model) 
     rel.write_pandoc_html(html_file_path)
+    return model
 
 def generate_website():
     generate_model_run_reports()
@@ -927,6 +1130,7 @@ def render_parse():
     sources= parser.add_mutually_exclusive_group(required=True)
     sources.add_argument('-sd','--src_dir', default=None, help="The path to the directory containing the yaml files sourced by the report. Either this or -y must be present. " )
     sources.add_argument('-y', '--yaml', default=None, help="The path to the yaml file containing the description of the record. Either this or -sd must be present." )
+    parser.add_argument('-f', '--force', action='store_true', help="render the report even if the template and the yaml files did not change since the last call." )
     
     parser.epilog= Template("""Examples:\n
         ${p} report_templates/Overview_table.py -sd data/all_records  -t ${o} 
@@ -935,6 +1139,7 @@ def render_parse():
 
     com=parser.parse_args()
     print(com)
+    bibtexc.offline=com.offline
     template_path=Path(com.template)
     #reference the template in the output html filename
     fn=template_path.stem+".html"
@@ -944,18 +1149,33 @@ def render_parse():
     else:
         target_dir_path=Path(".")
 
+    manifest=BuildManifest(target_dir_path)
     if com.yaml: 
         yaml_file_path=Path(com.yaml)
-        model=Model.from_path(yaml_file_path)
-        rel=render(template_path,model)
         dir_name = yaml_file_path.stem
         html_file_path= target_dir_path.joinpath(dir_name,fn)
-        rel.write_pandoc_html(html_file_path)
+        input_paths=[template_path,yaml_file_path]+report_source_paths()
+        key=html_file_path.relative_to(target_dir_path).as_posix()
+        if com.force or not manifest.is_up_to_date(key,input_paths,[html_file_path]):
+            model=Model.from_path(yaml_file_path)
+            rel=render(template_path,model)
+            rel.write_pandoc_html(html_file_path)
+            manifest.update(key,input_paths)
+        else:
+            print(str(html_file_path)+" is up to date")
     else:
-        model_list=ModelList.from_dir_path(Path(com.src_dir))
-        rel=render(template_path,model_list)
+        src_dir_path=Path(com.src_dir)
         html_file_path= target_dir_path.joinpath(fn)
-        rel.write_pandoc_html(html_file_path)
+        input_paths=[template_path]+sorted(p for p in src_dir_path.iterdir() if p.suffix == ".yaml")+report_source_paths()
+        key=fn
+        if com.force or not manifest.is_up_to_date(key,input_paths,[html_file_path]):
+            model_list=ModelList.from_dir_path(src_dir_path)
+            rel=render(template_path,model_list)
+            rel.write_pandoc_html(html_file_path)
+            manifest.update(key,input_paths)
+        else:
+            print(str(html_file_path)+" is up to date")
+    manifest.save()
     sys.exit(0)
     
 
@@ -0,0 +1,194 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import hashlib
+import types
+from collections import OrderedDict
+
+import numpy as np
+from sympy import srepr, Basic
+
+from .helpers import get_size
+
+
+class ResultCache:
+    """Memory bounded cache of derived results, e.g. of a SmoothModelRun.
+
+    Values are stored under hashable keys, compound keys containing arrays,
+    dictionaries, sympy expressions or functions are turned into stable
+    strings by key(). The size of every value is measured by get_size, the
+    least recently used values are evicted as soon as all values together
+    exceed max_bytes (None means no limit). Values larger than max_bytes
+    are returned but not stored. The object owning the cache is not
+    counted when values (e.g. closures) refer to it.
+    """
+
+    def __init__(self, max_bytes = 256*2**20, owner = None):
+        self.max_bytes = max_bytes
+        self._not_counted = {id(self)}
+        if owner is not None:
+            self._not_counted.add(id(owner))
+        self._values = OrderedDict()
+        self._sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    @classmethod
+    def key(cls, *parts):
+        # objects without hashable content enter the key by their id,
+        # the key keeps them alive, so that the id cannot be reused by
+        # another object as long as a value is stored under the key
+        h = hashlib.sha256()
+        refs = []
+        for part in parts:
+            cls._update(h, part, {}, refs)
+        return _Key(h.hexdigest(), refs)
+
+
+    @classmethod
+    def _update(cls, h, obj, seen = None, refs = None):
+        # seen numbers the functions already hashed in the order
+        # of their first occurrence
+        if seen is None: seen = dict()
+        if refs is None: refs = []
+        if isinstance(obj, np.ndarray):
+            h.update(('array%s%s;' % (obj.dtype.str, obj.shape)).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, dict):
+            items = sorted([(str(k), k, v) for k, v in obj.items()], key = lambda item: item[0])
+            h.update(('dict%d;' % len(items)).encode())
+            for _, k, v in items:
+                cls._update(h, k, seen, refs)
+                cls._update(h, v, seen, refs)
+        elif isinstance(obj, (list, tuple)):
+            h.update(('%s%d;' % (type(obj).__name__, len(obj))).encode())
+            for item in obj:
+                cls._update(h, item, seen, refs)
+        elif isinstance(obj, Basic):
+            h.update(('sympy%s;' % srepr(obj)).encode())
+        elif isinstance(obj, types.FunctionType):
+            if id(obj) in seen.keys():
+                # recursive functions or functions used several times
+                h.update(('seen%d;' % seen[id(obj)]).encode())
+            else:
+                seen[id(obj)] = len(seen)
+                cls._update_function(h, obj, seen, refs)
+        elif isinstance(obj, (str, bytes, int, float, complex, bool, np.number, type(None))):
+            h.update(('%s%r;' % (type(obj).__name__, obj)).encode())
+        elif isinstance(obj, types.ModuleType):
+            h.update(('module%s;' % obj.__name__).encode())
+        elif isinstance(obj, (types.BuiltinFunctionType, np.ufunc)) or (isinstance(obj, type) and obj.__module__ == 'builtins'):
+            # defined once by their module
+            h.update(('builtin%s.%s;' % (getattr(obj, '__module__', None), getattr(obj, '__qualname__', obj.__name__))).encode())
+        else:
+            # no content we could hash, e.g. interpolation objects
+            refs.append(obj)
+            h.update(('id%s%d;' % (type(obj).__name__, id(obj))).encode())
+
+
+    @classmethod
+    def _update_function(cls, h, f, seen, refs):
+        # two functions are equal if they have the same code, the same
+        # default arguments and see the same values in their closures
+        # and global variables, global functions are compared in the
+        # same way
+        code = f.__code__
+        h.update(('function%s;' % code.co_name).encode())
+        names = cls._update_code(h, code, seen, refs)
+        cls._update(h, f.__defaults__, seen, refs)
+        cls._update(h, f.__kwdefaults__, seen, refs)
+        cls._update(h, [cell.cell_contents for cell in (f.__closure__ or ())], seen, refs)
+        for name in sorted(names):
+            if name in f.__globals__.keys():
+                h.update(('global%s;' % name).encode())
+                cls._update(h, f.__globals__[name], seen, refs)
+
+
+    @classmethod
+    def _update_code(cls, h, code, seen, refs):
+        # the code of nested functions (e.g. lambdas) belongs to it,
+        # returns the global names used
+        h.update(code.co_code)
+        names = set(code.co_names)
+        for c in code.co_consts:
+            if isinstance(c, types.CodeType):
+                names |= cls._update_code(h, c, seen, refs)
+            else:
+                cls._update(h, c, seen, refs)
+        return names
+
+
+    def get(self, key, default = None):
+        if key in self._values.keys():
+            self.hits += 1
+            self._values.move_to_end(key)
+            return self._values[key]
+
+        self.misses += 1
+        return default
+
+
+    def put(self, key, value):
+        self.remove(key)
+        size = get_size(value, set(self._not_counted))
+        if (self.max_bytes is not None) and (size > self.max_bytes):
+            return
+
+        self._values[key] = value
+        self._sizes[key] = size
+        self.bytes += size
+        while (self.max_bytes is not None) and (self.bytes > self.max_bytes):
+            oldest = next(iter(self._values.keys()))
+            self.remove(oldest)
+            self.evictions += 1
+
+
+    def cached(self, key, compute):
+        # the value stored under key, computed by compute() if necessary
+        if key in self._values.keys():
+            return self.get(key)
+
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+
+    def remove(self, key):
+        if key in self._values.keys():
+            del self._values[key]
+            self.bytes -= self._sizes.pop(key)
+
+
+    def clear(self):
+        self._values.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+
+    def __contains__(self, key):
+        return key in self._values.keys()
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    @property
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._values),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes}
+
+
+class _Key(str):
+    # a key of ResultCache.key() holding the objects identified by id
+    def __new__(cls, value, refs):
+        key = str.__new__(cls, value)
+        key.refs = tuple(refs)
+        return key
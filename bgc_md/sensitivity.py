@@ -0,0 +1,378 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import os
+import warnings
+from pathlib import Path
+
+import numpy as np
+from scipy.stats import qmc
+from sympy import sympify, Symbol
+from sympy.abc import _clash
+
+from .SmoothModelRunEnsemble import SmoothModelRunEnsemble
+
+
+def parameter_ranges(parameter_sets, symbols_by_type, rel_width = 0.5):
+    # ranges of the parameters given by numbers in the parameter sets
+    # (the 'values' dictionaries of Model.parameter_sets), from the
+    # smallest to the largest value, parameters with only one value
+    # vary by rel_width around it,
+    # parameters given by expressions of other parameters are left out,
+    # they are substituted and follow the varying ones
+    values = dict()
+    for par_set in parameter_sets:
+        for name, value in par_set['values'].items():
+            expr = sympify(value, locals = _clash)
+            if expr.is_number:
+                values.setdefault(name, []).append(float(expr))
+
+    symbols, bounds = [], []
+    for name in sorted(values.keys()):
+        lo, hi = min(values[name]), max(values[name])
+        if lo == hi:
+            lo, hi = sorted([lo*(1-rel_width), lo*(1+rel_width)])
+        if lo == hi:
+            # zero, no range to vary in
+            continue
+        symbols.append(symbols_by_type.get(name, Symbol(name)))
+        bounds.append([lo, hi])
+
+    return symbols, np.array(bounds, dtype = 'float64').reshape((-1, 2))
+
+
+def morris_design(nr_parameters, nr_trajectories, levels = 4, seed = 0):
+    # Morris trajectories in the unit cube, each of nr_parameters+1 points
+    # with one coordinate changed by +-delta from one point to the next,
+    # returns the points (trajectories*(nr_parameters+1), nr_parameters),
+    # the index of the changed coordinate and the step for every point
+    # but the first of each trajectory (trajectories, nr_parameters)
+    d = nr_parameters
+    delta = levels/(2*(levels-1))
+    rng = np.random.RandomState(seed)
+
+    points = np.zeros((nr_trajectories, d+1, d))
+    changed = np.zeros((nr_trajectories, d), dtype = int)
+    steps = np.zeros((nr_trajectories, d))
+    for r in range(nr_trajectories):
+        x = rng.randint(levels, size = d)/(levels-1)
+        points[r,0] = x
+        for s, i in enumerate(rng.permutation(d)):
+            up = x[i]+delta <= 1+1e-12
+            down = x[i]-delta >= -1e-12
+            step = delta if (up and (not down or rng.rand() < 0.5)) else -delta
+            x = x.copy()
+            x[i] += step
+            points[r,s+1] = x
+            changed[r,s] = i
+            steps[r,s] = step
+
+    return points.reshape((-1, d)), changed, steps
+
+
+def sobol_design(nr_parameters, nr_samples, seed = 0):
+    # Saltelli's design in the unit cube from a scrambled Sobol sequence,
+    # for every base sample the points A, B and A with the i-th coordinate
+    # from B for i = 1, ..., nr_parameters,
+    # shape (nr_samples*(nr_parameters+2), nr_parameters)
+    d = nr_parameters
+    with warnings.catch_warnings():
+        # balance properties need powers of 2 for nr_samples
+        warnings.simplefilter('ignore')
+        AB = qmc.Sobol(2*d, scramble = True, seed = seed).random(nr_samples)
+    A, B = AB[:,:d], AB[:,d:]
+
+    points = np.zeros((nr_samples, d+2, d))
+    points[:,0] = A
+    points[:,1] = B
+    for i in range(d):
+        points[:,i+2] = A
+        points[:,i+2,i] = B[:,i]
+
+    return points.reshape((-1, d))
+
+
+class SensitivityAnalysis:
+    """Global sensitivity of model diagnostics to the parameters.
+
+    The parameters parameter_symbols vary in the ranges bounds
+    (one row [lower, upper] per parameter), following a Morris design of
+    nr_samples trajectories (method = 'morris') or a Saltelli design of
+    nr_samples base samples (method = 'sobol'). The parameter values of a
+    batch of trajectories or base samples are integrated together as one
+    SmoothModelRunEnsemble, in chunks of chunk_size members on processes
+    forked workers, and only the sums the indices are computed from are
+    kept. After every batch they are written to the .npz file checkpoint
+    (if given), a run with the same checkpoint resumes from there.
+
+    diagnostics are names of ensemble diagnostics ('solution' and
+    'steady_state' per pool at the last time, 'system_age_moment' and
+    'backward_transit_time_moment' of order 1 at the last time) or pairs
+    (name, f) with f(ensemble) returning an array (members, ...).
+    """
+    diagnostic_functions = {
+        'solution': lambda ens: ens.solve()[:,-1,:],
+        'steady_state': lambda ens: ens.steady_states(),
+        'system_age_moment': lambda ens: ens.system_age_moment(1)[:,-1],
+        'backward_transit_time_moment': lambda ens: ens.backward_transit_time_moment(1)[:,-1]
+    }
+
+    def __init__(self, smooth_reservoir_model, parameter_symbols, bounds, start_values, times, diagnostics = ('system_age_moment',), method = 'sobol', nr_samples = 64, levels = 4, seed = 0, parameter_set = None, func_set = None, integrator = 'odeint', chunk_size = 64, processes = 1):
+        if parameter_set is None: parameter_set = dict()
+        if func_set is None: func_set = dict()
+        if method not in ('sobol', 'morris'):
+            raise(Exception("Unknown method '" + str(method) + "', use 'sobol' or 'morris'."))
+
+        self.model = smooth_reservoir_model
+        self.parameter_symbols = list(parameter_symbols)
+        self.bounds = np.array(bounds, dtype = 'float64').reshape((-1, 2))
+        if len(self.bounds) != len(self.parameter_symbols):
+            raise(Exception("bounds needs one row per parameter symbol."))
+        self.start_values = np.array(start_values, dtype = 'float64')
+        self.times = np.array(times, dtype = 'float64')
+        self.method = method
+        self.nr_samples = nr_samples
+        self.levels = levels
+        self.seed = seed
+        # the varying parameters are arguments, not substituted
+        self.parameter_set = {k: v for k, v in parameter_set.items() if k not in self.parameter_symbols}
+        self.func_set = func_set
+        self.integrator = integrator
+        self.chunk_size = chunk_size
+        self.processes = processes
+
+        self.diagnostics = []
+        for diagnostic in diagnostics:
+            if isinstance(diagnostic, str):
+                if diagnostic not in self.diagnostic_functions.keys():
+                    raise(Exception("Unknown diagnostic '" + diagnostic + "', available are: " + ", ".join(sorted(self.diagnostic_functions.keys()))))
+                diagnostic = (diagnostic, self.diagnostic_functions[diagnostic])
+            self.diagnostics.append(diagnostic)
+
+        self.output_names = None
+        self.nr_done = 0
+        self._sums = None
+        self._morris_design = None
+
+
+    @classmethod
+    def from_model(cls, model, combination = 0, rel_width = 0.5, **kwargs):
+        # the ranges of the parameters come from all parameter sets of
+        # model, start values, run times and the values of the parameters
+        # not varied from its model run combination number combination
+        comb = model.model_run_combinations[combination]
+        symbols, bounds = parameter_ranges(model.parameter_sets, model.symbols_by_type, rel_width)
+
+        parameter_set = dict()
+        if comb['par_set'] is not None:
+            parameter_set = {model.symbols_by_type[name]: sympify(value, locals = _clash) for name, value in comb['par_set']['values'].items()}
+
+        iv_dic = comb['IV']['values']
+        start_values = []
+        for state_v_sym in model.state_vector['expr']:
+            for name, sym in model.symbols_by_type.items():
+                if sym == state_v_sym:
+                    start_values.append(iv_dic[name])
+
+        run_time = comb['run_time']
+        times = np.arange(run_time['start'], run_time['end']+run_time['step_size'], run_time['step_size'])
+        return cls(model.reservoir_model, symbols, bounds, np.array(start_values, dtype = 'float64'), times, parameter_set = parameter_set, **kwargs)
+
+
+    @property
+    def nr_parameters(self):
+        return len(self.parameter_symbols)
+
+
+    @property
+    def block_size(self):
+        # points per trajectory or base sample
+        d = self.nr_parameters
+        return d+1 if self.method == 'morris' else d+2
+
+
+    def _morris(self):
+        # the Morris design is drawn once, the accumulation needs it again
+        if self._morris_design is None:
+            self._morris_design = morris_design(self.nr_parameters, self.nr_samples, self.levels, self.seed)
+        return self._morris_design
+
+
+    def design(self):
+        # all parameter values, shape (nr_samples*block_size, nr_parameters)
+        if self.method == 'morris':
+            unit_points, _, _ = self._morris()
+        else:
+            unit_points = sobol_design(self.nr_parameters, self.nr_samples, self.seed)
+
+        lo, hi = self.bounds[:,0], self.bounds[:,1]
+        return lo + unit_points*(hi-lo)
+
+
+    def evaluate(self, parameter_matrix):
+        # the diagnostics for the rows of parameter_matrix, flattened
+        # to shape (rows, outputs), nan where they could not be computed
+        ens = SmoothModelRunEnsemble(
+            self.model,
+            self.parameter_symbols,
+            parameter_matrix,
+            self.start_values,
+            self.times,
+            parameter_set = self.parameter_set,
+            func_set = self.func_set,
+            integrator = self.integrator,
+            chunk_size = self.chunk_size,
+            processes = self.processes
+        )
+
+        m = len(parameter_matrix)
+        outputs, names = [], []
+        with np.errstate(all = 'ignore'):
+            for name, f in self.diagnostics:
+                vals = np.array(f(ens), dtype = 'float64').reshape((m, -1))
+                outputs.append(vals)
+                if vals.shape[1] == 1:
+                    names.append(name)
+                else:
+                    names += [name + '[' + str(j) + ']' for j in range(vals.shape[1])]
+
+        if self.output_names is None:
+            self.output_names = names
+        return np.concatenate(outputs, axis = 1)
+
+
+    ##### accumulation #####
+
+
+    def _accumulate(self, Y, first_block):
+        # adds the sums of the blocks of outputs Y (blocks, block_size, outputs),
+        # blocks with non finite values are left out for the affected outputs
+        d = self.nr_parameters
+        valid = np.all(np.isfinite(Y), axis = 1)
+        Y = np.where(valid[:,None,:], Y, 0)
+        q = Y.shape[2]
+        if self._sums is None:
+            self._sums = self._empty_sums(q)
+        sums = self._sums
+
+        sums['count'] += valid.sum(0)
+        if self.method == 'morris':
+            _, changed, steps = self._morris()
+            blocks = np.arange(first_block, first_block+len(Y))
+            changed, steps = changed[blocks], steps[blocks]
+            # elementary effects in units of the parameter ranges
+            EE = (Y[:,1:,:]-Y[:,:-1,:])/steps[:,:,None]
+            for s in range(d):
+                np.add.at(sums['ee'], changed[:,s], EE[:,s,:])
+                np.add.at(sums['abs_ee'], changed[:,s], np.abs(EE[:,s,:]))
+                np.add.at(sums['ee2'], changed[:,s], EE[:,s,:]**2)
+        else:
+            fA, fB, fAB = Y[:,0,:], Y[:,1,:], Y[:,2:,:]
+            sums['f'] += (fA+fB).sum(0)
+            sums['f2'] += (fA**2+fB**2).sum(0)
+            # Saltelli 2010 for the first order, Jansen for the total indices
+            sums['first'] += (fB[:,None,:]*(fAB-fA[:,None,:])).sum(0)
+            sums['total'] += ((fA[:,None,:]-fAB)**2).sum(0)
+
+
+    def _empty_sums(self, nr_outputs):
+        d, q = self.nr_parameters, nr_outputs
+        if self.method == 'morris':
+            return {'count': np.zeros((q,)), 'ee': np.zeros((d, q)), 'abs_ee': np.zeros((d, q)), 'ee2': np.zeros((d, q))}
+        return {'count': np.zeros((q,)), 'f': np.zeros((q,)), 'f2': np.zeros((q,)), 'first': np.zeros((d, q)), 'total': np.zeros((d, q))}
+
+
+    @property
+    def indices(self):
+        # Morris: mean (mu), mean of the absolute values (mu_star) and
+        # standard deviation (sigma) of the elementary effects,
+        # Sobol: first order (S1) and total (ST) indices,
+        # every index has the shape (parameters, outputs)
+        if self._sums is None:
+            return None
+
+        sums = self._sums
+        with np.errstate(all = 'ignore'):
+            n = sums['count']
+            if self.method == 'morris':
+                mu = sums['ee']/n
+                res = {'mu': mu,
+                       'mu_star': sums['abs_ee']/n,
+                       'sigma': np.sqrt(np.maximum(sums['ee2']/n-mu**2, 0)*n/(n-1))}
+            else:
+                mean = sums['f']/(2*n)
+                var = sums['f2']/(2*n)-mean**2
+                res = {'S1': sums['first']/n/var,
+                       'ST': sums['total']/(2*n)/var}
+
+        res['parameters'] = [str(s) for s in self.parameter_symbols]
+        res['outputs'] = list(self.output_names)
+        return res
+
+
+    ##### running and checkpoints #####
+
+
+    def run(self, checkpoint = None, batch_size = 16, max_batches = None):
+        # evaluates the design in batches of batch_size trajectories or
+        # base samples and returns the indices,
+        # with max_batches the run stops early and can be resumed
+        if checkpoint is not None and Path(checkpoint).exists():
+            self.load_checkpoint(checkpoint)
+
+        X = self.design()
+        k = self.block_size
+        nr_batches = 0
+        while self.nr_done < self.nr_samples:
+            if (max_batches is not None) and (nr_batches >= max_batches):
+                break
+            stop = min(self.nr_done+batch_size, self.nr_samples)
+            Y = self.evaluate(X[self.nr_done*k:stop*k])
+            self._accumulate(Y.reshape((stop-self.nr_done, k, -1)), self.nr_done)
+            self.nr_done = stop
+            nr_batches += 1
+            if checkpoint is not None:
+                self.save_checkpoint(checkpoint)
+
+        return self.indices
+
+
+    def _settings(self):
+        # what a checkpoint has to agree with to be resumed
+        return {'method': np.array(self.method),
+                'nr_samples': np.array(self.nr_samples),
+                'levels': np.array(self.levels),
+                'seed': np.array(self.seed),
+                'bounds': self.bounds,
+                'parameters': np.array([str(s) for s in self.parameter_symbols]),
+                'diagnostics': np.array([name for name, _ in self.diagnostics])}
+
+
+    def save_checkpoint(self, filename):
+        data = self._settings()
+        data['nr_done'] = np.array(self.nr_done)
+        if self._sums is not None:
+            data['output_names'] = np.array(self.output_names)
+            data.update({'sum_' + key: value for key, value in self._sums.items()})
+
+        # write to a temporary file first, an interrupted run
+        # must not leave a broken checkpoint
+        path = Path(filename)
+        tmp_path = path.with_name(path.name + '.%d.tmp' % os.getpid())
+        with tmp_path.open('wb') as f:
+            np.savez(f, **data)
+        os.replace(str(tmp_path), str(path))
+
+
+    def load_checkpoint(self, filename):
+        with np.load(str(filename)) as data:
+            for key, value in self._settings().items():
+                if key not in data.files or data[key].shape != value.shape or not np.all(data[key] == value):
+                    raise(Exception("The checkpoint " + str(filename) + " belongs to a different analysis ('" + key + "' differs)."))
+
+            self.nr_done = int(data['nr_done'])
+            if 'output_names' in data.files:
+                self.output_names = [str(name) for name in data['output_names']]
+                self._sums = {key[len('sum_'):]: data[key].copy() for key in data.files if key.startswith('sum_')}
+            else:
+                self.output_names = None
+                self._sums = None
@@ -0,0 +1,190 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+
+import hashlib
+import multiprocessing
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+from scipy.optimize import root
+from sympy import solve, srepr, sympify, lambdify, Matrix, Float, nan, zoo, oo
+
+
+def _solve(rhs, state_vector):
+    # runs in the worker processes
+    return solve(rhs, state_vector, dict=True)
+
+
+class SteadyStateSolver:
+    """Steady states of model right hand sides.
+
+    Symbolic solving is done by sympy in a pool of worker processes and
+    given up after timeout seconds. All results, including timeouts, are
+    cached in memory and, if cache_dir is given, in pickle files on disk,
+    keyed by a hash of the right hand side, the state vector and the
+    parameter values. If symbolic solving fails for a parameter set the
+    steady states are searched numerically.
+    """
+
+    def __init__(self, timeout=10, processes=1, cache_dir=None):
+        self.timeout = timeout
+        self.processes = processes
+        self.cache_dir = cache_dir
+        self._pool = None
+        self._results = {}
+
+
+    def formal_steady_states(self, rhs, state_vector):
+        """Symbolic steady states as list of dictionaries, None after a timeout."""
+        return self._symbolic(rhs, state_vector, {})
+
+
+    def parameter_set_steady_states(self, rhs, state_vector, par_values, time_symbol=None, time=0):
+        """Steady states for the parameter values par_values.
+
+        The formal steady states are used if they are known, otherwise
+        the system with the parameter values substituted is solved
+        symbolically and, if that times out, numerically. The numerical
+        steady states of non-autonomous systems are those of the system
+        frozen at the given time.
+        """
+        formal = self._cached(self._key(rhs, state_vector, {}))
+        if formal is not None and formal['status'] == 'solved':
+            res = []
+            for ss in formal['result']:
+                ss_par = {sv: sympify(val).subs(par_values) for sv, val in ss.items()}
+                if all(not val.has(nan, zoo, oo, -oo) for val in ss_par.values()):
+                    res.append(ss_par)
+            return res
+
+        res = self._symbolic(rhs.subs(par_values), state_vector, par_values)
+        if res is not None:
+            return res
+
+        return self.numeric_steady_states(rhs, state_vector, par_values, time_symbol, time)
+
+
+    def numeric_steady_states(self, rhs, state_vector, par_values, time_symbol=None, time=0, nr_starts=20, seed=0):
+        """Steady states found by root finding from several start vectors.
+
+        If the right hand side depends on time_symbol, the steady states
+        of the system frozen at the given time are returned. Without
+        time_symbol no steady states of non-autonomous systems are searched.
+        """
+        if time_symbol is not None and time_symbol in Matrix(rhs).free_symbols:
+            par_values = dict(par_values)
+            par_values[time_symbol] = time
+
+        # other start vectors may find other steady states
+        key = self._key(rhs, state_vector, par_values, 'numeric-%d-%d' % (nr_starts, seed))
+        cached = self._cached(key)
+        if cached is not None:
+            return [dict(ss) for ss in cached['result']]
+
+        rhs_par = Matrix(rhs)
+        for _ in range(len(par_values)+1):
+            rhs_par = rhs_par.subs(par_values)
+            if rhs_par.free_symbols <= set(state_vector): break
+
+        res = []
+        # no steady states are searched if rhs_par still depends on
+        # other symbols, e.g. on time if no time_symbol is given
+        if rhs_par.free_symbols <= set(state_vector):
+            n = len(state_vector)
+            F = lambdify([list(state_vector)], list(rhs_par), 'numpy')
+            f = lambda x: np.array(F(x), dtype='float64')
+
+            rng = np.random.RandomState(seed)
+            starts = [np.ones(n)*10.0**e for e in (-2, 0, 2)]
+            starts += [10.0**rng.uniform(-2, 2, n) for _ in range(nr_starts-len(starts))]
+
+            solutions = []
+            with np.errstate(all='ignore'):
+                for x0 in starts:
+                    sol = root(f, x0)
+                    if not sol.success or not np.all(np.isfinite(sol.x)): continue
+                    if np.max(np.abs(f(sol.x))) > 1e-8*max(1, np.max(np.abs(sol.x))): continue
+                    if any(np.allclose(sol.x, x, rtol=1e-6, atol=1e-9) for x in solutions): continue
+                    solutions.append(sol.x)
+
+            res = [{sv: Float(x[i]) for i, sv in enumerate(state_vector)} for x in solutions]
+
+        self._store(key, {'status': 'solved', 'result': res})
+        return [dict(ss) for ss in res]
+
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+    def _symbolic(self, rhs, state_vector, par_values):
+        key = self._key(rhs, state_vector, par_values)
+        cached = self._cached(key)
+        if cached is not None:
+            if cached['status'] == 'solved':
+                return [dict(ss) for ss in cached['result']]
+            if cached['timeout'] >= self.timeout:
+                return None
+
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        try:
+            res = self._pool.apply_async(_solve, (rhs, state_vector)).get(self.timeout)
+        except multiprocessing.TimeoutError:
+            # the worker is still busy, get rid of it
+            self.close()
+            self._store(key, {'status': 'timeout', 'timeout': self.timeout})
+            return None
+
+        self._store(key, {'status': 'solved', 'result': res})
+        return [dict(ss) for ss in res]
+
+
+    @staticmethod
+    def _key(rhs, state_vector, par_values, kind='symbolic'):
+        h = hashlib.sha256()
+        h.update(kind.encode())
+        h.update(srepr(rhs).encode())
+        h.update(srepr(tuple(state_vector)).encode())
+        for k, v in sorted([(str(k), str(v)) for k, v in par_values.items()]):
+            h.update(('%s=%s;' % (k, v)).encode())
+        return h.hexdigest()
+
+
+    def _cached(self, key):
+        if key in self._results.keys():
+            return self._results[key]
+
+        if self.cache_dir is not None:
+            path = Path(self.cache_dir).joinpath(key + '.pickle')
+            if path.exists():
+                try:
+                    with path.open('rb') as f:
+                        self._results[key] = pickle.load(f)
+                    return self._results[key]
+                except Exception:
+                    # unreadable cache files are recomputed
+                    pass
+
+        return None
+
+
+    def _store(self, key, result):
+        self._results[key] = result
+        if self.cache_dir is None:
+            return
+
+        cache_dir = Path(self.cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        path = cache_dir.joinpath(key + '.pickle')
+        tmp_path = cache_dir.joinpath(key + '.%d.tmp' % os.getpid())
+        with tmp_path.open('wb') as f:
+            pickle.dump(result, f)
+        os.replace(str(tmp_path), str(path))
+
+
+default_solver = SteadyStateSolver()
@@ -122,6 +122,24 @@ class SlowTestReportGeneration(InDirTest):
         
         res=run(['generate_website','-s',src_dir_name],check=True )
     
+    def test_commandline_generate_website_parallel(self):
+        # the same as above but with the reports rendered by two processes
+        d=defaults() 
+        sp=d['paths']['tested_records']
+        src_dir_name='localDataBase'
+        src_dir_path=Path(src_dir_name)
+        src_dir_path.mkdir()
+        rec_list=sorted([ rec  for rec in sp.glob('*.yaml')])[2:5]
+        
+        for rec in rec_list:
+            shutil.copy(sp.joinpath(rec).as_posix(),src_dir_name)
+        
+        res=run(['generate_website','-s',src_dir_name,'-j','2'],check=True )
+        html_dir_path=Path('.').joinpath('html')
+        for rec in rec_list:
+            self.assertTrue(html_dir_path.joinpath(rec.stem,'Report.html').exists())
+        self.assertTrue(html_dir_path.joinpath('list_report.html').exists())
+    
 #    @unittest.skip("function under test calls report_from_yaml_str which is commented out")
 #    def test_report_html_presence(self):
 #    # fixme
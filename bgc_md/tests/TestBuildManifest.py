@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+from pathlib import Path
+
+from testinfrastructure.InDirTest import InDirTest
+from bgc_md.build_manifest import BuildManifest
+
+
+class TestBuildManifest(InDirTest):
+    def setUp(self):
+        self.rec = Path('rec.yaml')
+        self.rec.write_text('name: a\n')
+        self.template = Path('template.py')
+        self.template.write_text('def template(model): pass\n')
+        self.output = Path('html').joinpath('rec', 'Report.html')
+        self.output.parent.mkdir(parents=True)
+        self.output.write_text('<html></html>')
+
+
+    def test_up_to_date(self):
+        inputs = [self.rec, self.template]
+        manifest = BuildManifest('html')
+        self.assertFalse(manifest.is_up_to_date('rec', inputs, [self.output]))
+
+        manifest.update('rec', inputs)
+        manifest.save()
+        self.assertTrue(Path('html').joinpath(BuildManifest.file_name).exists())
+        
+        # a new manifest reads the saved one
+        manifest = BuildManifest('html')
+        self.assertTrue(manifest.is_up_to_date('rec', inputs, [self.output]))
+        
+        # changed inputs
+        self.rec.write_text('name: b\n')
+        self.assertFalse(manifest.is_up_to_date('rec', inputs, [self.output]))
+        manifest.update('rec', inputs)
+        self.assertTrue(manifest.is_up_to_date('rec', inputs, [self.output]))
+
+        # missing outputs
+        self.output.unlink()
+        self.assertFalse(manifest.is_up_to_date('rec', inputs, [self.output]))
+
+        manifest.remove('rec')
+        self.assertFalse(manifest.is_up_to_date('rec', inputs))
+
+
+    def test_broken_manifest(self):
+        Path('html').joinpath(BuildManifest.file_name).write_text('{not json')
+        manifest = BuildManifest('html')
+        self.assertEqual(manifest.entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from sympy import symbols
+
+from testinfrastructure.InDirTest import InDirTest
+import bgc_md.tests.exampleSmoothReservoirModels as ESRM
+from bgc_md.SmoothModelRun import SmoothModelRun
+from bgc_md.field_store import FieldStore
+from bgc_md.helpers_reservoir import load_csv
+
+
+class TestFieldStore(InDirTest):
+    def test_append_and_read(self):
+        times = np.linspace(0, 1, 4)
+        field = np.arange(10*4*3, dtype = 'float64').reshape((10, 4, 3))
+        ages = np.linspace(0, 9, 10)
+
+        store = FieldStore.create('field', ['age', 'time', 'pool'], {'time': times, 'pool': ['x', 'y', 'system']}, chunk_rows = 4)
+        store.append(field[:3], ages[:3])
+        self.assertEqual(len(list(Path('field').glob('chunk_*.npy'))), 0)
+        store.append(field[3:7], ages[3:7])
+        # one full chunk is written, the other rows are buffered
+        self.assertEqual(len(list(Path('field').glob('chunk_*.npy'))), 1)
+        self.assertEqual(store.shape, (7, 4, 3))
+        self.assertTrue(np.all(store[2:6] == field[2:6]))
+
+        # readers see the flushed rows
+        store.flush()
+        self.assertEqual(FieldStore.open('field').shape, (7, 4, 3))
+
+        # continue appending later
+        store.close()
+        store = FieldStore.open('field', 'a')
+        store.append(field[7:], ages[7:])
+        store.close()
+
+        store = FieldStore.open('field')
+        self.assertEqual(store.shape, field.shape)
+        self.assertEqual(store.dims, ['age', 'time', 'pool'])
+        self.assertTrue(np.all(store.coords['age'] == ages))
+        self.assertTrue(np.all(store.coords['time'] == times))
+        self.assertEqual(list(store.coords['pool']), ['x', 'y', 'system'])
+        self.assertTrue(np.all(store.to_array() == field))
+
+        # lazy partial reads
+        self.assertTrue(np.all(store[5] == field[5]))
+        self.assertTrue(np.all(store[-1, :, 2] == field[-1, :, 2]))
+        self.assertTrue(np.all(store[1:9:3, ::2, -1] == field[1:9:3, ::2, -1]))
+        self.assertTrue(np.all(store[[8, 1, 4]] == field[[8, 1, 4]]))
+        self.assertTrue(np.all(store[::-1] == field[::-1]))
+        for index in [np.s_[:, [0, 2], [1, 2]], np.s_[[7, 9], 1:3, [0, 2]], np.s_[5, :, [0, 2]], np.s_[..., 1], np.s_[np.arange(10) > 6, 2]]:
+            self.assertTrue(np.all(store[index] == field[index]))
+        self.assertEqual(len(store._chunks), 3)
+
+        with self.assertRaises(Exception):
+            store.append(field[:1], ages[:1])
+        with self.assertRaises(Exception):
+            FieldStore.open('no_field')
+
+
+    def test_read_memory(self):
+        # the index is applied to every chunk, not to all rows at once
+        field = np.random.RandomState(0).rand(200, 200, 6)
+        with FieldStore.create('field', ['age', 'time', 'pool'], {'time': np.arange(200), 'pool': np.arange(6)}, chunk_rows = 16) as store:
+            store.append(field, np.arange(200))
+
+        store = FieldStore.open('field')
+        tracemalloc.start()
+        res = store[:, ::10, -1]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertTrue(np.all(res == field[:, ::10, -1]))
+        self.assertTrue(peak < field.nbytes/10)
+
+
+    def test_smooth_model_run(self):
+        symbs = symbols("t, k_01,k_10,k_0o,k_1o")
+        t, k_01,k_10,k_0o,k_1o = symbs
+        srm = ESRM.critics(symbs)
+        pardict = {k_0o: 0.01, k_1o: 0.08, k_01: 0.09, k_10: 1}
+        smr = SmoothModelRun(srm, pardict, np.array([0.001, 0.001]), np.linspace(0, 10, 11))
+        ages = np.linspace(0, 10, 11)
+
+        store = smr.pools_and_system_density_store('density', ages, chunk_rows = 4)
+        p = smr.pool_age_densities_func()(ages)
+        self.assertEqual(store.shape, (len(ages), len(smr.times), 3))
+        self.assertTrue(np.allclose(store[:, :, :2], p))
+        self.assertTrue(np.allclose(store[:, :, 2], p.sum(2)))
+
+        smr.save_pools_and_system_density_store('density_2', p, p.sum(2), ages, chunk_rows = 5)
+        self.assertTrue(np.allclose(smr.load_store('density_2').to_array(), store.to_array(), rtol = 1e-06))
+
+        # the same values as in the csv file, without rounding
+        smr.save_pools_and_system_density_csv('density.csv', p, p.sum(2), ages)
+        self.assertTrue(np.allclose(load_csv('density.csv')[:,3], store.to_array().reshape((-1,)), atol = 1e-8))
+
+        sol = smr.solve()
+        smr.save_pools_and_system_value_store('values', sol, sol.sum(1))
+        self.assertTrue(np.all(smr.load_store('values')[:, :2] == sol))
+        smr.save_value_store('value', sol[:, 0])
+        self.assertTrue(np.all(smr.load_store('value').to_array() == sol[:, 0]))
+        smr.save_density_store('system_density', p.sum(2), ages)
+        self.assertTrue(np.all(smr.load_store('system_density').to_array() == p.sum(2)))
+
+        smr.times = smr.times[:-1]
+        with self.assertRaises(Exception):
+            smr.load_store('values')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,7 @@ matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from sympy import Matrix, symbols, sin, Piecewise, DiracDelta
 
-from bgc_md.helpers_reservoir import factor_out_from_matrix, parse_input_function, melt, MH_sampling, stride
+from bgc_md.helpers_reservoir import factor_out_from_matrix, parse_input_function, melt, MH_sampling, stride, numsol_symbolic_system, numerical_jacobian, jacobian_sparsity, exp_sinh_nodes, fork_map, tabulated_inverse_CDF, MH_sampling_chains, generalized_inverse_CDF, generalized_inverse_CDF_vectorized
 
 class TestHelpers_reservoir(unittest.TestCase):
 
@@ -25,6 +25,130 @@ class TestHelpers_reservoir(unittest.TestCase):
         self.assertEqual(jump_times, [])
 
 
+    def test_numerical_jacobian(self):
+        x, y, t, k = symbols('x y t k')
+        rhs = Matrix([-k*x*y, k*x*y - sin(t)*y])
+        jac = numerical_jacobian([x, y], t, rhs, {k: 2}, {}, [0, 10])
+        self.assertTrue(np.allclose(jac(np.array([1, 3]), 1), [[-6, -2], [6, 2-np.sin(1)]]))
+        # beyond the last time the last time is used
+        self.assertTrue(np.allclose(jac(np.array([1, 3]), 12), jac(np.array([1, 3]), 10)))
+
+        rhs = Matrix([-k*x, k*x - y])
+        self.assertTrue(np.all(jacobian_sparsity([x, y], rhs) == [[True, False], [True, True]]))
+
+        rhs = Matrix([Piecewise((-x, t<1), (-2*x, True)), -y])
+        self.assertIsNone(numerical_jacobian([x, y], t, rhs, {}, {}, [0, 10]))
+
+
+    def test_numsol_symbolic_system_methods(self):
+        # a stiff linear system
+        x, y, t = symbols('x y t')
+        rhs = Matrix([-1000*x + y, 10*x - 0.1*y + 1])
+        start_values = np.array([1.0, 1.0])
+        times = np.linspace(0, 10, 11)
+        ref = numsol_symbolic_system([x, y], t, rhs, {}, {}, start_values, times)
+        for method in ['odeint', 'BDF', 'Radau', 'LSODA']:
+            for use_jacobian in [False, True]:
+                soln = numsol_symbolic_system([x, y], t, rhs, {}, {}, start_values, times, method, use_jacobian)
+                self.assertEqual(soln.shape, (len(times), 2))
+                self.assertTrue(np.allclose(soln, ref, rtol = 1e-05))
+
+        with self.assertRaises(Exception):
+            numsol_symbolic_system([x, y], t, rhs, {}, {}, start_values, times, 'unknown')
+
+
+    def test_numsol_symbolic_system_dense_output(self):
+        x, y, t = symbols('x y t')
+        rhs = Matrix([-x + sin(t), x - 0.5*y])
+        start_values = np.array([1.0, 2.0])
+        times = np.linspace(0, 10, 11)
+        fine_times = np.linspace(0, 10, 101)
+        ref = numsol_symbolic_system([x, y], t, rhs, {}, {}, start_values, fine_times)
+        for method in ['odeint', 'BDF', 'RK45']:
+            sol = numsol_symbolic_system([x, y], t, rhs, {}, {}, start_values, times, method, dense_output = True)
+            self.assertEqual(sol(fine_times).shape, (len(fine_times), 2))
+            self.assertTrue(np.allclose(sol(fine_times), ref, rtol = 1e-06, atol = 1e-06))
+            self.assertTrue(np.allclose(sol(2.55), sol(np.array([2.55]))[0]))
+
+        sol = numsol_symbolic_system([x, y], t, rhs, {}, {}, start_values, times[:1], dense_output = True)
+        self.assertTrue(np.all(sol(0) == start_values))
+
+
+    def test_exp_sinh_nodes(self):
+        nodes, weights = exp_sinh_nodes()
+        self.assertTrue(np.allclose(weights.dot(np.exp(-nodes)), 1, rtol = 1e-8))
+        self.assertTrue(np.allclose(weights.dot(nodes*np.exp(-nodes/1000)), 1e6, rtol = 1e-8))
+        self.assertTrue(np.allclose(weights.dot(1/(1+nodes)**2), 1, rtol = 1e-6))
+
+
+    def test_fork_map(self):
+        offset = np.arange(3)
+        # the function is not picklable, it is inherited by the workers
+        f = lambda x: x**2 + offset.sum()
+        self.assertEqual(fork_map(f, range(5), 2), [3, 4, 7, 12, 19])
+        self.assertEqual(fork_map(f, range(5)), [3, 4, 7, 12, 19])
+
+
+    def test_generalized_inverse_CDF_vectorized(self):
+        # exponential distributions with different rates
+        rates = np.array([1, 0.1, 0.01, 2, 1])
+        us = np.array([0.5, 0.5, 0.9, 0.1, np.nan])
+        calls = []
+        def CDF(ages, indices):
+            calls.append(len(ages))
+            return 1-np.exp(-rates[indices]*ages)
+
+        res = generalized_inverse_CDF_vectorized(CDF, us)
+        ref = [generalized_inverse_CDF(lambda a: 1-np.exp(-rates[i]*a), us[i]) for i in range(4)]
+        self.assertTrue(np.allclose(res[:4], ref, rtol = 1e-6))
+        self.assertTrue(np.isnan(res[4]))
+
+        # warm started close to the solutions only few evaluations are needed
+        cold_calls = len(calls)
+        calls.clear()
+        res_warm = generalized_inverse_CDF_vectorized(CDF, us, start = res*1.01)
+        self.assertTrue(np.allclose(res_warm[:4], ref, rtol = 1e-6))
+        self.assertTrue(len(calls) < cold_calls)
+
+        # the CDF reaches the level already at age 0, or never
+        res = generalized_inverse_CDF_vectorized(lambda ages, indices: 0.5+0*ages, [0.3, 0.7])
+        self.assertEqual(res[0], 0)
+        self.assertTrue(np.isnan(res[1]))
+
+
+    def test_tabulated_inverse_CDF(self):
+        ages = np.array([1, 2, 3, 4])
+        CDF_values = np.array([0.1, 0.5, 0.5, 0.9])
+        res = tabulated_inverse_CDF(ages, CDF_values, [0, 0.05, 0.3, 0.7, 0.95])
+        self.assertTrue(np.allclose(res, [0, 0.5, 1.5, 3.5, np.inf]))
+
+
+    def test_MH_sampling_chains(self):
+        rng = np.random.default_rng(0)
+        PDF = lambda x: np.exp(-x/2)/2
+        calls = []
+        def counting_PDF(x):
+            calls.append(len(x))
+            return PDF(x)
+
+        xs, nr_calls = MH_sampling_chains(10000, counting_PDF, 20, rng = rng)
+        self.assertEqual(xs.shape, (10000,))
+        self.assertEqual(nr_calls, len(calls))
+        self.assertEqual(set(calls), set([20]))
+        self.assertTrue(np.all(xs > 0))
+        self.assertTrue(abs(xs.mean()-2) < 0.5)
+
+        # short chains from a common start far out are biased,
+        # a burn-in period or spread start values remove the bias
+        xs, _ = MH_sampling_chains(2000, PDF, 100, start = 50.0, rng = rng)
+        self.assertTrue(xs.mean() > 4)
+        xs, nr_calls = MH_sampling_chains(2000, PDF, 100, start = 50.0, rng = rng, burn_in = 1000)
+        self.assertEqual(nr_calls, 1+1000+20)
+        self.assertTrue(abs(xs.mean()-2) < 0.3)
+        xs, _ = MH_sampling_chains(2000, PDF, 100, start = rng.exponential(2, size = 100), rng = rng)
+        self.assertTrue(abs(xs.mean()-2) < 0.3)
+
+
     def test_factor_out_from_matrix(self):
         gamma, k_1 = symbols('gamma k_1')
         M = Matrix([[12*gamma*k_1, 0], [3*gamma**2, 15*gamma]])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+import os
+
+import numpy as np
+from sympy import symbols, Matrix, sin, exp, Function
+
+from testinfrastructure.InDirTest import InDirTest
+from bgc_md.lambdify_cache import LambdifyCache
+
+
+class TestLambdifyCache(InDirTest):
+
+    def setUp(self):
+        self.x, self.y, self.t, self.k = symbols('x y t k')
+        x, y, t, k = self.x, self.y, self.t, self.k
+        self.f = Function('f')
+        self.expr = Matrix([[-k*x*sin(t)], [k*x - exp(-y) + self.f(t)]])
+        self.args = (x, y, t)
+
+
+    def test_hits_and_misses(self):
+        cache = LambdifyCache()
+        k = self.k
+
+        F1 = cache.lambdify(self.args, self.expr, {k: 2}, {'f': lambda t: 1})
+        F2 = cache.lambdify(self.args, self.expr, {k: 2}, {'f': lambda t: 1})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertTrue(np.allclose(F1(1, 2, 3), F2(1, 2, 3)))
+        self.assertTrue(np.allclose(F1(1, 2, 3).reshape((2,)), [-2*np.sin(3), 2-np.exp(-2)+1]))
+
+        # a different parameter set gives a different function
+        F3 = cache.lambdify(self.args, self.expr, {k: 3}, {'f': lambda t: 1})
+        self.assertEqual(cache.misses, 2)
+        self.assertTrue(np.allclose(F3(1, 2, 3).reshape((2,)), [-3*np.sin(3), 3-np.exp(-2)+1]))
+
+        # func_set callables are bound anew on a hit
+        F4 = cache.lambdify(self.args, self.expr, {k: 2}, {'f': lambda t: t})
+        self.assertEqual(cache.hits, 2)
+        self.assertTrue(np.allclose(F4(1, 2, 3).reshape((2,)), [-2*np.sin(3), 2-np.exp(-2)+3]))
+        self.assertTrue(np.allclose(F1(1, 2, 3).reshape((2,)), [-2*np.sin(3), 2-np.exp(-2)+1]))
+
+
+    def test_lru_eviction(self):
+        cache = LambdifyCache(maxsize = 2)
+        x, k = self.x, self.k
+        for val in [1, 2, 1, 3]:
+            cache.lambdify((x,), k*x, {k: val})
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # 2 was least recently used
+        cache.lambdify((x,), k*x, {k: 1})
+        cache.lambdify((x,), k*x, {k: 2})
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+
+    def test_persistence(self):
+        cache = LambdifyCache(cache_dir = 'lambdify_cache')
+        k = self.k
+        F1 = cache.lambdify(self.args, self.expr, {k: 2}, {'f': lambda t: 1})
+        self.assertEqual(len(os.listdir('lambdify_cache')), 1)
+
+        # a fresh cache, e.g. in another process, reads the code from disk
+        cache = LambdifyCache(cache_dir = 'lambdify_cache')
+        F2 = cache.lambdify(self.args, self.expr, {k: 2}, {'f': lambda t: 1})
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertTrue(np.allclose(F1(1, 2, 3), F2(1, 2, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
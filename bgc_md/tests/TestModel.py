@@ -3,6 +3,8 @@
 import unittest
 import sys
 import yaml
+import shutil
+from pathlib import Path
 from sympy import Symbol, Matrix, var, sin, cos, Matrix, lambdify, symbols, MatrixSymbol, diag, Eq, simplify
 import numpy as np
 import matplotlib
@@ -11,10 +13,12 @@ import matplotlib.pyplot as plt
 
 from bgc_md.helpers import  retrieve_this_or_that
 from bgc_md.yaml_creator_mod import example_yaml_string_list
-from bgc_md.Model import Model, load_bibtex_entry, load_abstract, load_further_references, load_reviews, load_sections_and_titles, load_df, load_expressions_and_symbols, section_subdict, load_model_run_data, load_parameter_sets, load_initial_values, check_parameter_set_valid, check_parameter_sets_valid, check_parameter_set_complete, check_initial_values_set_valid, check_initial_values_complete, load_run_times, load_model_run_combinations
+from bgc_md.Model import Model, load_bibtex_entry, load_abstract, load_further_references, load_reviews, load_sections_and_titles, load_df, load_expressions_and_symbols, load_dependency_graph, section_subdict, load_model_run_data, load_parameter_sets, load_initial_values, check_parameter_set_valid, check_parameter_sets_valid, check_parameter_set_complete, check_initial_values_set_valid, check_initial_values_complete, load_run_times, load_model_run_combinations
 from bgc_md.Exceptions import ModelInitializationException
 from bgc_md.ModelList import ModelList
+import bgc_md.bibtexc as bibtexc
 from bgc_md.bibtexc import BibtexEntry, DoiNotFoundException, online_entry
+from bgc_md.reports import defaults
 from bgc_md.SmoothModelRun import SmoothModelRun 
 from bgc_md.SmoothReservoirModel import SmoothReservoirModel 
 from testinfrastructure.InDirTest import InDirTest
@@ -165,6 +169,32 @@ class TestModel(InDirTest):
         with self.assertRaises(DoiNotFoundException):
             bibtex_entry = load_bibtex_entry(complete_dict)
 
+    def test_offline_tested_records(self):
+        # offline and with an empty store records with dois load without references
+        old_store, old_offline = bibtexc.bibliography_store, bibtexc.offline
+        bibtexc.bibliography_store = bibtexc.BibliographyStore('bibliography.jsonl')
+        bibtexc.offline = True
+        try:
+            sp = defaults()['paths']['tested_records']
+            model = Model.from_path(sp.joinpath('Potter1993GlobalBiogeochmemCy.yaml'))
+            self.assertIsNone(model.bibtex_entry)
+            self.assertTrue(model.parameter_sets)
+            self.assertTrue(all(par_set['bibtex_entry'] is None for par_set in model.parameter_sets))
+
+            model = Model.from_path(sp.joinpath('Williams2005GCB.yaml'))
+            self.assertEqual(model.further_references[0]['doi'], '10.1016/j.agrformet.2009.05.002')
+            self.assertIsNone(model.further_references[0]['bibtex_entry'])
+
+            # the abstract from the yaml file is still used
+            yaml_file_path = Path('Potter1993.yaml')
+            shutil.copy(sp.joinpath('Potter1993GlobalBiogeochmemCy.yaml').as_posix(), yaml_file_path.as_posix())
+            with yaml_file_path.open('a') as f:
+                f.write('\nabstract: "An abstract."\n')
+            model = Model.from_path(yaml_file_path)
+            self.assertEqual(model.abstract, 'An abstract.')
+        finally:
+            bibtexc.bibliography_store, bibtexc.offline = old_store, old_offline
+
     def test_load_abstract(self):
         # test yaml abstract over bibtex abstract and correction of special terms
         yaml_str = """\
@@ -1462,6 +1492,38 @@ class TestModel(InDirTest):
         res=model_0.find_keys_used_in_key("state_vector_derivative")
         print(res)
 
+    def test_load_dependency_graph(self):
+        yaml_str = """\
+        model:
+            - environmental_paramters: 
+                - Ti
+                - f
+            - components:
+                - b:
+                    exprs: b = Matrix(3,1, [1, 0, 1])
+                - u:
+                    exprs: u=Ti*f
+                - f_s:
+                    exprs: "f_s = u*b"
+        """
+        model_0 = IncompleteModel(yaml_str)
+        model_0.sections, model_0.section_titles, model_0.complete_dict = load_sections_and_titles(model_0.complete_dict)
+        df = load_df(model_0.complete_dict, model_0.sections)
+        syms_dict, exprs_dict, symbols_by_type = load_expressions_and_symbols(df)
+
+        direct, closure = load_dependency_graph(df, symbols_by_type)
+        self.assertEqual(direct["f_s"], set(["u","b"]))
+        self.assertEqual(direct["Ti"], set())
+        self.assertEqual(closure["f_s"], set(["u","b","Ti","f"]))
+        self.assertEqual(closure["u"], set(["Ti","f"]))
+        self.assertEqual(closure["b"], set())
+
+        # circular definitions are rejected
+        df.append_row(["v", "components", "v = w"])
+        df.append_row(["w", "components", "w = v"])
+        with self.assertRaises(ModelInitializationException):
+            load_dependency_graph(df, symbols_by_type)
+
     def test_T_N_u_to_reservoir_model(self):
         yaml_str = """\
         model:
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+import shutil
+from pathlib import Path
+
+from testinfrastructure.InDirTest import InDirTest
+from bgc_md.Model import Model
+from bgc_md.ModelList import ModelList
+from bgc_md.model_cache import ModelCache
+from bgc_md.reports import defaults
+
+
+class TestModelCache(InDirTest):
+    def setUp(self):
+        d = defaults()
+        sp = d['paths']['tested_records'].joinpath('Andren1997EcologicalApplications.yaml')
+        self.src_dir_path = Path('records')
+        self.src_dir_path.mkdir()
+        shutil.copy(sp.as_posix(), self.src_dir_path.as_posix())
+        self.yaml_file_path = self.src_dir_path.joinpath(sp.name)
+
+
+    def test_from_path(self):
+        model = Model.from_path(self.yaml_file_path, cache_dir='model_cache')
+        self.assertEqual(len(list(Path('model_cache').glob('*.pickle'))), 1)
+
+        cache = ModelCache('model_cache')
+        cached_model = cache.load(self.yaml_file_path)
+        self.assertIsNotNone(cached_model)
+        self.assertEqual(cached_model.name, model.name)
+        self.assertEqual(cached_model.state_vector['expr'], model.state_vector['expr'])
+        self.assertEqual(cached_model.symbols_by_type, model.symbols_by_type)
+        self.assertEqual(cached_model.yaml_file_path, self.yaml_file_path)
+
+        # a changed file is parsed again
+        with self.yaml_file_path.open('a') as f:
+            f.write('\n')
+        self.assertIsNone(cache.load(self.yaml_file_path))
+        Model.from_path(self.yaml_file_path, cache_dir='model_cache')
+        self.assertEqual(len(list(Path('model_cache').glob('*.pickle'))), 2)
+
+
+    def test_model_list(self):
+        ml = ModelList.from_dir_path(self.src_dir_path, cache_dir='model_cache')
+        cached_ml = ModelList.from_dir_path(self.src_dir_path, cache_dir='model_cache')
+        self.assertEqual([m.name for m in ml], [m.name for m in cached_ml])
+        self.assertEqual(len(list(Path('model_cache').glob('*.pickle'))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
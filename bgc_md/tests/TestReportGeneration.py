@@ -8,11 +8,13 @@ from pathlib import Path
 import shutil 
 from bgc_md.Model import Model
 from testinfrastructure.InDirTest import InDirTest
-from bgc_md.reports import produce_model_report_markdown, produce_model_report_markdown_directory, create_html_from_pandoc_md, create_html_from_pandoc_md_directory,generate_website,defaults,create_overview_report,render
+from bgc_md.reports import produce_model_report_markdown, produce_model_report_markdown_directory, create_html_from_pandoc_md, create_html_from_pandoc_md_directory,generate_website,defaults,create_overview_report,render,jacobian_eigenvalues
 from bgc_md.yaml_creator_mod import example_yaml_string_list2
 from bgc_md.helpers import remove_indentation
 from bgc_md.ModelList import ModelList
 import bgc_md.gv as gv
+import numpy as np
+from sympy import symbols, Matrix
 
 
 
@@ -83,4 +85,25 @@ class TestReportGeneration(InDirTest):
         self.assertTrue(targetPath.exists())
         
 
+    def test_jacobian_eigenvalues(self):
+        x, y, k, l = symbols('x y k l')
+        class JacobianModel:
+            def jacobian(self):
+                return Matrix([[-k*x, l], [-l, -k*y]])
 
+        dics = [
+            {'k': 1, 'l': 2, 'x': 1, 'y': 1},
+            {'k': '2*l', 'l': 0.5, 'x': 3, 'y': 1},
+            {'k': 1, 'x': 1, 'y': 1} # l is missing
+        ]
+        res = jacobian_eigenvalues(JacobianModel(), dics)
+
+        evs, rhos = res[0]
+        self.assertTrue(np.allclose(sorted(evs, key=lambda ev: ev.imag), [-1-2j, -1+2j]))
+        self.assertTrue(np.allclose(rhos, 1/np.sqrt(5)))
+
+        evs, rhos = res[1]
+        self.assertTrue(np.allclose(sorted(evs.real), [-2-np.sqrt(3)/2, -2+np.sqrt(3)/2]))
+        self.assertTrue(np.allclose(evs.imag, 0))
+
+        self.assertIsNone(res[2])
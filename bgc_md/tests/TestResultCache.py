@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+
+import numpy as np
+from sympy import symbols
+
+from bgc_md.result_cache import ResultCache
+from bgc_md.helpers import get_size
+
+
+class TestResultCache(unittest.TestCase):
+    def test_key(self):
+        k = symbols('k')
+        a = np.arange(6.0)
+        self.assertEqual(ResultCache.key('x', a, {k: 1, 'b': [1, 2]}), ResultCache.key('x', a.copy(), {'b': [1, 2], k: 1}))
+        self.assertNotEqual(ResultCache.key(a), ResultCache.key(a.reshape((2, 3))))
+        self.assertNotEqual(ResultCache.key(a), ResultCache.key(a.astype('float32')))
+        self.assertNotEqual(ResultCache.key({k: 1}), ResultCache.key({k: 2}))
+
+        # functions are compared by code and the values they see
+        def maker(c):
+            return lambda a: c*np.exp(-a)
+        self.assertEqual(ResultCache.key(maker(1)), ResultCache.key(maker(1)))
+        self.assertNotEqual(ResultCache.key(maker(1)), ResultCache.key(maker(2)))
+        self.assertNotEqual(ResultCache.key(lambda a: a), ResultCache.key(lambda a: 2*a))
+
+        # global functions they call are compared in the same way
+        g = {'np': np}
+        exec("def helper(a): return np.exp(-a)\nf = lambda a: helper(a)", g)
+        k1 = ResultCache.key(g['f'])
+        exec("def helper(a): return 5*np.exp(-a)", g)
+        self.assertNotEqual(k1, ResultCache.key(g['f']))
+
+
+    def test_key_by_id(self):
+        # objects without hashable content are kept alive by the keys
+        # of the stored values, their ids cannot be reused
+        class Density:
+            def __init__(self, c): self.c = c
+            def __call__(self, a): return self.c*np.exp(-a)
+
+        def maker(c):
+            d = Density(c)
+            return lambda a: d(a)
+
+        cache = ResultCache()
+        for i in range(20):
+            cache.put(ResultCache.key('field', maker(i)), i)
+        self.assertEqual(len(cache), 20)
+        self.assertEqual(sorted(cache._values.values()), list(range(20)))
+
+
+    def test_get_size(self):
+        a = np.zeros((1000, 100))
+        self.assertTrue(get_size(a) >= a.nbytes)
+        self.assertTrue(get_size(a[:10]) >= a[:10].nbytes)
+        self.assertTrue(get_size({'a': a}) >= a.nbytes)
+
+        # closures, e.g. interpolating functions, hold their data
+        make = lambda data: (lambda t: data[0]*t)
+        self.assertTrue(get_size(make(a)) >= a.nbytes)
+        self.assertTrue(get_size(make([make(a)])) >= a.nbytes)
+
+        # the owner of a cache is not counted for closures referring to it
+        class Owner:
+            def __init__(self):
+                self.data = np.zeros((1000, 100))
+                self.cache = ResultCache(owner = self)
+        o = Owner()
+        o.cache.put('f', lambda t: o.data[0]*t)
+        self.assertTrue(o.cache.bytes < 10000)
+
+
+    def test_lru_and_stats(self):
+        a = np.zeros((1000,))
+        cache = ResultCache(max_bytes = 3*get_size(a))
+        for i in range(3):
+            cache.put(i, np.zeros((1000,)))
+        self.assertEqual(len(cache), 3)
+
+        self.assertIs(cache.get(0), cache.get(0))
+        self.assertIsNone(cache.get(5))
+        # 1 is the least recently used value now
+        cache.put(3, a)
+        self.assertTrue(1 not in cache)
+        self.assertTrue(0 in cache)
+
+        stats = cache.stats
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 3)
+        self.assertTrue(stats['bytes'] <= stats['max_bytes'])
+
+        # too large values are not kept
+        cache.put(4, np.zeros((10000,)))
+        self.assertTrue(4 not in cache)
+
+        calls = []
+        compute = lambda: calls.append(1) or 'value'
+        self.assertEqual(cache.cached('c', compute), 'value')
+        self.assertEqual(cache.cached('c', compute), 'value')
+        self.assertEqual(len(calls), 1)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
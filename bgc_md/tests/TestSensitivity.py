@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+from pathlib import Path
+
+import numpy as np
+from sympy import symbols
+
+from testinfrastructure.InDirTest import InDirTest
+import bgc_md.tests.exampleSmoothReservoirModels as ESRM
+from bgc_md.sensitivity import SensitivityAnalysis, parameter_ranges, morris_design, sobol_design
+
+
+def linear_combination(ens):
+    # known indices: S1 = ST = [1/5, 4/5] for equal ranges
+    P = ens.parameter_matrix
+    return P[:,0] + 2*P[:,1]
+
+
+class TestSensitivity(InDirTest):
+    def setUp(self):
+        symbs = symbols("t k_01 k_10 k_0o k_1o")
+        self.t, self.k_01, self.k_10, self.k_0o, self.k_1o = symbs
+        self.srm = ESRM.nonlinear_two_pool(symbs)
+
+
+    def analysis(self, **kwargs):
+        kwargs.setdefault('diagnostics', [('lin', linear_combination)])
+        return SensitivityAnalysis(
+            self.srm,
+            [self.k_0o, self.k_1o],
+            [[0.3, 0.7], [0.3, 0.7]],
+            np.array([1, 2]),
+            np.linspace(0, 2, 5),
+            parameter_set = {self.k_01: 1/100, self.k_10: 1/100},
+            **kwargs
+        )
+
+
+    def test_designs(self):
+        X, changed, steps = morris_design(3, 5, levels = 4, seed = 1)
+        self.assertEqual(X.shape, (20, 3))
+        self.assertTrue(np.all((X >= 0) & (X <= 1)))
+        X = X.reshape((5, 4, 3))
+        for r in range(5):
+            self.assertEqual(sorted(changed[r]), [0, 1, 2])
+            for s in range(3):
+                diff = X[r,s+1]-X[r,s]
+                self.assertAlmostEqual(diff[changed[r,s]], steps[r,s])
+                self.assertEqual(np.count_nonzero(diff), 1)
+
+        X = sobol_design(3, 8).reshape((8, 5, 3))
+        A, B = X[:,0], X[:,1]
+        for i in range(3):
+            self.assertTrue(np.all(X[:,i+2,i] == B[:,i]))
+            self.assertTrue(np.all(np.delete(X[:,i+2], i, axis = 1) == np.delete(A, i, axis = 1)))
+
+
+    def test_sobol(self):
+        res = self.analysis(nr_samples = 1024).run(batch_size = 256)
+        self.assertEqual(res['S1'].shape, (2, 1))
+        self.assertEqual(res['outputs'], ['lin'])
+        self.assertTrue(np.allclose(res['S1'][:,0], [0.2, 0.8], atol = 0.05))
+        self.assertTrue(np.allclose(res['ST'][:,0], [0.2, 0.8], atol = 0.05))
+
+
+    def test_morris(self):
+        res = self.analysis(method = 'morris', nr_samples = 10).run(batch_size = 3)
+        # elementary effects in units of the ranges
+        self.assertTrue(np.allclose(res['mu_star'][:,0], [0.4, 0.8]))
+        self.assertTrue(np.allclose(res['sigma'][:,0], 0, atol = 1e-6))
+
+
+    def test_diagnostics(self):
+        sa = self.analysis(method = 'morris', nr_samples = 3, diagnostics = ['solution', 'system_age_moment', 'backward_transit_time_moment', 'steady_state'])
+        res = sa.run()
+        self.assertEqual(res['outputs'], ['solution[0]', 'solution[1]', 'system_age_moment', 'backward_transit_time_moment', 'steady_state[0]', 'steady_state[1]'])
+        self.assertEqual(res['mu_star'].shape, (2, 6))
+        self.assertTrue(np.all(np.isfinite(res['mu_star'])))
+
+        with self.assertRaises(Exception):
+            self.analysis(diagnostics = ['unknown'])
+
+
+    def test_checkpoint(self):
+        full = self.analysis(nr_samples = 16).run(batch_size = 4)
+
+        sa = self.analysis(nr_samples = 16)
+        sa.run('checkpoint.npz', batch_size = 4, max_batches = 2)
+        self.assertEqual(sa.nr_done, 8)
+        self.assertTrue(Path('checkpoint.npz').exists())
+
+        # a new analysis resumes after the first two batches
+        sa = self.analysis(nr_samples = 16)
+        calls = []
+        evaluate = sa.evaluate
+        sa.evaluate = lambda X: calls.append(len(X)) or evaluate(X)
+        res = sa.run('checkpoint.npz', batch_size = 4)
+        self.assertEqual(calls, [16, 16])
+        self.assertTrue(np.allclose(res['S1'], full['S1']))
+        self.assertTrue(np.allclose(res['ST'], full['ST']))
+
+        with self.assertRaises(Exception):
+            self.analysis(nr_samples = 16, seed = 1).run('checkpoint.npz')
+
+
+    def test_parameter_ranges(self):
+        k, l, m, z = symbols('k l m z')
+        parameter_sets = [{'values': {'k': 1, 'l': '1/2', 'm': 'k/2', 'z': 0}},
+                          {'values': {'k': 3, 'l': 0.5, 'm': 'k/2', 'z': 0}}]
+        syms, bounds = parameter_ranges(parameter_sets, {'k': k, 'l': l, 'm': m, 'z': z}, rel_width = 0.1)
+        self.assertEqual(syms, [k, l])
+        self.assertTrue(np.allclose(bounds, [[1, 3], [0.45, 0.55]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
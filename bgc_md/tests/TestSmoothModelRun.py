@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+
+import numpy as np
+from scipy.integrate import odeint
+from sympy import symbols, sin, Function, Piecewise
+
+import bgc_md.tests.exampleSmoothReservoirModels as ESRM
+from bgc_md.SmoothReservoirModel import SmoothReservoirModel
+from bgc_md.SmoothModelRun import SmoothModelRun
+from bgc_md.helpers_reservoir import numsol_symbolic_system
+
+
+class TestSmoothModelRun(unittest.TestCase):
+
+    def linear_smr(self):
+        symbs = symbols("t, k_01,k_10,k_0o,k_1o")
+        t, k_01,k_10,k_0o,k_1o = symbs
+        srm = ESRM.critics(symbs)
+        pardict = {k_0o: 0.01, k_1o: 0.08, k_01: 0.09, k_10: 1}
+        start_values = np.array([0.001,0.001])
+        times = np.linspace(0, 10, 11)
+        return SmoothModelRun(srm, pardict, start_values, times)
+
+
+    def nonlinear_smr(self):
+        symbs = symbols("t k_01 k_10 k_0o k_1o")
+        t, k_01,k_10,k_0o,k_1o = symbs
+        srm = ESRM.nonlinear_two_pool(symbs)
+        pardict = {k_01: 1/100, k_10: 1/100, k_0o: 1/2, k_1o: 1/2}
+        start_values = np.array([1,2])
+        times = np.linspace(0, 2, 9)
+        return SmoothModelRun(srm, pardict, start_values, times)
+
+
+    def linear_autonomous_smr(self, inputs = None):
+        x, y, t, k, l = symbols('x y t k l')
+        if inputs is None: inputs = {0: 1, 1: 2}
+        srm = SmoothReservoirModel([x,y], t, inputs, {0: k*x, 1: l*y}, {(0,1): 0.5*x, (1,0): 0.1*y})
+        times = np.linspace(0, 50, 101)
+        return SmoothModelRun(srm, {k: 0.3, l: 0.2}, np.array([3, 4]), times)
+
+
+    def test_is_linear(self):
+        self.assertTrue(self.linear_smr().model.is_linear)
+        self.assertFalse(self.nonlinear_smr().model.is_linear)
+
+
+    def test_state_transition_operator_batch(self):
+        for smr in [self.linear_smr(), self.nonlinear_smr()]:
+            times = smr.times
+            t0 = np.array([times[0], times[0], times[2], times[2], times[3], times[1]])
+            t = np.array([times[0], times[4], times[5], times[-1], times[3], times[6]])
+            X = np.array([[1,2], [1,0], [0,1], [0,0], [3,4], [0.5,0.25]])
+
+            res = smr._state_transition_operator_batch(t, t0, X)
+            self.assertEqual(res.shape, X.shape)
+
+            ref = np.array([smr._state_transition_operator(t[i], t0[i], X[i]).reshape((2,)) for i in range(len(t))])
+            self.assertTrue(np.allclose(res, ref, rtol = 1e-05, atol = 1e-08))
+
+            # t == t0 and zero start vectors are passed through
+            self.assertTrue(np.all(res[0] == X[0]))
+            self.assertTrue(np.all(res[3] == 0))
+            self.assertTrue(np.all(res[4] == X[4]))
+
+            with self.assertRaises(Exception):
+                smr._state_transition_operator_batch(times[:1], times[1:2], X[:1])
+
+
+    def test_no_input_sol_batch(self):
+        x, y, t, k = symbols('x y t k')
+        g = Function('g')
+        internal = {(0,1): 0.5*x}
+        smrs = [self.nonlinear_smr(),
+                # functions that only accept scalars
+                SmoothModelRun(SmoothReservoirModel([x,y], t, {0: 1}, {0: k*g(x), 1: 0.2*y}, internal), {k: 0.1}, np.array([1, 1]), self.nonlinear_smr().times, {'g(x)': lambda x: float(x)}),
+                # piecewise defined models
+                SmoothModelRun(SmoothReservoirModel([x,y], t, {0: 1}, {0: Piecewise((k*x, t < 1), (2*k*x, True)), 1: 0.2*y}, internal), {k: 0.1}, np.array([1, 1]), self.nonlinear_smr().times)]
+
+        X = np.array([[1,2], [1,0], [3,4], [0.5,0.25]])
+        ts = np.array([0.5, 1.5, 2, 1.5])
+        for smr in smrs:
+            res = smr._no_input_sol_batch(0, ts, X)
+            ref = np.array([odeint(smr._no_input_num_rhs, X[i], [0, ts[i]])[-1] for i in range(len(ts))])
+            self.assertTrue(np.allclose(res, ref, rtol = 1e-05, atol = 1e-08))
+        self.assertIsNone(smrs[2]._no_input_rhs_func)
+
+
+    def test_state_transition_operator_matrices(self):
+        smr = self.linear_smr()
+        times = smr.times
+        n = smr.nr_pools
+
+        Phis = smr._state_transition_operator_matrices(times[1], times[[3,1,7,3]])
+        self.assertEqual(Phis.shape, (4, n, n))
+        self.assertTrue(np.all(Phis[1] == np.identity(n)))
+        self.assertTrue(np.all(Phis[0] == Phis[3]))
+
+        # integrating backwards gives the same matrices
+        Phis_back = np.array([smr._state_transition_operator_matrices_backward(t, times[[1]])[0] for t in times[[3,1,7,3]]])
+        self.assertTrue(np.allclose(Phis, Phis_back, rtol = 1e-05))
+
+        # semigroup property
+        Phi_31 = smr._state_transition_operator_matrices(times[1], times[[3]])[0]
+        Phi_73 = smr._state_transition_operator_matrices(times[3], times[[7]])[0]
+        self.assertTrue(np.allclose(Phis[2], Phi_73.dot(Phi_31), rtol = 1e-05))
+
+
+    def test_pool_age_densities_func(self):
+        for smr in [self.linear_smr(), self.nonlinear_smr()]:
+            times = smr.times
+            ages = np.array([-1, 0, times[2]-times[0], times[-1]-times[0], times[-1]+1])
+            p1_sv = smr._age_densities_1_single_value()
+            p2_sv = smr._age_densities_2_single_value()
+            ref = np.array([[p1_sv(a,t)+p2_sv(a,t) for t in times] for a in ages])
+
+            p = smr.pool_age_densities_func()(ages)
+            self.assertEqual(p.shape, (len(ages), len(times), smr.nr_pools))
+            # the scalar reference integrates the small start values with
+            # the absolute tolerance of odeint
+            self.assertTrue(np.allclose(p, ref, rtol = 1e-04, atol = 1e-06))
+
+
+    def test_pool_age_densities_func_grid(self):
+        for smr in [self.linear_smr(), self.nonlinear_smr(), self.linear_autonomous_smr()]:
+            times = smr.times
+            dt = times[1]-times[0]
+            ages = np.array([0, 3, 1, len(times)-1, len(times)+2])*dt
+
+            ref = smr.pool_age_densities_func()(ages)
+            p = smr.pool_age_densities_func(grid = True)(ages)
+            self.assertEqual(p.shape, (len(ages), len(times), smr.nr_pools))
+            self.assertTrue(np.allclose(p, ref, rtol = 1e-04, atol = 1e-06))
+
+            with self.assertRaises(Exception):
+                smr.pool_age_densities_func(grid = True)(ages+dt/2)
+
+
+    def test_forward_transit_time_density_func(self):
+        for smr in [self.linear_smr(), self.nonlinear_smr()]:
+            times = smr.times
+            ages = np.array([-times[2], 0, times[1]-times[0], times[-1]-times[0]])
+            for cut_off in [True, False]:
+                p_sv = smr.forward_transit_time_density_single_value(cut_off)
+                ref = np.array([[p_sv(a,t) for t in times] for a in ages])
+
+                p = smr.forward_transit_time_density_func(cut_off)(ages)
+                self.assertEqual(p.shape, (len(ages), len(times)))
+                self.assertTrue(np.all(np.isnan(p) == np.isnan(ref)))
+                self.assertTrue(np.allclose(p, ref, rtol = 1e-05, atol = 1e-08, equal_nan = True))
+
+
+    def test_forward_transit_time_moment(self):
+        smr = self.linear_smr()
+        # the mean is the integral of the surviving fraction of the inputs,
+        # integrated as additional component of the no-input system
+        num_rhs = smr._no_input_num_rhs
+        def rhs(Y, t):
+            dX = np.array(num_rhs(Y[:2], t)).reshape((2,))
+            return np.concatenate((dX, [Y[:2].sum()]))
+        U = smr.external_input_vector
+        ref = np.array([np.nan] + [odeint(rhs, np.concatenate((U[ti], [0])), [t, t+1e5], mxstep = 10000)[-1, 2]/U[ti].sum() for ti, t in enumerate(smr.times) if ti > 0])
+        mean = smr.forward_transit_time_moment(1)
+        self.assertTrue(np.allclose(mean, ref, rtol = 1e-04, equal_nan = True))
+        self.assertTrue(np.allclose(smr.forward_transit_time_moment(1, processes = 2), mean, equal_nan = True))
+
+        # closed form for linear autonomous models
+        smr = self.linear_autonomous_smr()
+        self.assertTrue(smr._is_linear_autonomous)
+        A = smr._constant_A
+        u = np.array([1, 2])
+        mean_ref = np.linalg.solve(-A, u).sum()/u.sum()
+        mean = smr.forward_transit_time_moment(1)
+        self.assertTrue(np.isnan(mean[0]))
+        self.assertTrue(np.allclose(mean[1:], mean_ref))
+
+        second_moment = smr.forward_transit_time_moment(2)
+        second_moment_ref = 2*np.linalg.solve(-A, np.linalg.solve(-A, u)).sum()/u.sum()
+        self.assertTrue(np.allclose(second_moment[1:], second_moment_ref))
+
+        # the quadrature agrees with the closed form
+        t = symbols('t')
+        smr = self.linear_autonomous_smr({0: 1+0*t})
+        smr._saved_is_linear_autonomous = False
+        self.assertTrue(np.allclose(smr.forward_transit_time_moment(2)[1:], 2*np.linalg.solve(-A, np.linalg.solve(-A, [1,0])).sum(), rtol = 1e-06))
+
+
+    def test_forward_transit_time_simulation(self):
+        smr = self.linear_smr()
+        mean = smr.forward_transit_time_moment(1)
+        for M, MH, N in [(2, False, 2000), (1, False, 2000), (2, True, 200)]:
+            res, diagnostics = smr.apply_to_forward_transit_time_simulation({'mean': np.mean}, N = N, M = M, k = 1, MH = MH, seed = 1, return_diagnostics = True)
+            values = res['mean']['values']
+            self.assertTrue(np.isnan(values[0]))
+            if M == 1:
+                # inverse transform sampling, the other ones are biased
+                self.assertTrue(np.allclose(values[1:], mean[1:], rtol = 0.1))
+            self.assertEqual(diagnostics['durations'].shape, smr.times.shape)
+            self.assertEqual(diagnostics['calls'][0], 0)
+
+            # reproducible and independent of the number of processes
+            res_2 = smr.apply_to_forward_transit_time_simulation({'mean': np.mean}, N = N, M = M, k = 1, MH = MH, seed = 1, processes = 2)
+            self.assertTrue(np.allclose(values, res_2['mean']['values'], equal_nan = True))
+
+        res = smr.apply_to_forward_transit_time_simulation_its({'mean': np.mean}, smr.times[1:], N = 5000, k = 1, seed = 2)
+        self.assertTrue(np.allclose(res['mean']['values'], mean[1:], rtol = 0.1))
+
+
+    def test_distribution_quantiles_vectorized(self):
+        smr = self.linear_autonomous_smr()
+        times = smr.times
+        # exponential distributions with a rate changing in time
+        rate = lambda t: 1/(1+t)
+        F_sv = lambda a, t: 2*(1-np.exp(-rate(t)*a))
+        F_vec = lambda ages, ts: 2*(1-np.exp(-rate(ts)*ages))
+        norm_consts = np.ones((len(times),))*2
+        norm_consts[3] = 0
+
+        ref = np.log(2)*(1+times)
+        ref[3] = np.nan
+        for F in [None, F_vec]:
+            q = smr.distribution_quantiles(0.5, F_sv, norm_consts, np.ones((len(times),)), method = 'vectorized', F_vec = F)
+            self.assertTrue(np.allclose(q, ref, rtol = 1e-6, equal_nan = True))
+
+        q = smr.distribution_quantiles(0.5, F_sv, norm_consts, np.ones((len(times),)))
+        self.assertTrue(np.allclose(q, ref, rtol = 1e-6, equal_nan = True))
+
+
+    def test_flux_arrays(self):
+        x, y, t, k = symbols('x y t k')
+        f = Function('f')
+        srm = SmoothReservoirModel([x,y], t, {0: 1, 1: 2+sin(t)}, {0: k*f(t)*x}, {(0,1): 0.5*x, (1,0): 0.1*y})
+        # a function that cannot handle arrays of times
+        func_set = {'f(t)': lambda t: 1 if t < 5 else 2}
+        smr = SmoothModelRun(srm, {k: 0.3}, np.array([3, 4]), np.linspace(0, 10, 21), func_set = func_set)
+        times = smr.times
+        sol = smr.solve()
+        n = smr.nr_pools
+
+        F = smr.internal_flux_matrix
+        self.assertEqual(F.shape, (len(times), n, n))
+        self.assertTrue(np.allclose(F[:,0,1], 0.5*sol[:,0]))
+        self.assertTrue(np.allclose(F[:,1,0], 0.1*sol[:,1]))
+        self.assertTrue(np.all(F[:,0,0] == 0) and np.all(F[:,1,1] == 0))
+
+        u = smr.external_input_flux_vector
+        self.assertEqual(u.shape, (len(times), n))
+        self.assertTrue(np.all(u[:,0] == 1))
+        self.assertTrue(np.allclose(u[:,1], 2+np.sin(times)))
+        # no inputs at t0 in the vector used for the age computations
+        self.assertTrue(np.all(smr.external_input_vector[0] == 0))
+        self.assertTrue(np.allclose(smr.external_input_vector[1:], u[1:]))
+
+        r = smr.external_output_flux_vector
+        self.assertTrue(np.allclose(r[:,0], 0.3*np.where(times < 5, 1, 2)*sol[:,0]))
+        self.assertTrue(np.all(r[:,1] == 0))
+        self.assertTrue(np.allclose(smr.external_output_vector, r))
+        self.assertTrue(np.allclose(smr.output_rate_vector[:,0], 0.3*np.where(times < 5, 1, 2)))
+
+        # the flux functions accept arrays of times
+        flux_01 = smr.internal_flux_funcs()[(0,1)]
+        self.assertTrue(np.allclose(flux_01(times), F[:,0,1]))
+        self.assertTrue(np.allclose(smr.external_input_flux_funcs()[0](times), u[:,0]))
+
+
+    def test_cached_flux_funcs(self):
+        x, y, t, k = symbols('x y t k')
+        srm = SmoothReservoirModel([x,y], t, {0: 1, 1: 2+sin(t)}, {0: k*x}, {(0,1): 0.5*x, (1,0): 0.1*y})
+        smr = SmoothModelRun(srm, {k: 0.3}, np.array([3, 4]), np.linspace(0, 10, 21))
+        times = smr.times
+        ts = np.array([0, 0.25, 5, 10])
+
+        # built once
+        self.assertIs(smr.output_flux_funcs()[0], smr.output_flux_funcs()[0])
+        self.assertIs(smr.sol_funcs()[0], smr.sol_funcs()[0])
+
+        # scalar and array times
+        u = smr.external_input_vector_func()
+        U = u(ts)
+        self.assertEqual(U.shape, (len(ts), 2))
+        self.assertTrue(np.all(U[0] == 0))
+        self.assertTrue(np.allclose(U[1:], [[1, 2+np.sin(ti)] for ti in ts[1:]]))
+        self.assertTrue(np.all(u(ts[1]) == U[1]))
+        self.assertTrue(np.all(u(11) == 0))
+
+        sol = smr.sol_funcs()[0](ts)
+        r = smr.output_vector_func(ts)
+        self.assertTrue(np.allclose(r[:,0], 0.3*sol))
+        self.assertTrue(np.all(smr.output_vector_func(ts[2]) == r[2]))
+        rates = smr.output_rate_vector_at_t(ts)
+        self.assertTrue(np.allclose(rates, [[0.3, 0]]*len(ts)))
+        self.assertTrue(np.allclose(smr.output_rate_vector_at_t(ts[2]), [0.3, 0]))
+
+        # assigning new parameters drops the cached functions and solutions
+        soln = smr.solve()
+        smr.parameter_set = {k: 0.6}
+        self.assertFalse(np.allclose(smr.solve(), soln))
+        self.assertTrue(np.allclose(smr.output_rate_vector_at_t(ts[2]), [0.6, 0]))
+        smr.start_values = np.array([0, 0])
+        self.assertTrue(np.all(smr.solve()[0] == 0))
+        # the output rates of empty pools are nan, at single times 0
+        self.assertTrue(np.all(np.isnan(smr.output_rate_vector[0])))
+        self.assertTrue(np.all(np.isfinite(smr.output_rate_vector[1:,0])))
+        self.assertTrue(np.all(smr.output_rate_vector_at_t(ts[0]) == 0))
+        smr.times = times[:5]
+        self.assertEqual(smr.solve().shape, (5, 2))
+
+
+    def test_solve_single_value(self):
+        for smr in [self.linear_smr(), self.nonlinear_smr(), self.linear_autonomous_smr()]:
+            times = smr.times
+            ts = np.linspace(times[0], times[-1], 4*len(times))
+            ref = smr.solve(alternative_times = ts)
+            sol = smr.solve_single_value()
+            self.assertTrue(np.allclose(sol(ts), ref, rtol = 1e-06))
+            self.assertTrue(np.allclose(sol(ts[5]), ref[5], rtol = 1e-06))
+            self.assertTrue(np.allclose(smr.sol_funcs()[1](ts), ref[:,1], rtol = 1e-06))
+
+            # cut off after the last time, nothing before the first
+            self.assertTrue(np.allclose(sol(times[-1]+1), ref[-1], rtol = 1e-06))
+            self.assertTrue(np.all(np.isnan(sol(times[0]-1))))
+            self.assertTrue(np.all(np.isnan(sol(np.array([times[0]-1, times[0]]))[0])))
+
+            # integrated only once
+            self.assertIs(smr._dense_age_moment_solution(0), smr._dense_age_moment_solution(0))
+
+            sv = smr.start_values*2
+            ref_2 = smr.solve(alternative_times = ts, alternative_start_values = sv)
+            self.assertTrue(np.allclose(smr.solve_single_value(sv)(ts), ref_2, rtol = 1e-06))
+
+
+    def test_solve_single_value_registered_integrator(self):
+        # integrators without dense output are interpolated between the times
+        from bgc_md.integrators import register_integrator, integrators
+        register_integrator('odeint_copy', lambda *args, **kwargs: integrators['odeint'](*args, **kwargs))
+        smr = self.nonlinear_smr()
+        smr.integrator = 'odeint_copy'
+        times = smr.times
+        ref = smr.solve()
+        sol = smr.solve_single_value()
+        self.assertTrue(np.allclose(sol(times), ref))
+        self.assertTrue(np.allclose(smr.sol_funcs()[0](times[3]), ref[3,0]))
+        self.assertTrue(np.allclose(sol((times[1]+times[2])/2), (ref[1]+ref[2])/2))
+        self.assertEqual(smr.output_rate_vector_at_t(times[2]).shape, (2,))
+
+
+    def test_result_cache(self):
+        smr = self.linear_smr()
+        ages = np.array([0, 1, 2])
+        p0 = lambda a: np.exp(-a)*smr.start_values
+        field = smr.pool_age_densities_func(p0)(ages)
+        misses = smr.result_cache.misses
+
+        # an equal start age density function gives a hit
+        field_2 = smr.pool_age_densities_func(lambda a: np.exp(-a)*smr.start_values)(ages)
+        self.assertIs(field, field_2)
+        self.assertEqual(smr.result_cache.misses, misses)
+        self.assertTrue(smr.result_cache.stats['bytes'] >= field.nbytes)
+
+        # new parameters clear the cache
+        smr.parameter_set = dict(smr.parameter_set)
+        self.assertEqual(len(smr.result_cache), 0)
+        self.assertIsNot(smr.pool_age_densities_func(p0)(ages), field)
+
+        # the memory budget is respected
+        smr = self.linear_smr()
+        smr.result_cache.max_bytes = field.nbytes
+        smr.pool_age_densities_func(p0)(ages)
+        self.assertTrue(smr.result_cache.bytes <= field.nbytes)
+
+
+    def test_is_linear_autonomous(self):
+        self.assertTrue(self.linear_autonomous_smr()._is_linear_autonomous)
+        self.assertTrue(self.linear_autonomous_smr()._has_constant_inputs)
+        self.assertFalse(self.linear_smr()._is_linear_autonomous)
+        self.assertFalse(self.nonlinear_smr()._is_linear_autonomous)
+
+        t = symbols('t')
+        smr = self.linear_autonomous_smr({0: 1+sin(t)})
+        self.assertTrue(smr._is_linear_autonomous)
+        self.assertFalse(smr._has_constant_inputs)
+
+
+    def test_state_transition_operator_linear_autonomous(self):
+        smr = self.linear_autonomous_smr()
+        times = smr.times
+        x = np.array([1, 2])
+        
+        ref = smr._no_input_sol([times[3], times[40]], x)
+        self.assertTrue(np.allclose(smr._state_transition_operator(times[40], times[3], x), ref, rtol = 1e-06))
+
+        t0 = np.array([times[0], times[3], times[10]])
+        t = np.array([times[5], times[40], times[10]])
+        res = smr._state_transition_operator_batch(t, t0, np.array([x, x, x]))
+        ref = np.array([smr._no_input_sol([t0[i], t[i]], x) for i in range(3)])
+        self.assertTrue(np.allclose(res, ref, rtol = 1e-06))
+
+
+    def test_solve_age_moment_system_closed_form(self):
+        start_age_moments = np.array([[1, 2], [3, 5]])
+        for inputs in [None, {0: 1+sin(symbols('t'))}]:
+            smr = self.linear_autonomous_smr(inputs)
+            srm = smr.model
+            soln = smr._solve_age_moment_system(2, start_age_moments)
+            
+            state_vector, rhs = srm.age_moment_system(2)
+            start_values = np.concatenate([smr.start_values, start_age_moments.flatten()])
+            ref = numsol_symbolic_system(state_vector, srm.time_symbol, rhs, smr.parameter_set, {}, start_values, smr.times)
+            self.assertTrue(np.allclose(soln, ref, rtol = 1e-06))
+
+            self.assertTrue(np.allclose(smr.solve(), ref[:,:2], rtol = 1e-06))
+
+
+    def test_integrator(self):
+        ref = self.linear_smr()
+        for integrator in ['BDF', 'Radau']:
+            for use_jacobian in [False, True]:
+                smr = SmoothModelRun(ref.model, ref.parameter_set, ref.start_values, ref.times, integrator = integrator, use_jacobian = use_jacobian)
+                self.assertTrue(np.allclose(smr.solve(), ref.solve(), rtol = 1e-05, atol = 1e-08))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+
+import numpy as np
+from sympy import symbols, sin, Function
+
+import bgc_md.tests.exampleSmoothReservoirModels as ESRM
+from bgc_md.SmoothReservoirModel import SmoothReservoirModel
+from bgc_md.SmoothModelRun import SmoothModelRun
+from bgc_md.SmoothModelRunEnsemble import SmoothModelRunEnsemble
+
+
+class TestSmoothModelRunEnsemble(unittest.TestCase):
+    def setUp(self):
+        symbs = symbols("t k_01 k_10 k_0o k_1o")
+        self.t, self.k_01, self.k_10, self.k_0o, self.k_1o = symbs
+        self.srm = ESRM.nonlinear_two_pool(symbs)
+        self.times = np.linspace(0, 2, 9)
+
+        rng = np.random.RandomState(1)
+        self.parameter_matrix = np.stack([rng.uniform(0.3, 0.7, 7), rng.uniform(0.3, 0.7, 7)], axis = 1)
+        self.start_values_matrix = rng.uniform(0.5, 2, (7, 2))
+
+
+    def ensemble(self, **kwargs):
+        return SmoothModelRunEnsemble(self.srm, [self.k_0o, self.k_1o], self.parameter_matrix, self.start_values_matrix, self.times, parameter_set = {self.k_01: 1/100, self.k_10: 1/100}, **kwargs)
+
+
+    def test_solve(self):
+        ens = self.ensemble()
+        sol = ens.solve()
+        self.assertEqual(sol.shape, (7, len(self.times), 2))
+
+        for k in range(ens.nr_members):
+            ref = ens.model_run(k).solve()
+            self.assertTrue(np.allclose(sol[k], ref, rtol = 1e-6, atol = 1e-8))
+
+
+    def test_chunks_and_processes(self):
+        ref = self.ensemble().solve()
+        self.assertTrue(np.allclose(self.ensemble(chunk_size = 3).solve(), ref, rtol = 1e-6))
+        self.assertTrue(np.allclose(self.ensemble(chunk_size = 2, processes = 2).solve(), ref, rtol = 1e-6))
+        self.assertTrue(np.allclose(self.ensemble(chunk_size = 4, integrator = 'BDF').solve(), ref, rtol = 1e-5))
+
+
+    def test_func_set(self):
+        # functions that only accept scalars are evaluated member by member
+        x, y, t, k = symbols('x y t k')
+        f, g = Function('f'), Function('g')
+        srm = SmoothReservoirModel([x,y], t, {0: f(t), 1: 2}, {0: k*g(x), 1: 0.2*y}, {(0,1): 0.5*x})
+        func_set = {'f(t)': lambda t: 1+0.5*np.sin(t), 'g(x)': lambda x: float(x)}
+        times = np.linspace(0, 5, 11)
+
+        ens = SmoothModelRunEnsemble(srm, [k], [[0.1], [0.2], [0.3]], [1, 1], times, func_set = func_set)
+        sol = ens.solve()
+        self.assertEqual(sol.shape, (3, 11, 2))
+        for i, kv in enumerate([0.1, 0.2, 0.3]):
+            ref = SmoothModelRun(srm, {k: kv}, np.array([1, 1]), times, func_set).solve()
+            self.assertTrue(np.allclose(sol[i], ref, rtol = 1e-6, atol = 1e-8))
+
+
+    def test_from_model_runs(self):
+        pardicts = [{self.k_01: 1/100, self.k_10: 1/100, self.k_0o: v, self.k_1o: 1/2} for v in (0.3, 0.5, 0.6)]
+        mrs = [SmoothModelRun(self.srm, pardict, np.array([1, 2]), self.times) for pardict in pardicts]
+
+        ens = SmoothModelRunEnsemble.from_model_runs(mrs)
+        # only the parameter that differs is an argument
+        self.assertEqual(ens.parameter_symbols, [self.k_0o])
+        sol = ens.solve()
+        for k, mr in enumerate(mrs):
+            self.assertTrue(np.allclose(sol[k], mr.solve(), rtol = 1e-6, atol = 1e-8))
+
+        with self.assertRaises(Exception):
+            SmoothModelRunEnsemble.from_model_runs([mrs[0], SmoothModelRun(self.srm, pardicts[1], np.array([1, 2]), self.times[:-1])])
+
+        # the members are of the class of the given runs
+        class OtherRun(SmoothModelRun):
+            pass
+        others = [OtherRun(self.srm, pardict, np.array([1, 2]), self.times) for pardict in pardicts]
+        ens = SmoothModelRunEnsemble.from_model_runs(others)
+        self.assertIs(type(ens.model_run(1)), OtherRun)
+        self.assertTrue(np.allclose(ens.model_run(1).solve(), others[1].solve()))
+        with self.assertRaises(Exception):
+            SmoothModelRunEnsemble.from_model_runs([mrs[0], others[1]])
+
+
+    def test_shapes(self):
+        with self.assertRaises(Exception):
+            SmoothModelRunEnsemble(self.srm, [self.k_0o], self.parameter_matrix, self.start_values_matrix, self.times)
+        with self.assertRaises(Exception):
+            SmoothModelRunEnsemble(self.srm, [self.k_0o, self.k_1o], self.parameter_matrix, self.start_values_matrix[:3], self.times)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+import json
+import pickle
+from pathlib import Path
+
+import numpy as np
+from sympy import symbols, sin
+
+from testinfrastructure.InDirTest import InDirTest
+import bgc_md.tests.exampleSmoothReservoirModels as ESRM
+from bgc_md.SmoothReservoirModel import SmoothReservoirModel
+from bgc_md.SmoothModelRun import SmoothModelRun
+
+
+def nonlinear_smr():
+    symbs = symbols("t k_01 k_10 k_0o k_1o")
+    t, k_01,k_10,k_0o,k_1o = symbs
+    srm = ESRM.nonlinear_two_pool(symbs)
+    pardict = {k_01: 1/100, k_10: 1/100, k_0o: 1/2, k_1o: 1/2}
+    return SmoothModelRun(srm, pardict, np.array([1,2]), np.linspace(0, 2, 9))
+
+
+def linear_smr():
+    x, y, t, k = symbols('x y t k')
+    srm = SmoothReservoirModel([x,y], t, {0: 1, 1: 2}, {0: k*(1+0.5*sin(t))*x, 1: 0.2*y}, {(0,1): 0.5*x, (1,0): 0.1*y})
+    return SmoothModelRun(srm, {k: 0.3}, np.array([3, 4]), np.linspace(0, 10, 21))
+
+
+class TestStateTransitionOperatorCache(InDirTest):
+    def setUp(self):
+        self.smr = nonlinear_smr()
+        self.size = 6
+
+
+    def test_build_parallel(self):
+        smr = self.smr
+        n = smr.nr_pools
+        smr.build_state_transition_operator_cache(size = self.size)
+        ref = np.array(smr._state_transition_operator_values)
+        self.assertEqual(ref.shape, (self.size, self.size, n, n))
+        # Phi(t0, t0) = I and nothing after t_max
+        self.assertTrue(np.allclose(ref[0, 0], np.identity(n)))
+        self.assertTrue(np.all(ref[-1] == 0))
+
+        smr.build_state_transition_operator_cache(size = self.size, processes = 2)
+        self.assertTrue(np.all(smr._state_transition_operator_values == ref))
+
+        # built directly into a memory mapped file
+        smr.build_state_transition_operator_cache(size = self.size, processes = 2, filename = 'cache')
+        values = smr._state_transition_operator_values
+        self.assertTrue(isinstance(values, np.memmap))
+        self.assertFalse(values.flags.writeable)
+        self.assertTrue(np.all(values == ref))
+        self.assertTrue(Path('cache', 'metadata.json').exists())
+
+
+    def test_save_and_load(self):
+        smr = self.smr
+        smr.build_state_transition_operator_cache(size = self.size)
+        ref = np.array(smr._state_transition_operator_values)
+        x = np.array([1, 2])
+        ref_sol = smr._state_transition_operator(1.3, 0.1, x)
+
+        smr.save_state_transition_operator_cache('cache')
+        smr.save_state_transition_operator_cache('cache32', dtype = 'float32')
+        with open('cache32/metadata.json') as f:
+            metadata = json.load(f)
+        self.assertEqual(metadata['dtype'], 'float32')
+        self.assertEqual(metadata['size'], self.size)
+
+        smr = nonlinear_smr()
+        smr.load_state_transition_operator_cache('cache')
+        self.assertTrue(isinstance(smr._state_transition_operator_values, np.memmap))
+        self.assertTrue(np.all(smr._state_transition_operator_values == ref))
+        self.assertTrue(np.allclose(smr._state_transition_operator(1.3, 0.1, x), ref_sol))
+
+        smr.load_state_transition_operator_cache('cache32')
+        self.assertEqual(smr._state_transition_operator_values.dtype, np.float32)
+        self.assertTrue(np.allclose(smr._state_transition_operator(1.3, 0.1, x), ref_sol, rtol = 1e-05))
+
+        # caches of a different run are refused
+        smr.times = smr.times[:-1]
+        with self.assertRaises(Exception):
+            smr.load_state_transition_operator_cache('cache')
+        with self.assertRaises(Exception):
+            smr.load_state_transition_operator_cache('no_cache')
+
+
+    def test_load_pickled(self):
+        smr = self.smr
+        smr.build_state_transition_operator_cache(size = self.size)
+        ref = np.array(smr._state_transition_operator_values)
+        with open('cache.pickle', 'wb') as f:
+            pickle.dump({'values': ref, 'size': self.size, 'times': smr.times}, f)
+
+        smr = nonlinear_smr()
+        smr.load_state_transition_operator_cache('cache.pickle')
+        self.assertTrue(np.all(smr._state_transition_operator_values == ref))
+
+
+    def test_interpolate(self):
+        smr = linear_smr()
+        n = smr.nr_pools
+        rng = np.random.RandomState(0)
+        t0 = np.concatenate((rng.uniform(0, 10, 50), [0, 10, 3]))
+        t = t0+np.concatenate((rng.uniform(0, 1, 50), [1, 0, 0]))*(10-t0)
+        ref = np.array([smr._state_transition_operator_matrices(t0[i], [t[i]])[0] for i in range(len(t))])
+        X = rng.uniform(0, 1, (len(t), n))
+
+        smr.build_state_transition_operator_cache(size = 21)
+        smr.state_transition_operator_cache_mode = 'interpolate'
+        # no ODE is solved any more
+        smr.result_cache.put('no_input_sol', None)
+        smr.result_cache.put('no_input_num_rhs', None)
+
+        Phis, errs = smr._state_transition_operator_cached(t, t0)
+        self.assertEqual(Phis.shape, (len(t), n, n))
+        self.assertEqual(errs.shape, (len(t),))
+        self.assertTrue(np.allclose(Phis[-2:], np.identity(n)))
+        self.assertTrue(np.all(errs[-2:] == 0))
+
+        # the error estimates are conservative
+        true_errs = np.abs(Phis-ref).sum(axis = 2).max(axis = 1)
+        self.assertTrue(np.all(true_errs <= errs+1e-06))
+        self.assertTrue(true_errs.max() < 0.01)
+        self.assertEqual(smr.state_transition_operator_cache_error, errs.max())
+
+        # all ways to evaluate Phi use the cache
+        vals = smr._state_transition_operator_batch(t, t0, X)
+        self.assertTrue(np.allclose(vals, np.einsum('ijk,ik->ij', Phis, X)))
+        self.assertTrue(np.allclose(smr._state_transition_operator(t[0], t0[0], X[0]), vals[0]))
+        self.assertTrue(np.allclose(smr._state_transition_operator_matrices(t0[0], t[:1])[0], Phis[0]))
+        self.assertTrue(np.allclose(smr._state_transition_operator_matrices_backward(t[0], t0[:1])[0], Phis[0]))
+
+        with self.assertRaises(Exception):
+            smr._state_transition_operator_cached([11], [0])
+        with self.assertRaises(Exception):
+            smr._state_transition_operator_cached([1], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# vim:set ff=unix expandtab ts=4 sw=4:
+import unittest
+from pathlib import Path
+
+from sympy import symbols, Matrix, exp, Rational
+
+from testinfrastructure.InDirTest import InDirTest
+from bgc_md.steady_states import SteadyStateSolver
+
+
+class TestSteadyStateSolver(InDirTest):
+    def setUp(self):
+        self.x, self.y, self.u, self.k = symbols('x y u k')
+        x, y, u, k = self.x, self.y, self.u, self.k
+        self.rhs = Matrix([u - k*x, k*x - y])
+        self.state_vector = [x, y]
+
+
+    def test_formal_steady_states(self):
+        solver = SteadyStateSolver()
+        x, y, u, k = self.x, self.y, self.u, self.k
+        ss = solver.formal_steady_states(self.rhs, self.state_vector)
+        self.assertEqual(ss, [{x: u/k, y: u}])
+
+        # the cached result is a copy
+        ss[0][x] = 0
+        self.assertEqual(solver.formal_steady_states(self.rhs, self.state_vector), [{x: u/k, y: u}])
+
+        # the formal steady states are reused for parameter sets
+        ss = solver.parameter_set_steady_states(self.rhs, self.state_vector, {'u': 2, 'k': Rational(1, 2)})
+        self.assertEqual(ss, [{x: 4, y: 2}])
+        solver.close()
+
+
+    def test_persistent_cache(self):
+        solver = SteadyStateSolver(cache_dir='cache')
+        solver.formal_steady_states(self.rhs, self.state_vector)
+        solver.close()
+        self.assertEqual(len(list(Path('cache').iterdir())), 1)
+
+        solver = SteadyStateSolver(cache_dir='cache')
+        ss = solver.formal_steady_states(self.rhs, self.state_vector)
+        self.assertIsNone(solver._pool)
+        self.assertEqual(ss, [{self.x: self.u/self.k, self.y: self.u}])
+
+
+    def test_numeric_fallback(self):
+        x, y = self.x, self.y
+        # sympy can not solve this one symbolically
+        rhs = Matrix([1 - x*exp(x) - y, x - y**3])
+        solver = SteadyStateSolver(timeout=1e-6)
+        self.assertIsNone(solver.formal_steady_states(rhs, [x, y]))
+
+        ss = solver.parameter_set_steady_states(rhs, [x, y], {})
+        self.assertEqual(len(ss), 1)
+        val = rhs.subs(ss[0])
+        self.assertTrue(all(abs(v) < 1e-8 for v in val))
+
+        # the timeout is remembered
+        self.assertIsNone(solver.formal_steady_states(rhs, [x, y]))
+        self.assertIsNone(solver._pool)
+
+
+    def test_numeric_non_autonomous(self):
+        x, y = self.x, self.y
+        t = symbols('t')
+        rhs = Matrix([1 + t - x*exp(x) - y, x - y**3])
+        solver = SteadyStateSolver()
+        self.assertEqual(solver.numeric_steady_states(rhs, [x, y], {}), [])
+
+        # the steady states of the system frozen at the given time
+        for time in (0, 2):
+            ss = solver.numeric_steady_states(rhs, [x, y], {}, time_symbol=t, time=time)
+            self.assertEqual(len(ss), 1)
+            val = rhs.subs(ss[0]).subs(t, time)
+            self.assertTrue(all(abs(v) < 1e-8 for v in val))
+        self.assertNotEqual(ss, solver.numeric_steady_states(rhs, [x, y], {}, time_symbol=t))
+
+
+    def test_numeric_cache_key(self):
+        x = self.x
+        # the three fixed start vectors miss the steady state at 5
+        rhs = Matrix([(x-1)*(x-5)*(x-20)])
+        solver = SteadyStateSolver(cache_dir='cache')
+        self.assertEqual(len(solver.numeric_steady_states(rhs, [x], {}, nr_starts=3)), 2)
+
+        # more start vectors or another seed are not answered from the cache
+        solver = SteadyStateSolver(cache_dir='cache')
+        self.assertEqual(len(solver.numeric_steady_states(rhs, [x], {}, nr_starts=20)), 3)
+        self.assertEqual(len(solver.numeric_steady_states(rhs, [x], {}, nr_starts=20, seed=1)), 3)
+        self.assertEqual(len(list(Path('cache').iterdir())), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
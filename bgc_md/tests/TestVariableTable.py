@@ -0,0 +1,61 @@
+# vim:set ff=unix expandtab ts=4 sw=4:
+from bgc_md.VariableTable import VariableTable
+import unittest
+
+
+class TestVariableTable(unittest.TestCase):
+    def setUp(self):
+        self.vt = VariableTable([["name", "category", "key", "exprs", "unit"],
+                                 ["t", "components", "time_symbol", None, "d"],
+                                 ["C", "components", ["state_vector", "pools"], "C=Matrix(2,1,[C_1,C_2])", None],
+                                 ["C_1", "state_variables", None, None, "kgC"],
+                                 ["k", "parameters", None, None, "1/d"]])
+
+
+    def test_lookups(self):
+        vt = self.vt
+        self.assertEqual(vt.get_by_name("C", "exprs"), "C=Matrix(2,1,[C_1,C_2])")
+        self.assertEqual(vt.get_by_name("k", "unit"), "1/d")
+        with self.assertRaises(KeyError):
+            vt.get_by_name("x", "unit")
+
+        self.assertEqual(vt.rows_of_key("pools"), [1])
+        self.assertEqual(vt.rows_of_key("time_symbol"), [0])
+        self.assertEqual(vt.rows_of_key("no_key"), [])
+
+        self.assertEqual(vt.get_by_cond("unit", "name", "C_1"), "kgC")
+        self.assertEqual(vt.get_by_cond("unit", "name", "x"), None)
+        self.assertEqual(vt.get_by_cond("name", "unit", "1/d"), "k")
+
+        self.assertEqual(vt[1, "category"], "components")
+        self.assertEqual(vt[:, "name"], ["t", "C", "C_1", "k"])
+
+
+    def test_get_column_returns_copy(self):
+        names = self.vt.get_column("name")
+        names.remove("t")
+        self.assertEqual(self.vt.get_column("name"), ["t", "C", "C_1", "k"])
+
+
+    def test_changes_update_indexes(self):
+        vt = self.vt
+        vt.append_row(["C_2", "state_variables", "second_pool", None, "kgC"])
+        self.assertEqual(vt.get_by_name("C_2", "unit"), "kgC")
+        self.assertEqual(vt.rows_of_key("second_pool"), [4])
+
+        vt.remove_column("unit")
+        self.assertEqual(vt.head, ["name", "category", "key", "exprs"])
+        with self.assertRaises(KeyError):
+            vt.get_column("unit")
+
+
+    def test_duplicate_names(self):
+        vt = VariableTable([["name", "category"],
+                            ["C", "state_variables"],
+                            ["C", "parameters"]])
+        self.assertEqual(vt.duplicate_names, ["C"])
+        self.assertEqual(vt.get_by_name("C", "category"), "state_variables")
+
+
+if __name__ == '__main__':
+    unittest.main()
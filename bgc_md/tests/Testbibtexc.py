@@ -2,7 +2,9 @@
 #vim:set ff=unix expandtab ts=4 sw=4:
 
 import sys
+import time
 import unittest
+from types import SimpleNamespace
 from bgc_md.helpers import remove_indentation
 import bgc_md.bibtexc as bibtexc
 from bgc_md.bibtexc import DoiNotFoundException, BibtexEntry, online_entry
@@ -379,3 +381,116 @@ class TestbibtexcFiles(InDirTest):
 
 
 
+
+
+class TestBibliographyStore(InDirTest):
+
+    def setUp(self):
+        self.entry = {'ID': 'Korol1991CanadianJournalofForestResearch',
+                      'ENTRYTYPE': 'article',
+                      'year': '1991',
+                      'doi': '10.1139/x91-151',
+                      'title': 'Testing a mechanistic carbon balance model against observed tree growth',
+                      'journal': 'Canadian Journal of Forest Research',
+                      'author': 'Korol, R. L. and Running, S. W. and Milner, K. S. and Hunt Jr., E. R.'}
+        self.old_store = bibtexc.bibliography_store
+        self.old_offline = bibtexc.offline
+        bibtexc.bibliography_store = bibtexc.BibliographyStore('bibliography.jsonl')
+        bibtexc.offline = True
+
+    def tearDown(self):
+        bibtexc.bibliography_store = self.old_store
+        bibtexc.offline = self.old_offline
+        super().tearDown()
+
+    def test_store(self):
+        store = bibtexc.bibliography_store
+        self.assertIsNone(store.get('10.1139/x91-151'))
+        store.put('10.1139/x91-151', self.entry, abstract=False)
+        self.assertEqual(store.get('10.1139/X91-151'), self.entry)
+        # an entry retrieved without abstract is not used if the abstract is requested
+        self.assertIsNone(store.get('10.1139/x91-151', abstract=True))
+
+        # a new store reads the file
+        store = bibtexc.BibliographyStore('bibliography.jsonl')
+        self.assertEqual(store.get('10.1139/x91-151'), self.entry)
+
+    def test_offline(self):
+        bibtexc.bibliography_store.put('10.1139/x91-151', self.entry, abstract=False)
+        result = BibtexEntry.from_doi(doi='10.1139/x91-151')
+        self.assertEqual(result.entry['ID'], self.entry['ID'])
+
+        with self.assertRaises(DoiNotFoundException):
+            online_entry(doi='10.1029/93GB02725', abstract=False)
+
+        self.assertEqual(bibtexc.prefetch_dois(['10.1139/x91-151', '10.1029/93GB02725'], abstract=False), ['10.1029/93GB02725'])
+
+        with open('record.yaml', 'w') as f:
+            f.write("doi: 10.1139/x91-151\nparameter_sets:\n    - p1:\n        doi: 10.1029/93GB02725\n")
+        with open('broken.yaml', 'w') as f:
+            f.write("doi: [")
+        self.assertEqual(bibtexc.prefetch_record_dois(['record.yaml', 'broken.yaml'], abstract=False), ['10.1029/93GB02725'])
+
+    def test_dois_in(self):
+        dic = {'doi': '10.1139/x91-151', 'modelinformation': [{'doi': '10.1029/93GB02725'}, {'desc': 'no doi'}]}
+        self.assertEqual(bibtexc.dois_in(dic), ['10.1139/x91-151', '10.1029/93GB02725'])
+
+
+class TestMendeleySession(unittest.TestCase):
+    # fake sessions count their requests and are rejected by the server
+    # after max_requests
+    def setUp(self):
+        self.created = []
+        self.old_new_session = bibtexc._new_mendeley_session
+        self.old_session = bibtexc._sessions.pop('mendeley', None)
+
+        test = self
+        class Response:
+            status_code = 401
+            text = 'token expired'
+            def json(self): return {'message': self.text}
+
+        class Catalog:
+            def __init__(self, session): self.session = session
+            def by_identifier(self, doi, view):
+                self.session.requests += 1
+                if self.session.requests > self.session.max_requests:
+                    raise bibtexc.MendeleyApiException(Response())
+                return SimpleNamespace(identifiers={'doi': doi})
+
+        class Session:
+            def __init__(self, expires_in, max_requests):
+                self.token = {'expires_at': time.time() + expires_in}
+                self.requests = 0
+                self.max_requests = max_requests
+                self.catalog = Catalog(self)
+
+        def new_session():
+            session = Session(*test.next_session)
+            test.created.append(session)
+            return session
+        bibtexc._new_mendeley_session = new_session
+
+    def tearDown(self):
+        bibtexc._new_mendeley_session = self.old_new_session
+        bibtexc._sessions.pop('mendeley', None)
+        if self.old_session is not None:
+            bibtexc._sessions['mendeley'] = self.old_session
+
+    def test_renew(self):
+        self.next_session = (3600, 2)
+        bibtexc._mendeley_data('10.1139/x91-151')
+        bibtexc._mendeley_data('10.1139/x91-151')
+        self.assertEqual(len(self.created), 1)
+
+        # the server rejects the token
+        bibtexc._mendeley_data('10.1139/x91-151')
+        self.assertEqual(len(self.created), 2)
+        self.assertEqual(self.created[1].requests, 1)
+
+        # the token expires within the next minute
+        self.next_session = (10, 2)
+        bibtexc._mendeley_session(renew=True)
+        bibtexc._mendeley_data('10.1139/x91-151')
+        self.assertEqual(len(self.created), 4)
+        self.assertEqual(self.created[2].requests, 0)
@@ -37,6 +37,7 @@ setup(name='bgc_md',
                 # the next entry is only for test reasons
                 ,'generate_test_report = bgc_md.reports:generate_test_report' # ...
                 ,'render= bgc_md.reports:render_parse'
+                ,'prefetch_bibliography = bgc_md.reports:prefetch_bibliography' # fills the local bibliography store for --offline
                 ]
         },
         install_requires=[